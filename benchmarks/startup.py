@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Time how long it takes to import eddy and to instantiate its classes. Each
+import is timed in a fresh interpreter so that cached modules do not hide the
+cost of loading the heavy dependencies.
+
+Usage:
+    python benchmarks/startup.py [path/to/rotationmap.fits] [--ntrials N]
+"""
+
+import sys
+import argparse
+import subprocess
+import numpy as np
+
+
+def time_import(module='eddy', ntrials=5):
+    """Return the wall time in [s] of ``import module`` in fresh processes."""
+    cmd = ('import time; t0 = time.perf_counter(); import {}; '
+           'print(time.perf_counter() - t0)').format(module)
+    times = []
+    for _ in range(ntrials):
+        out = subprocess.run([sys.executable, '-c', cmd], check=True,
+                             capture_output=True, text=True).stdout
+        times.append(float(out.strip().split()[-1]))
+    return np.array(times)
+
+
+def time_rotationmap(path, ntrials=5):
+    """Return the wall time in [s] to instantiate a ``rotationmap``."""
+    import time
+    from eddy import rotationmap
+    times = []
+    for _ in range(ntrials):
+        t0 = time.perf_counter()
+        rotationmap(path)
+        times.append(time.perf_counter() - t0)
+    return np.array(times)
+
+
+def _report(label, times):
+    print('{:<28s} median {:7.1f} ms  (min {:.1f}, max {:.1f})'.format(
+          label, 1e3 * np.median(times), 1e3 * times.min(),
+          1e3 * times.max()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('path', nargs='?', default=None)
+    parser.add_argument('--ntrials', type=int, default=5)
+    args = parser.parse_args()
+
+    _report('import numpy', time_import('numpy', args.ntrials))
+    _report('import eddy', time_import('eddy', args.ntrials))
+    if args.path is not None:
+        _report('rotationmap(path)', time_rotationmap(args.path, args.ntrials))
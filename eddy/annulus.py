@@ -1,27 +1,52 @@
 # -*- coding: utf-8 -*-
 
-import zeus
 import time
-import emcee
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.ticker import MultipleLocator
+from importlib.util import find_spec
 from .helper_functions import plot_walkers, plot_corner, random_p0
-from scipy.stats import binned_statistic
-from scipy.optimize import curve_fit
-from scipy.optimize import minimize
+from .helper_functions import load_checkpoint, clear_checkpoint
+from .helper_functions import run_checkpointed, load_checkpoint_chain
 
-# Check is 'celerite' is installed.
+# Check is 'celerite' is installed. Only look for the module here so that the
+# import itself is deferred until a GP is actually built.
 
-try:
-    import celerite
-    celerite_installed = True
-except ImportError:
-    celerite_installed = False
+celerite_installed = find_spec('celerite') is not None
 
 __all__ = ['annulus']
 
 
+class _annulus_pixels(object):
+    """
+    Container for the per-pixel properties of an annulus. A single index
+    array, combining the sorting and the removal of empty spectra, is only
+    applied to each array when it is first accessed.
+    """
+
+    __slots__ = ('_values', '_index', '_pending')
+
+    def __init__(self, index=None, **values):
+        self._values = values
+        self._index = index
+        self._pending = set() if index is None else set(values)
+
+    def get(self, name):
+        if name in self._pending:
+            self._values[name] = self._values[name][self._index]
+            self._pending.discard(name)
+        return self._values[name]
+
+    def set(self, name, values):
+        self._values[name] = values
+        self._pending.discard(name)
+
+
+def _pixel_property(name, doc):
+    """Property reading ``name`` from the per-pixel container."""
+    return property(lambda self: self._pixels.get(name),
+                    lambda self, values: self._pixels.set(name, values),
+                    doc=doc)
+
+
 class annulus(object):
     """
     A class containing an annulus of spectra with their associated polar angles
@@ -47,61 +72,90 @@ class annulus(object):
         remove_empty (optional[bool]): Remove empty spectra.
         sort_spectra (optional[bool]): Sorted the spectra into increasing
             ``theta``.
+        bin_width (optional[float]): If provided, average the spectra in
+            azimuthal bins of this width in [deg] such that the fitting methods
+            run on far fewer spectra. Each binned spectrum takes the mean polar
+            angle, radius and sky position of its bin, and the array indices
+            of its central spectrum. The number of spectra in each bin is
+            stored in ``nspectra`` and the noise of each binned spectrum,
+            ``rms / sqrt(nspectra)``, in ``spectra_rms``. When the spectra are
+            stacked, each binned spectrum is weighted by ``spectra_rms**-2``.
+        pix_per_beam (optional[float]): Number of pixels per beam. If provided,
+            the number of independent spectra in each bin used for
+            ``spectra_rms`` is capped at the number of beams it covers,
+            ``nspectra / pix_per_beam``, as neighbouring pixels within a beam
+            have correlated noise.
+        dtype (optional[type]): If provided, store the spectra with this type,
+            for example ``np.float32`` to halve the memory of the annulus.
+        rms (optional[float]): The noise of a single spectrum. If not
+            provided, this is estimated from the first and last channels of
+            ``spectra``, so must be given if these may contain the line, for
+            example if the velocity axis has been cropped.
     """
 
+    theta = _pixel_property('theta', "Polar angles in [rad].")
+    rvals = _pixel_property('rvals', "Radial positions in [arcsec].")
+    xsky = _pixel_property('xsky', "On-sky x-offsets in [arcsec].")
+    ysky = _pixel_property('ysky', "On-sky y-offsets in [arcsec].")
+    jidx = _pixel_property('jidx', "j-indices of the original data array.")
+    iidx = _pixel_property('iidx', "i-indices of the original data array.")
+
     def __init__(self, spectra, pvals, velax, inc, rvals, xsky, ysky, jidx,
-                 iidx, remove_empty=True, sort_spectra=True):
+                 iidx, remove_empty=True, sort_spectra=True, bin_width=None,
+                 pix_per_beam=None, dtype=None, rms=None):
 
         # Read in the spectra and populate variables.
 
-        self.theta = pvals
-        self.rvals = rvals
-        self.xsky = xsky
-        self.ysky = ysky
-        self.jidx = jidx
-        self.iidx = iidx
         self.spectra = spectra
         if inc == 0.0:
             raise ValueError("Disk inclination must be non-zero.")
         else:
             self.inc = inc
 
-        # Estimate the RMS.
-
-        self.rms = self._estimate_RMS()
+        # Estimate the RMS if not provided.
 
-        # Sort the spectra with increasing polar angle.
+        self._rms_provided = rms is not None
+        self.rms = self._estimate_RMS() if rms is None else rms
 
-        if sort_spectra:
-            idxs = np.argsort(self.theta)
-            self.spectra = self.spectra[idxs]
-            self.theta = self.theta[idxs]
-            self.rvals = self.rvals[idxs]
-            self.xsky = self.xsky[idxs]
-            self.ysky = self.ysky[idxs]
-            self.jidx = self.jidx[idxs]
-            self.iidx = self.iidx[idxs]
-
-        # Remove empty pixels.
+        # Combine the removal of empty pixels and the sorting with increasing
+        # polar angle into a single index array. The spectra are gathered once
+        # with this index, or left as provided if it would not change them,
+        # while the remaining per-pixel arrays are only indexed when used.
 
+        idxs = np.arange(pvals.size)
         if remove_empty:
-            idxa = np.sum(self.spectra, axis=-1) != 0.0
-            idxb = np.std(self.spectra, axis=-1) != 0.0
-            idxs = idxa & idxb
-            self.theta = self.theta[idxs]
-            self.spectra = self.spectra[idxs]
-            self.rvals = self.rvals[idxs]
-            self.xsky = self.xsky[idxs]
-            self.ysky = self.ysky[idxs]
-            self.jidx = self.jidx[idxs]
-            self.iidx = self.iidx[idxs]
-        if self.theta.size < 1:
+            idxa = np.sum(spectra, axis=-1) != 0.0
+            idxb = np.std(spectra, axis=-1) != 0.0
+            idxs = idxs[idxa & idxb]
+        if sort_spectra:
+            idxs = idxs[np.argsort(pvals[idxs])]
+        if idxs.size < 1:
             raise ValueError("No finite spectra. Check for NaNs.")
+        if idxs.size == pvals.size and np.all(np.diff(idxs) > 0):
+            idxs = None
+        if idxs is None:
+            self.spectra = np.ascontiguousarray(spectra, dtype=dtype)
+        else:
+            self.spectra = np.asarray(spectra[idxs], dtype=dtype)
+        self._pixels = _annulus_pixels(index=idxs, theta=pvals, rvals=rvals,
+                                       xsky=xsky, ysky=ysky, jidx=jidx,
+                                       iidx=iidx)
+
+        # Average the spectra in azimuthal bins, propagating the noise. Only
+        # spectra separated by a beam are independent, so the number of
+        # independent spectra in a bin is at most the number of beams.
+
+        self.nspectra = np.ones(self.theta.size, dtype=int)
+        if bin_width is not None:
+            self._bin_spectra(np.radians(bin_width))
+        nindep = self.nspectra.astype(float)
+        if pix_per_beam is not None:
+            nindep = np.clip(nindep / pix_per_beam, 1.0, nindep)
+        self.spectra_rms = self.rms / np.sqrt(nindep)
 
         # Easier to use variables.
 
         self.theta_deg = np.degrees(self.theta)
-        self.spectra_flat = self.spectra.flatten()
         self.inc_rad = np.radians(self.inc)
         self.sini = np.sin(self.inc_rad)
         self.cosi = np.cos(self.inc_rad)
@@ -128,6 +182,38 @@ class annulus(object):
         self.theta_grid = np.linspace(-np.pi, np.pi, 60)
         self.velax_grid = self.velax.copy()
 
+    def _bin_spectra(self, bin_width):
+        """
+        Average the attached spectra in azimuthal bins of ``bin_width`` in
+        [rad]. The spectra are ordered by bin such that the sums can be made
+        with ``np.add.reduceat``.
+        """
+        if bin_width <= 0.0:
+            raise ValueError("`bin_width` must be positive.")
+        bins = np.floor((self.theta + np.pi) / bin_width).astype(int)
+        order = np.argsort(bins, kind='stable')
+        bins, counts = np.unique(bins[order], return_counts=True)
+        starts = np.append(0, np.cumsum(counts)[:-1])
+
+        def bin_mean(values):
+            values = np.add.reduceat(values[order], starts, axis=0)
+            return values / counts.reshape((-1,) + (1,) * (values.ndim - 1))
+
+        central = order[starts + counts // 2]
+        self.spectra = bin_mean(self.spectra)
+        self.theta = bin_mean(self.theta)
+        self.rvals = bin_mean(self.rvals)
+        self.xsky = bin_mean(self.xsky)
+        self.ysky = bin_mean(self.ysky)
+        self.jidx = self.jidx[central]
+        self.iidx = self.iidx[central]
+        self.nspectra = counts
+
+    @property
+    def spectra_flat(self):
+        """Flattened view of the spectra."""
+        return self.spectra.ravel()
+
     @property
     def extent_grid(self, degrees=True):
         if degrees:
@@ -144,7 +230,8 @@ class annulus(object):
             vrot_mask=None, vlsr_mask=None, vrad_mask=None, dv_mask=None,
             resample=None, optimize=True, nwalkers=32, nburnin=500, nsteps=500,
             scatter=1e-3, signal='int', optimize_kwargs=None, mcmc='emcee',
-            mcmc_kwargs=None, centroid_method='quadratic', repeat_with_mask=0):
+            mcmc_kwargs=None, centroid_method='quadratic', repeat_with_mask=0,
+            grid=None, kernel='histogram'):
         """
         Infer the requested velocities by shifting lines back to a common
         center and stacking. The quality of fit is given by the selected
@@ -209,6 +296,13 @@ class annulus(object):
             plots (optional[list]):
             repeat_with_mask (optional[int]): Number of iterations to use.
                 Currently only works with `fit_method='SHO'`.
+            grid (optional[int/list]): For ``fit_method='dV'`` or ``'SNR'``,
+                first search a grid of trial velocities, evaluated in a single
+                vectorized pass, and refine the best point with ``minimize``.
+                See :func:`get_vlos_dV` for details.
+            kernel (optional[str]): For ``fit_method='dV'`` or ``'SNR'``, use
+                ``'spline'`` to stack the spectra with a smooth kernel and
+                optimize with gradients. See :func:`get_vlos_dV` for details.
 
         Returns:
             v, dv (array, array): [coming soon]
@@ -263,7 +357,9 @@ class annulus(object):
                                     resample=resample,
                                     vlsr_mask=vlsr_mask,
                                     dv_mask=dv_mask,
-                                    optimize_kwargs=optimize_kwargs)
+                                    optimize_kwargs=optimize_kwargs,
+                                    grid=grid,
+                                    kernel=kernel)
 
             popt = np.array([popt[0], popt[1] if fit_vrad else np.nan, np.nan])
             cvar = np.ones(popt.size) * np.nan
@@ -276,7 +372,9 @@ class annulus(object):
                                      signal=signal,
                                      vlsr_mask=vlsr_mask,
                                      dv_mask=dv_mask,
-                                     optimize_kwargs=optimize_kwargs)
+                                     optimize_kwargs=optimize_kwargs,
+                                     grid=grid,
+                                     kernel=kernel)
 
             popt = np.array([popt[0], popt[1] if fit_vrad else np.nan, np.nan])
             cvar = np.ones(popt.size) * np.nan
@@ -344,7 +442,8 @@ class annulus(object):
     def get_vlos_GP(self, p0=None, fit_vrad=False, vlsr_mask=None, dv_mask=None,
         optimize=False, nwalkers=64,nburnin=50, nsteps=100, scatter=1e-3,
         niter=1, plots=None, returns=None, resample=False, mcmc='emcee',
-        optimize_kwargs=None, mcmc_kwargs=None):
+        optimize_kwargs=None, mcmc_kwargs=None, checkpoint=None, resume=False,
+        checkpoint_every=100):
         """
         Determine the azimuthally averaged rotational (and optionally radial)
         velocity by finding the greatest overlap between 
@@ -374,10 +473,22 @@ class annulus(object):
             optimize_kwargs (optional[dict]): Kwargs to pass to the initial
                 optimization of starting parameters.
             mcmc_kwargs (optional[dict]): Kwargs to pass to the MCMC sampler.
+            checkpoint (optional[str]): Path to a directory to write the chains
+                and sampler state to every ``checkpoint_every`` steps. Use a
+                different directory for each annulus.
+            resume (optional[bool]): Continue from the last checkpoint in
+                ``checkpoint``, skipping the optimization and any completed
+                iterations.
+            checkpoint_every (optional[int]): Number of steps between each
+                checkpoint.
 
         Returns:
             Dependent on what is specified in ``returns``.
         """
+        if mcmc == 'zeus':
+            from zeus import EnsembleSampler
+        else:
+            from emcee import EnsembleSampler
 
         # Starting positions.
 
@@ -401,9 +512,24 @@ class annulus(object):
         if np.any(np.isnan(p0)):
             raise ValueError("WARNING: NaNs in the p0 array.")
 
+        # Load the checkpoint if resuming, otherwise clear any previous one.
+
+        state = None
+        if checkpoint is not None:
+            if resume:
+                state = load_checkpoint(checkpoint)
+                if state is None:
+                    print("WARNING: No checkpoint found. Starting from p0.")
+            else:
+                clear_checkpoint(checkpoint)
+        elif resume:
+            raise ValueError("Must specify `checkpoint` to resume.")
+
         # Optimize the starting positions.
 
-        if optimize:
+        if state is not None:
+            p0 = state['p0']
+        elif optimize:
             if optimize_kwargs is None:
                 optimize_kwargs = {}
             p0 = self._optimize_p0_GP(p0,
@@ -422,19 +548,32 @@ class annulus(object):
         moves = mcmc_kwargs.pop('moves', None)
         pool = mcmc_kwargs.pop('pool', None)
 
+        n_start = 0 if state is None else int(state['level'])
+
         for n in range(int(niter)):
 
-            if mcmc == 'zeus':
-                EnsembleSampler = zeus.EnsembleSampler
-            else:
-                EnsembleSampler = emcee.EnsembleSampler
+            # Skip the iterations already completed in the checkpoint.
 
-            p0 = random_p0(p0, scatter, nwalkers[n % nwalkers.size])
+            if n < n_start:
+                continue
+
+            # The prior on the rotation velocity is centered on the mean of
+            # the starting walkers, so the value from the original start is
+            # restored when resuming from the checkpointed walkers.
+
+            p0_state, start = p0, 0
+            if state is not None and n == n_start:
+                p0, start = state['walkers'], int(state['step'])
+                vref = float(state['vref']) if 'vref' in state \
+                    else p0[:, 0].mean()
+            else:
+                p0 = random_p0(p0, scatter, nwalkers[n % nwalkers.size])
+                vref = p0[:, 0].mean()
 
             sampler = EnsembleSampler(nwalkers[n % nwalkers.size],
                                       p0.shape[1],
                                       self._lnprobability,
-                                      args=(p0[:, 0].mean(),
+                                      args=(vref,
                                             vlsr_mask,
                                             dv_mask,
                                             resample),
@@ -442,14 +581,21 @@ class annulus(object):
                                       pool=pool)
 
             total_steps = nburnin[n % nburnin.size] + nsteps[n % nsteps.size]
-            sampler.run_mcmc(p0, total_steps, progress=progress, **mcmc_kwargs)
+            if checkpoint is None:
+                sampler.run_mcmc(p0, total_steps, progress=progress,
+                                 **mcmc_kwargs)
+                chain = sampler.get_chain()
+            else:
+                run_checkpointed(sampler, p0, total_steps, checkpoint,
+                                 level=n, start=start, every=checkpoint_every,
+                                 progress=progress,
+                                 state=dict(p0=p0_state, vref=vref),
+                                 **mcmc_kwargs)
+                chain, _ = load_checkpoint_chain(checkpoint, n, total_steps)
 
             # Split off the burnt in samples.
 
-            if mcmc == 'emcee':
-                samples = sampler.chain[:, -int(nsteps[n % nsteps.size]):]
-            else:
-                samples = sampler.chain[-int(nsteps[n % nsteps.size]):]
+            samples = chain[-int(nsteps[n % nsteps.size]):]
             samples = samples.reshape(-1, samples.shape[-1])
             p0 = np.median(samples, axis=0)
             time.sleep(0.5)
@@ -459,10 +605,7 @@ class annulus(object):
         plots = ['walkers', 'corner'] if plots is None else plots
         plots = [p.lower() for p in np.atleast_1d(plots)]
         if 'walkers' in plots:
-            if mcmc == 'emcee':
-                walkers = sampler.chain.T
-            else:
-                walkers = np.rollaxis(sampler.chain.copy(), 2)
+            walkers = np.rollaxis(chain.copy(), 2)
             plot_walkers(walkers, nburnin[-1], labels, True)
         if 'corner' in plots:
             plot_corner(samples, labels)
@@ -511,6 +654,7 @@ class annulus(object):
             p0 (ndarray): Optimized array. If scipy.minimize does not converge
                 then p0 will not be updated. No warnings are given, however.
         """
+        from scipy.optimize import minimize
 
         # Default parameters for the minimization.
         # Bit messy to preserve user chosen values.
@@ -685,6 +829,7 @@ class annulus(object):
     @staticmethod
     def _build_kernel(x, y, hyperparams):
         """Build the GP kernel. Returns None if gp.compute(x) fails."""
+        import celerite
         noise, lnsigma, lnrho = hyperparams
         k_noise = celerite.terms.JitterTerm(log_sigma=np.log(noise))
         k_line = celerite.terms.Matern32Term(log_sigma=lnsigma, log_rho=lnrho)
@@ -761,7 +906,7 @@ class annulus(object):
 
     def get_vlos_dV(self, p0=None, fit_vrad=False, resample=False,
             vrot_mask=None, vlsr_mask=None, vrad_mask=None, dv_mask=None, 
-            optimize_kwargs=None):
+            optimize_kwargs=None, grid=None, kernel='histogram'):
         """
         Infer the rotational (and optically radial) velocity by minimizing the
         width of the shifted-and-stacked azimuthally averaged spectrum.
@@ -778,11 +923,25 @@ class annulus(object):
             vrad_mask (optional[float]): Disk-frame radial velocity in [m/s].
             dv_mask (optional[float]): Half-width of the mask in [m/s].
             optimize_kwargs (optional[dict]): Kwargs to pass to ``minimize``.
+            grid (optional[int/list]): If provided, start the optimization from
+                the best point of a grid of trial velocities, all evaluated at
+                once with :func:`deprojected_width_batch`. Either the number of
+                points along each axis, or a list of the axes. See
+                :func:`_grid_p0` for details.
+            kernel (optional[str]): If ``'spline'``, stack the resampled
+                spectra with a cubic B-spline kernel rather than binning them,
+                such that the objective is smooth and ``minimize`` can use
+                gradients, by default with ``'L-BFGS-B'``, in units of the
+                channel spacing. This requires ``resample`` to be set, as the
+                unbinned spectra are not smooth in the velocities. The
+                gradients are from central differences, evaluated in a single
+                batch with :func:`deprojected_width_batch`.
 
         Returns:
             Velocities which minimize the line width of the shifted and stacked
             spectrum.
         """
+        from scipy.optimize import minimize
 
         # Starting positions.
 
@@ -792,26 +951,59 @@ class annulus(object):
                 p0 = p0[:1]
         p0 = np.atleast_1d(p0)
 
+        # The smooth kernel only applies to resampled spectra.
+
+        if kernel not in ['histogram', 'spline']:
+            raise ValueError("`kernel` must be 'histogram' or 'spline'.")
+        if kernel == 'spline' and resample is False:
+            raise ValueError("`kernel='spline'` requires `resample`.")
+
+        # Start from the best point of the grid.
+
+        if grid is not None:
+            p0, step = self._grid_p0(self.deprojected_width_batch, p0, grid,
+                                     fit_vrad=fit_vrad, resample=resample,
+                                     vrot_mask=vrot_mask, vlsr_mask=vlsr_mask,
+                                     vrad_mask=vrad_mask, dv_mask=dv_mask,
+                                     kernel=kernel)
+
         # Populate the kwargs.
 
         optimize_kwargs = {} if optimize_kwargs is None else optimize_kwargs
-        optimize_kwargs['method'] = optimize_kwargs.get('method', 'Nelder-Mead')
+        method = 'L-BFGS-B' if kernel == 'spline' else 'Nelder-Mead'
+        optimize_kwargs['method'] = optimize_kwargs.get('method', method)
         options = optimize_kwargs.pop('options', {})
         options['maxiter'] = options.pop('maxiter', 10000)
         options['maxfun'] = options.pop('maxfun', 10000)
-        options['ftol'] = options.pop('ftol', 1e-4)
+        ftol = 1e-9 if kernel == 'spline' else 1e-4
+        options['ftol'] = options.pop('ftol', ftol)
+        if grid is not None:
+            options = self._grid_refine_options(optimize_kwargs['method'],
+                                                p0, step, options)
         optimize_kwargs['options'] = options
 
         # Run the minimization.
 
-        args = (fit_vrad, resample, vrot_mask, vlsr_mask, vrad_mask, dv_mask)
-        res = minimize(self.deprojected_width,
-                       x0=p0,
-                       args=args,
-                       **optimize_kwargs)
+        if kernel == 'spline':
+            scale = abs(self.chan)
+            func = self._batch_gradient(self.deprojected_width_batch, scale,
+                                        fit_vrad=fit_vrad, resample=resample,
+                                        vrot_mask=vrot_mask,
+                                        vlsr_mask=vlsr_mask,
+                                        vrad_mask=vrad_mask, dv_mask=dv_mask,
+                                        kernel=kernel)
+            res = minimize(func, x0=p0 / scale, jac=True, **optimize_kwargs)
+            res.x = res.x * scale
+        else:
+            args = (fit_vrad, resample, vrot_mask, vlsr_mask, vrad_mask,
+                    dv_mask)
+            res = minimize(self.deprojected_width,
+                           x0=p0,
+                           args=args,
+                           **optimize_kwargs)
         if not res.success:
             print("WARNING: minimize did not converge.")
-        return res.x if res.success else np.nan
+        return res.x if res.success else np.full(p0.size, np.nan)
 
     def deprojected_width(self, theta, fit_vrad=False, resample=True,
             vrot_mask=None, vlsr_mask=None, vrad_mask=None, dv_mask=None):
@@ -834,15 +1026,16 @@ class annulus(object):
         """
         from .helper_functions import get_gaussian_width
         vrot, vrad = theta if fit_vrad else (theta, 0.0)
-        x, y = self.deprojected_spectrum(vrot=vrot,
-                                         vrad=vrad,
-                                         resample=resample,
-                                         scatter=False,
-                                         vrot_mask=vrot_mask,
-                                         vlsr_mask=vlsr_mask,
-                                         vrad_mask=vrad_mask,
-                                         dv_mask=dv_mask)
-        return get_gaussian_width(*self._get_masked_spectrum(x, y))
+        spectrum = self.deprojected_spectrum(vrot=vrot,
+                                             vrad=vrad,
+                                             resample=resample,
+                                             scatter=resample is False,
+                                             vrot_mask=vrot_mask,
+                                             vlsr_mask=vlsr_mask,
+                                             vrad_mask=vrad_mask,
+                                             dv_mask=dv_mask)
+        return get_gaussian_width(*self._get_masked_spectrum(*spectrum),
+                                  return_uncertainty=False)
 
     # -- Rotation Velocity by Fitting a SHO -- #
 
@@ -873,6 +1066,7 @@ class annulus(object):
             pop, cvar (array, array): Arrays of the best-fit parameter values
             and their uncertainties returned from ``curve_fit``.
         """
+        from scipy.optimize import curve_fit
         from .helper_functions import SHO, SHO_double
         v0, dv0 = self.line_centroids(method=centroid_method,
                                       vrot_mask=vrot_mask,
@@ -928,7 +1122,7 @@ class annulus(object):
 
     def get_vlos_SNR(self, p0=None, fit_vrad=False, resample=False,
             signal='weighted', vrot_mask=None, vlsr_mask=None, vrad_mask=None,
-            dv_mask=None, optimize_kwargs=None):
+            dv_mask=None, optimize_kwargs=None, grid=None, kernel='histogram'):
         """
         Infer the rotation (and, optically, the radial) velocity by finding the
         rotation velocity (and radial velocities) which, after shifting all
@@ -951,6 +1145,23 @@ class annulus(object):
             vrad_mask (optional[float]): Disk-frame radial velocity in [m/s].
             dv_mask (optional[float]): Half-width of the mask in [m/s].
             optimize_kwargs (optional[dict]): Kwargs to pass to ``minimize``.
+            grid (optional[int/list]): If provided, start the optimization from
+                the best point of a grid of trial velocities, all evaluated at
+                once with :func:`deprojected_nSNR_batch`. Either the number of
+                points along each axis, or a list of the axes. See
+                :func:`_grid_p0` for details. As the integrated intensity is
+                almost independent of the velocities, this requires ``signal``
+                to be ``'weighted'`` or ``'max'``.
+            kernel (optional[str]): If ``'spline'``, stack the resampled
+                spectra with a cubic B-spline kernel rather than binning them,
+                such that the objective is smooth and ``minimize`` can use
+                gradients, by default with ``'L-BFGS-B'``, in units of the
+                channel spacing. This requires ``resample`` to be set, as the
+                unbinned spectra are not smooth in the velocities. The
+                gradients are from central differences, evaluated in a single
+                batch with :func:`deprojected_nSNR_batch`. As the integrated
+                intensity is almost independent of the velocities, ``signal``
+                must be ``'weighted'`` or ``'max'``.
 
         Returns:
             Velocities which maximizese signal to noise of the shifted and
@@ -959,6 +1170,7 @@ class annulus(object):
         .. _Yen et al. (2016): https://ui.adsabs.harvard.edu/abs/2016ApJ...832..204Y/abstract
 
         """
+        from scipy.optimize import minimize
 
         # Make sure the signal is defined.
 
@@ -974,26 +1186,66 @@ class annulus(object):
                 p0 = p0[:1]
         p0 = np.atleast_1d(p0)
 
+        # The smooth kernel only applies to resampled spectra.
+
+        if kernel not in ['histogram', 'spline']:
+            raise ValueError("`kernel` must be 'histogram' or 'spline'.")
+        if kernel == 'spline' and resample is False:
+            raise ValueError("`kernel='spline'` requires `resample`.")
+        if kernel == 'spline' and signal == 'int':
+            raise ValueError("`kernel='spline'` requires `signal='weighted'` "
+                             + "or `signal='max'`.")
+
+        # Start from the best point of the grid. With the integrated intensity
+        # the objective is essentially flat, so the best point is just noise.
+
+        if grid is not None and signal == 'int':
+            raise ValueError("`grid` requires `signal='weighted'` or "
+                             + "`signal='max'`.")
+        if grid is not None:
+            p0, step = self._grid_p0(self.deprojected_nSNR_batch, p0, grid,
+                                     fit_vrad=fit_vrad, resample=resample,
+                                     signal=signal, vrot_mask=vrot_mask,
+                                     vlsr_mask=vlsr_mask, vrad_mask=vrad_mask,
+                                     dv_mask=dv_mask, kernel=kernel)
+
         # Populate the kwargs. For some reason L-BFGS-B doesn't play nicely.
 
         optimize_kwargs = {} if optimize_kwargs is None else optimize_kwargs
-        optimize_kwargs['method'] = optimize_kwargs.get('method', 'Powell')
+        method = 'L-BFGS-B' if kernel == 'spline' else 'Powell'
+        optimize_kwargs['method'] = optimize_kwargs.get('method', method)
         options = optimize_kwargs.pop('options', {})
         options['maxiter'] = options.pop('maxiter', 10000)
         options['maxfun'] = options.pop('maxfun', 10000)
-        options['ftol'] = options.pop('ftol', 1e-4)
+        ftol = 1e-9 if kernel == 'spline' else 1e-4
+        options['ftol'] = options.pop('ftol', ftol)
+        if grid is not None:
+            options = self._grid_refine_options(optimize_kwargs['method'],
+                                                p0, step, options)
         optimize_kwargs['options'] = options
 
         # Run the minimization.
 
-        args = (fit_vrad, resample, signal, vrot_mask, vlsr_mask, vrad_mask, dv_mask)
-        res = minimize(self.deprojected_nSNR,
-                       x0=p0,
-                       args=args,
-                       **optimize_kwargs)
+        if kernel == 'spline':
+            scale = abs(self.chan)
+            func = self._batch_gradient(self.deprojected_nSNR_batch, scale,
+                                        fit_vrad=fit_vrad, resample=resample,
+                                        signal=signal, vrot_mask=vrot_mask,
+                                        vlsr_mask=vlsr_mask,
+                                        vrad_mask=vrad_mask, dv_mask=dv_mask,
+                                        kernel=kernel)
+            res = minimize(func, x0=p0 / scale, jac=True, **optimize_kwargs)
+            res.x = res.x * scale
+        else:
+            args = (fit_vrad, resample, signal, vrot_mask, vlsr_mask,
+                    vrad_mask, dv_mask)
+            res = minimize(self.deprojected_nSNR,
+                           x0=p0,
+                           args=args,
+                           **optimize_kwargs)
         if not res.success:
             print("WARNING: minimize did not converge.")
-        return res.x if res.success else np.nan
+        return res.x if res.success else np.full(p0.size, np.nan)
 
     def deprojected_nSNR(self, theta, fit_vrad=False, resample=False, signal='weighted',
             vrot_mask=None, vlsr_mask=None, vrad_mask=None, dv_mask=None):
@@ -1022,17 +1274,19 @@ class annulus(object):
         """
         from .helper_functions import gaussian, fit_gaussian
         vrot, vrad = theta if fit_vrad else (theta, 0.0)
-        x, y = self.deprojected_spectrum(vrot=vrot,
-                                         vrad=vrad,
-                                         resample=resample,
-                                         scatter=False,
-                                         vrot_mask=vrot_mask,
-                                         vlsr_mask=vlsr_mask,
-                                         vrad_mask=vrad_mask,
-                                         dv_mask=dv_mask)
-        x0, dx, A = fit_gaussian(x, y)
-
-        noise = self._estimate_RMS() / np.sqrt(self.theta.size)
+        spectrum = self.deprojected_spectrum(vrot=vrot,
+                                             vrad=vrad,
+                                             resample=resample,
+                                             scatter=resample is False,
+                                             vrot_mask=vrot_mask,
+                                             vlsr_mask=vlsr_mask,
+                                             vrad_mask=vrad_mask,
+                                             dv_mask=dv_mask)
+        x, y = spectrum[:2]
+        dy = spectrum[2] if len(spectrum) > 2 else None
+        x0, dx, A = fit_gaussian(x, y, dy, return_uncertainty=False)
+
+        noise = self._stacked_noise()
 
         if signal == 'max':
             SNR = A / noise
@@ -1045,6 +1299,309 @@ class annulus(object):
             SNR = np.trapz((y * w)[mask], x=x[mask])
         return -SNR
 
+    # -- Batched Objective Functions -- #
+
+    def deprojected_width_batch(self, theta, fit_vrad=False, resample=True,
+            vrot_mask=None, vlsr_mask=None, vrad_mask=None, dv_mask=None,
+            kernel='histogram'):
+        """
+        Return the Gaussian widths of the deprojected and stacked spectra for
+        a batch of trial velocities. This is equivalent to calling
+        :func:`deprojected_width` for each trial, but the shifting, binning
+        and Gaussian fitting are done for all trials at once.
+
+        Args:
+            theta (array): Deprojection velocities, ``(vrot[, vrad])``, with
+                shape ``(ntrials,)`` or ``(ntrials, 2)`` if ``fit_vrad``.
+            fit_vrad (optional[bool]): Whether ``vrad`` in is ``theta``.
+            resample (optional): How to resample the data.  See
+                :func:`deprojected_spectrum` for more details.
+            vrot_mask (float): Disk-frame rotational velocity in [m/s].
+            vlsr_mask (optional[float]): Systemic velocity in [m/s].
+            vrad_mask (optional[float]): Disk-frame radial velocity in [m/s].
+            dv_mask (optional[float]): Half-width of the mask in [m/s].
+            kernel (optional[str]): How the shifted spectra are stacked onto
+                the resampled velocity axis, either ``'histogram'`` to bin them
+                as :func:`deprojected_spectrum`, or ``'spline'`` to interpolate
+                them with a cubic B-spline kernel such that the objective is
+                smooth in the velocities. Unused if ``resample=False``.
+
+        Returns:
+            Array of the Doppler widths of the stacked spectrum for each trial.
+        """
+        from .helper_functions import fit_gaussian_batch
+        widths = []
+        batches = self._deprojected_spectrum_batch(theta=theta,
+                                                   fit_vrad=fit_vrad,
+                                                   resample=resample,
+                                                   vrot_mask=vrot_mask,
+                                                   vlsr_mask=vlsr_mask,
+                                                   vrad_mask=vrad_mask,
+                                                   dv_mask=dv_mask,
+                                                   kernel=kernel)
+        for x, y, weights in batches:
+            mask = (x >= self.velax_mask[0]) & (x <= self.velax_mask[1])
+            dV = fit_gaussian_batch(x, y, np.where(mask, weights, 0.0))[:, 1]
+            widths += [np.where(np.isfinite(dV), abs(dV), 1e50)]
+        return np.concatenate(widths)
+
+    def deprojected_nSNR_batch(self, theta, fit_vrad=False, resample=False,
+            signal='weighted', vrot_mask=None, vlsr_mask=None, vrad_mask=None,
+            dv_mask=None, kernel='histogram'):
+        """
+        Return the negative SNR of the deprojected spectra for a batch of
+        trial velocities. This is equivalent to calling
+        :func:`deprojected_nSNR` for each trial, but the shifting, binning
+        and Gaussian fitting are done for all trials at once.
+
+        Args:
+            theta (array): Disk-frame velocities, ``(vrot[, vrad])``, with
+                shape ``(ntrials,)`` or ``(ntrials, 2)`` if ``fit_vrad``.
+            fit_vrad (optional[bool]): Whether ``vrad`` in is ``theta``.
+            resample (optional): How to resample the data. See
+                :func:`deprojected_spectrum` for more details.
+            signal (optional[str]): Definition of SNR to use.
+            vrot_mask (float): Disk-frame rotational velocity in [m/s].
+            vlsr_mask (optional[float]): Systemic velocity in [m/s].
+            vrad_mask (optional[float]): Disk-frame radial velocity in [m/s].
+            dv_mask (optional[float]): Half-width of the mask in [m/s].
+            kernel (optional[str]): How the shifted spectra are stacked onto
+                the resampled velocity axis, either ``'histogram'`` to bin them
+                as :func:`deprojected_spectrum`, or ``'spline'`` to interpolate
+                them with a cubic B-spline kernel such that the objective is
+                smooth in the velocities. Unused if ``resample=False``.
+
+        Returns:
+            Array of the negative signal-to-noise ratios for each trial.
+        """
+        from .helper_functions import gaussian, fit_gaussian_batch
+        noise = self._stacked_noise()
+        nSNR = []
+        batches = self._deprojected_spectrum_batch(theta=theta,
+                                                   fit_vrad=fit_vrad,
+                                                   resample=resample,
+                                                   vrot_mask=vrot_mask,
+                                                   vlsr_mask=vlsr_mask,
+                                                   vrad_mask=vrad_mask,
+                                                   dv_mask=dv_mask,
+                                                   kernel=kernel)
+        for x, y, weights in batches:
+
+            # Unbinned spectra must be ordered in velocity for the integral.
+
+            if resample is False:
+                idxs = np.argsort(x, axis=1)
+                x = np.take_along_axis(x, idxs, axis=1)
+                y = np.take_along_axis(y, idxs, axis=1)
+                weights = np.take_along_axis(weights, idxs, axis=1)
+            x0, dx, A = fit_gaussian_batch(x, y, weights).T
+            if signal == 'max':
+                nSNR += [-A / noise]
+                continue
+
+            # Integrate the (weighted) line with the trapezium rule, pairing
+            # each included point with the previous included point.
+
+            x0, dx = x0[:, None], dx[:, None]
+            with np.errstate(invalid='ignore'):
+                if signal == 'weighted':
+                    y = y * gaussian(x, x0, dx, (np.sqrt(np.pi) * abs(dx))**-1)
+                mask = (weights > 0.0) & (abs(x - x0) / dx <= 3.0)
+            prev = np.where(mask, np.arange(x.shape[1])[None, :], -1)
+            prev = np.maximum.accumulate(prev, axis=1)
+            prev = np.pad(prev[:, :-1], ((0, 0), (1, 0)), constant_values=-1)
+            pair = mask & (prev >= 0)
+            prev = np.clip(prev, 0, None)
+            xstep = x - np.take_along_axis(x, prev, axis=1)
+            ysum = y + np.take_along_axis(y, prev, axis=1)
+            SNR = np.sum(np.where(pair, 0.5 * xstep * ysum, 0.0), axis=1)
+            nSNR += [np.where(np.isfinite(A), -SNR, np.nan)]
+        return np.concatenate(nSNR)
+
+    def _deprojected_spectrum_batch(self, theta, fit_vrad=False,
+            resample=True, vrot_mask=None, vlsr_mask=None, vrad_mask=None,
+            dv_mask=None, kernel='histogram', max_size=4e6):
+        """
+        Yield the ``(x, y, weights)`` arrays of the deprojected spectra for
+        the trial velocities ``theta``, as returned by
+        :func:`deprojected_spectrum`, but with shape ``(ntrials, npnts)`` and
+        the ``weights`` of each point, zero for points to ignore. All trials
+        are shifted and stacked in a single vectorized pass, split into
+        chunks with no more than ``max_size`` shifted points.
+
+        With ``kernel='histogram'`` the spectra are binned and each bin has
+        unit weight. With ``kernel='spline'`` each shifted point is instead
+        spread over the four nearest velocity bins with a cubic B-spline
+        kernel, such that the stacked spectrum, and the weights given by the
+        summed kernel in each bin, vary smoothly with the trial velocities.
+        In both cases the points are weighted by the inverse variance of their
+        spectrum, ``spectra_rms**-2``, which is also the weight of each point
+        without resampling.
+        """
+        if kernel not in ['histogram', 'spline']:
+            raise ValueError("`kernel` must be 'histogram' or 'spline'.")
+        theta = np.atleast_2d(np.asarray(theta, dtype=float).T).T
+        vrot = theta[:, 0, None]
+        vrad = theta[:, 1, None] if fit_vrad else 0.0
+        vlos = self.calc_vlos(vrot=vrot, vrad=vrad)
+
+        # Only points within the velocity mask are used.
+
+        velocity_mask = self.get_velocity_mask(vrot_mask=vrot_mask,
+                                               vlsr_mask=vlsr_mask,
+                                               vrad_mask=vrad_mask,
+                                               dv_mask=dv_mask)
+        velocity_mask &= np.isfinite(self.spectra)
+        if resample is False:
+            velocity_mask &= self.spectra != 0.0
+        rows, chans = np.nonzero(velocity_mask)
+        spnts = self.spectra[rows, chans]
+        wpnts = (self.rms / self.spectra_rms[rows])**2
+
+        # Shift and bin each chunk of trials. The velocity bins are uniform
+        # such that the bin of each point can be calculated directly.
+
+        nchunk = max(1, int(max_size // max(spnts.size, 1)))
+        for i in range(0, theta.shape[0], nchunk):
+            vpnts = self.velax[chans][None, :] - vlos[i:i+nchunk, rows]
+            ntrials = vpnts.shape[0]
+            if resample is False:
+                y = np.broadcast_to(spnts, vpnts.shape)
+                yield vpnts, y, np.broadcast_to(wpnts, vpnts.shape)
+                continue
+            if isinstance(resample, (int, bool)):
+                nbins = int(self.velax.size * int(resample))
+                width = (self.velax[-1] - self.velax[0]) / nbins
+                x0 = np.full(ntrials, self.velax[0])
+            elif isinstance(resample, float):
+                bins = np.arange(self.velax[0], self.velax[-1], resample)
+                nbins, width = bins.size - 1, resample
+                x0 = bins[0] + 0.5 * (vpnts.max(axis=1) - bins[-1])
+            elif isinstance(resample, np.ndarray):
+                width = np.diff(resample).mean()
+                nbins = resample.size
+                x0 = np.full(ntrials, resample[0] - 0.5 * width)
+            else:
+                raise TypeError("Resample must be a boolean, int, float "
+                                + "or array.")
+            x = x0[:, None] + (np.arange(nbins)[None, :] + 0.5) * width
+            pnts = (vpnts - x0[:, None]) / width
+            offset = nbins * np.arange(ntrials)[:, None]
+            size = ntrials * nbins
+            if kernel == 'histogram':
+                idxs = np.floor(pnts).astype(int)
+                valid = (idxs >= 0) & (idxs < nbins)
+                idxs = (idxs + offset)[valid]
+                values = np.broadcast_to(spnts, vpnts.shape)[valid]
+                w = np.broadcast_to(wpnts, vpnts.shape)[valid]
+                count = np.bincount(idxs, minlength=size)
+                wsum = np.bincount(idxs, weights=w, minlength=size)
+                total = np.bincount(idxs, weights=w * values, minlength=size)
+                total2 = np.bincount(idxs, weights=w * values**2,
+                                     minlength=size)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    y = total / wsum
+                    var = total2 / wsum - y**2
+                weights = ((count > 1) & (var > 0.0) & (y != 0.0)) * 1.0
+                yield (x, y.reshape(ntrials, nbins),
+                       weights.reshape(ntrials, nbins))
+                continue
+
+            # Spread each point over the neighbouring bin centers.
+
+            pnts -= 0.5
+            lower = np.floor(pnts).astype(int)
+            count = np.zeros(size)
+            total = np.zeros(size)
+            for shift in range(-1, 3):
+                idxs = lower + shift
+                dist = abs(pnts - idxs)
+                kern = np.where(dist < 1.0,
+                                4.0 - 6.0 * dist**2 + 3.0 * dist**3,
+                                np.clip(2.0 - dist, 0.0, None)**3) / 6.0
+                valid = (idxs >= 0) & (idxs < nbins)
+                idxs = (idxs + offset)[valid]
+                kern = kern[valid] * np.broadcast_to(wpnts, vpnts.shape)[valid]
+                values = np.broadcast_to(spnts, vpnts.shape)[valid]
+                count += np.bincount(idxs, weights=kern, minlength=size)
+                total += np.bincount(idxs, weights=kern * values,
+                                     minlength=size)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                y = np.where(count > 0.0, total / count, 0.0)
+            yield (x, y.reshape(ntrials, nbins),
+                   count.reshape(ntrials, nbins))
+
+    def _grid_p0(self, objective, p0, grid, **kwargs):
+        """
+        Return the point of a grid of trial velocities which minimizes the
+        batched ``objective``, either :func:`deprojected_width_batch` or
+        :func:`deprojected_nSNR_batch`, and the grid spacing along each axis
+        to scale the subsequent refinement. If ``grid`` is an integer, or
+        ``True`` for 31, it is the number of points along each axis with
+        ``vrot`` spanning 0.5 to 1.5 times the starting value and ``vrad``
+        spanning the starting value plus or minus half of the starting
+        ``vrot``. Otherwise ``grid`` is a list of the ``vrot`` (and ``vrad``)
+        values to use.
+        """
+        p0 = np.atleast_1d(p0).astype(float)
+        if np.ndim(grid) == 0:
+            npts = 31 if grid is True else int(grid)
+            dv = 0.5 * abs(p0[0])
+            axes = [np.linspace(p - dv, p + dv, npts) for p in p0]
+        elif isinstance(grid[0], (list, tuple, np.ndarray)):
+            axes = [np.atleast_1d(a) for a in grid]
+        else:
+            axes = [np.atleast_1d(grid)]
+        if len(axes) != p0.size:
+            raise ValueError("`grid` must have an axis for each parameter.")
+        step = np.array([np.diff(a).mean() if a.size > 1 else 1.0
+                         for a in axes])
+        theta = np.meshgrid(*axes, indexing='ij')
+        theta = np.stack([t.flatten() for t in theta], axis=1)
+        values = objective(theta, **kwargs)
+        if np.all(np.isnan(values)):
+            print("WARNING: grid search failed, using p0.")
+            return p0, step
+        return theta[np.nanargmin(values)], step
+
+    @staticmethod
+    def _grid_refine_options(method, p0, step, options):
+        """Scale the initial steps of ``minimize`` to the grid spacing."""
+        if method.lower() == 'nelder-mead':
+            simplex = np.vstack([np.zeros(p0.size), np.diag(step)])
+            options.setdefault('initial_simplex', p0[None, :] + simplex)
+        elif method.lower() == 'powell':
+            options.setdefault('direc', np.diag(step))
+        return options
+
+    def _batch_gradient(self, objective, scale, **kwargs):
+        """
+        Wrap the batched ``objective`` as a function of the velocities in
+        units of ``scale``, returning its value and gradient. The gradient is
+        from central differences of a hundredth of ``scale``, with all
+        ``2 * ndim + 1`` evaluations made in a single batch. Working in units
+        of roughly the channel spacing keeps the curvature of the objective of
+        order unity, as expected by quasi-Newton methods.
+        """
+        def func(x):
+            x = np.atleast_1d(x)
+            shifts = 1e-2 * np.eye(x.size)
+            shifts = np.vstack([np.zeros(x.size), shifts, -shifts])
+            values = objective(scale * (x[None, :] + shifts), **kwargs)
+            grad = values[1:x.size+1] - values[x.size+1:]
+            return values[0], grad / 2e-2
+        return func
+
+    def _stacked_noise(self):
+        """
+        Noise of the average of all spectra. This is estimated from the edge
+        channels of the spectra unless ``rms`` was provided, in which case it
+        is propagated from ``spectra_rms``.
+        """
+        if self._rms_provided:
+            return np.sqrt(np.sum(self.spectra_rms**2)) / self.theta.size
+        return self._estimate_RMS() / np.sqrt(self.theta.size)
+
     def _estimate_RMS(self, N=15, iterative=False, nsigma=3.0):
         """Estimate the RMS of the data."""
         if iterative:
@@ -1201,6 +1758,12 @@ class annulus(object):
         It is important to disgintuish between ``float`` and ``int`` arguments
         for ``resample``.
 
+        If the spectra have been azimuthally binned, each spectrum is weighted
+        by its inverse variance, ``spectra_rms**-2``, such that they
+        contribute in proportion to the number of spectra they contain.
+        Without resampling, ``dy`` is the noise of the spectrum each point
+        comes from.
+
         A mask can also be applied to the data assuming azimuthally symmetric
         rotational and radial velocities.
 
@@ -1223,6 +1786,14 @@ class annulus(object):
         vpnts = self.velax[None, :] - vlos[:, None]
         spnts = self.spectra.copy()
 
+        # Weights are only needed if the noise differs between spectra, or
+        # to return the noise of each point without resampling.
+
+        weighted = resample is False or np.ptp(self.spectra_rms) > 0.0
+        if weighted:
+            wpnts = np.broadcast_to(self.spectra_rms[:, None]**-2.0,
+                                    spnts.shape)
+
         # Apply the velocity mask.
 
         velocity_mask = self.get_velocity_mask(vrot_mask=vrot_mask,
@@ -1232,13 +1803,20 @@ class annulus(object):
 
         # Order the spectra in increasing velocity and then resample them.
 
-        vpnts, spnts = self._order_spectra(vpnts=vpnts[velocity_mask],
-                                           spnts=spnts[velocity_mask])
-        
+        if weighted:
+            vpnts, spnts, wpnts = self._order_spectra(
+                vpnts=vpnts[velocity_mask], spnts=spnts[velocity_mask],
+                wpnts=wpnts[velocity_mask])
+        else:
+            vpnts, spnts = self._order_spectra(vpnts=vpnts[velocity_mask],
+                                               spnts=spnts[velocity_mask])
+            wpnts = None
+
         x, y, dy = self._resample_spectra(vpnts=vpnts,
                                           spnts=spnts,
                                           resample=resample,
-                                          scatter=True)
+                                          scatter=True,
+                                          wpnts=wpnts)
 
         mask = np.isfinite(y)
         if scatter:
@@ -1344,33 +1922,38 @@ class annulus(object):
        
         elif method == 'quadratic':
             from bettermoments.quadratic import quadratic
-            vmax = [quadratic(s, uncertainty=self.rms,
+            vmax = [quadratic(s, uncertainty=rms,
                               x0=v[0], dx=self.chan)
-                    for v, s in zip(velax, spectra)]
+                    for v, s, rms in zip(velax, spectra,
+                                         self.spectra_rms)]
             vmax, dvmax = np.array(vmax).T[:2]
        
         elif method == 'gaussian':
             from .helper_functions import get_gaussian_center
-            vmax = [get_gaussian_center(v, s, self.rms)
-                    for v, s in zip(velax, spectra)]
+            vmax = [get_gaussian_center(v, s, rms)
+                    for v, s, rms in zip(velax, spectra,
+                                         self.spectra_rms)]
             vmax, dvmax = np.array(vmax).T
        
         elif method == 'gaussthick':
             from .helper_functions import get_gaussthick_center
-            vmax = [get_gaussthick_center(v, s, self.rms)
-                    for v, s in zip(velax, spectra)]
+            vmax = [get_gaussthick_center(v, s, rms)
+                    for v, s, rms in zip(velax, spectra,
+                                         self.spectra_rms)]
             vmax, dvmax = np.array(vmax).T
         
         elif method == 'doublegauss':
             from .helper_functions import get_doublegauss_center
-            vmax = [get_doublegauss_center(v, s, self.rms)
-                    for v, s in zip(velax, spectra)]
+            vmax = [get_doublegauss_center(v, s, rms)
+                    for v, s, rms in zip(velax, spectra,
+                                         self.spectra_rms)]
             vmax, dvmax = np.array(vmax).T
         
         elif method == 'doublegauss_fixeddv':
             from .helper_functions import get_doublegauss_fixeddV_center
-            vmax = [get_doublegauss_fixeddV_center(v, s, self.rms)
-                    for v, s in zip(velax, spectra)]
+            vmax = [get_doublegauss_fixeddV_center(v, s, rms)
+                    for v, s, rms in zip(velax, spectra,
+                                         self.spectra_rms)]
             vmax, dvmax = np.array(vmax).T
         
         else:
@@ -1378,17 +1961,23 @@ class annulus(object):
         
         return vmax, dvmax
 
-    def _order_spectra(self, vpnts, spnts=None):
-        """Return velocity ordered spectra removing any NaNs."""
+    def _order_spectra(self, vpnts, spnts=None, wpnts=None):
+        """
+        Return velocity ordered spectra removing any NaNs, and the weights of
+        each point if ``wpnts`` is provided.
+        """
         spnts = self.spectra_flat if spnts is None else spnts
         nan_mask = np.isfinite(spnts)
         vpnts, spnts = vpnts[nan_mask], spnts[nan_mask]
         if len(spnts) != len(vpnts):
             raise ValueError("Wrong size in 'vpnts' and 'spnts'.")
         idxs = np.argsort(vpnts)
-        return vpnts[idxs], spnts[idxs]
+        if wpnts is None:
+            return vpnts[idxs], spnts[idxs]
+        return vpnts[idxs], spnts[idxs], wpnts[nan_mask][idxs]
 
-    def _resample_spectra(self, vpnts, spnts, resample=False, scatter=False):
+    def _resample_spectra(self, vpnts, spnts, resample=False, scatter=False,
+                          wpnts=None):
         """
         Resample the spectra to a given velocity axis. The scatter is estimated
         as the standard deviation of the bin (note that this is not rescaled by
@@ -1404,12 +1993,17 @@ class annulus(object):
                 originally supplied velocity axis. If a float, this will
                 describe the spectral resolution of the sampled grid.
             scatter (bool): If True, return the standard deviation in each bin.
+            wpnts (Optional[ndarray]): Inverse-variance weights of each point.
+                If provided, the weighted mean and standard deviation of each
+                bin are returned, or ``wpnts**-0.5`` as the uncertainty of
+                each point without resampling.
 
         Returns:
             x (ndarray): Velocity bin centers.
             y (ndarray): Mean of the bin.
             dy (ndarray/None): Standard error on the mean of the bin.
         """
+        from scipy.stats import binned_statistic
         if type(resample) is bool:
             x = vpnts.copy()
             y = spnts.copy()
@@ -1417,6 +2011,8 @@ class annulus(object):
             if not resample:
                 if not scatter:
                     return x[mask], y[mask]
+                if wpnts is not None:
+                    return x[mask], y[mask], wpnts[mask]**-0.5
                 return x[mask], y[mask], np.ones(x[mask].size) * np.nan
         if isinstance(resample, (int, bool)):
             bins = int(self.velax.size * int(resample) + 1)
@@ -1433,19 +2029,46 @@ class annulus(object):
             raise TypeError("Resample must be a boolean, int, float or array.")
         idxs = np.isfinite(spnts)
         vpnts, spnts = vpnts[idxs], spnts[idxs]
-        y = binned_statistic(vpnts, spnts, statistic='mean', bins=bins)[0]
         x = np.average([bins[1:], bins[:-1]], axis=0)
+        if wpnts is None:
+            y = binned_statistic(vpnts, spnts, statistic='mean', bins=bins)[0]
+        else:
+
+            # Find the bin of each point once, matching `binned_statistic`
+            # in including the right edge of the last bin, and accumulate
+            # the weighted sums with `bincount`.
+
+            nbins = bins.size - 1
+            ibin = np.searchsorted(bins, vpnts, side='right') - 1
+            ibin[vpnts == bins[-1]] = nbins - 1
+            inside = (ibin >= 0) & (ibin < nbins)
+            ibin, spnts = ibin[inside], spnts[inside]
+            wpnts = wpnts[idxs][inside]
+            wsum = np.bincount(ibin, weights=wpnts, minlength=nbins)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                y = np.bincount(ibin, weights=wpnts * spnts,
+                                minlength=nbins) / wsum
         mask = np.logical_and(np.isfinite(y), y != 0.0)
         if not scatter:
             return x[mask], y[mask]
-        dy = binned_statistic(vpnts, spnts, statistic='std', bins=bins)[0]
+        if wpnts is None:
+            dy = binned_statistic(vpnts, spnts, statistic='std', bins=bins)[0]
+        else:
+            count = np.bincount(ibin, minlength=nbins)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                dy = np.bincount(ibin, weights=wpnts * spnts**2,
+                                 minlength=nbins) / wsum
+                dy = np.sqrt(np.clip(dy - y**2, 0.0, None))
+            dy = np.where(count > 1, dy, 0.0)
         mask = np.logical_and(dy > 0.0, mask)
         return x[mask], y[mask], dy[mask]
 
-    def _get_masked_spectrum(self, x, y):
-        """Return the masked spectrum for fitting."""
+    def _get_masked_spectrum(self, x, y, dy=None):
+        """Return the masked spectrum, and uncertainties, for fitting."""
         mask = np.logical_and(x >= self.velax_mask[0], x <= self.velax_mask[1])
-        return x[mask], y[mask]
+        if dy is None:
+            return x[mask], y[mask]
+        return x[mask], y[mask], dy[mask]
 
     def guess_parameters(self, method='quadratic', fit=True):
         """
@@ -1462,6 +2085,7 @@ class annulus(object):
         Returns:
             The rotational, radial and systemic velocities all in [m/s].
         """
+        from scipy.optimize import curve_fit
         vpeaks, _ = self.line_centroids(method=method)
         vlsr = np.mean(vpeaks)
 
@@ -1536,6 +2160,7 @@ class annulus(object):
         Returns
             Figure with the attached spectra plotted.
         """
+        import matplotlib.pyplot as plt
         if ax is None:
             fig, ax = plt.subplots(figsize=(5.0, 3.1), constrained_layout=True)
         else:
@@ -1581,6 +2206,7 @@ class annulus(object):
         Returns:
             fig (matplotlib figure) if ``return_fig=True``.
         """
+        import matplotlib.pyplot as plt
 
         # Get the deprojected spectrum and transform to mJy/beam.
         # Remove all points which have a zero uncertainty if resampled.
@@ -1681,6 +2307,7 @@ class annulus(object):
         Returns:
             Matplotlib figure. To access the axis use ``ax=fig.axes[0]``.
         """
+        import matplotlib.pyplot as plt
 
         # Imports.
 
@@ -1825,6 +2452,8 @@ class annulus(object):
             Matplotlib figure. If `return_fig=True`. To access the axis use
                 ``ax=fig.axes[0]``. 
         """
+        import matplotlib.pyplot as plt
+        from matplotlib.ticker import MultipleLocator
 
         from .helper_functions import SHO_double
         if ax is None:
@@ -1927,6 +2556,7 @@ class annulus(object):
 
     @staticmethod
     def cmap_RdGy():
+        import matplotlib.pyplot as plt
         import matplotlib.colors as mcolors
         c2 = plt.cm.Reds(np.linspace(0.0, 0.9, 16))
         c1 = plt.cm.gray(np.linspace(0.2, 1.0, 16))
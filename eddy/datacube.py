@@ -2,10 +2,7 @@
 
 import os
 import numpy as np
-from astropy.io import fits
 import scipy.constants as sc
-import matplotlib.pyplot as plt
-from matplotlib.ticker import MaxNLocator, MultipleLocator
 import warnings
 
 warnings.filterwarnings("ignore")
@@ -28,14 +25,41 @@ class datacube(object):
             is useful if the FITS header does not contain axis information.
     """
 
-    flared_niter = 5
+    # Maximum number of iterations, tolerance in units of the pixel size and
+    # update method ('fixed' or 'newton') used to solve for flared surfaces.
+
+    flared_niter = 100
+    flared_tol = 1e-2
+    flared_method = 'fixed'
+
+    # If True, tabulate the emission surface on a 1D radial grid of
+    # z_func_npts points once per call of disk_coords and interpolate this
+    # table during the deprojection, rather than calling z_func directly.
+
+    z_func_tabulate = False
+    z_func_npts = 2048
+
     shadowed_extend = 1.5
     shadowed_oversample = 2.0
     shadowed_method = 'nearest'
 
+    # Indices of the pixels held when the data is stored in a compact form
+    # and, if these pixels have been binned, the bin each pixel belongs to and
+    # whether models are averaged over the pixels of each bin.
+
+    _pix_idx = None
+    _pix_bins = None
+    _pix_average = False
+
     msun = 1.98847e30
     fwhm = 2. * np.sqrt(2 * np.log(2))
 
+    # Attributes which, when reassigned, clear the cached statistics derived
+    # from them, such as the cube RMS or the beam area.
+
+    _cache_dependencies = ('data', 'velax', 'xaxis', 'yaxis', 'bmaj', 'bmin',
+                           'bpa')
+
     def __init__(self, path, FOV=None, velocity_range=None, fill=None,
                  force_center=False):
 
@@ -53,8 +77,30 @@ class datacube(object):
         if velocity_range is not None:
             self._clip_cube_velocity(*velocity_range)
 
+    def __setattr__(self, name, value):
+        if name in self._cache_dependencies:
+            self.__dict__.pop('_cache', None)
+        super().__setattr__(name, value)
+
+    def _cached(self, key, func):
+        """Return the cached value of ``key``, calculating it with ``func``."""
+        cache = self.__dict__.setdefault('_cache', {})
+        if key not in cache:
+            cache[key] = func()
+        return cache[key]
+
+    def clear_cache(self):
+        """
+        Clear the cached statistics derived from the data, the axes and the
+        beam. This happens automatically when any of these attributes are
+        reassigned, but must be called manually if the arrays are edited in
+        place, for example ``cube.data[cube.data < 0.0] = 0.0``.
+        """
+        self.__dict__.pop('_cache', None)
+
     @property
     def rms(self):
+        """RMS of the cube from :func:`estimate_cube_RMS`, cached."""
         return self.estimate_cube_RMS()
 
     # -- PIXEL DEPROJECTION -- #
@@ -102,7 +148,9 @@ class datacube(object):
         If the emission surface is more complex than the analytical form
         described above, users may provide their own function, ``z_func``,
         which should return the emission height in [arcsec] for a midplane
-        radius in [arcsec].
+        radius in [arcsec]. For expensive functions, setting
+        ``z_func_tabulate = True`` will evaluate the emission surface once on a
+        fine radial grid and interpolate this during the deprojection.
 
         For certain emission surfaces and high inclination disks, the
         transformation from on-sky coordinates to disk-frame coordinates can be
@@ -171,10 +219,12 @@ class datacube(object):
             r, t, z = self._get_conical_polar_coords(x0, y0, inc, PA, z0)
         else:
             if z_func is None:
-                r_taper = np.inf if r_taper is None else r_taper
-                def z_func(r_in):
-                    r = np.clip(r_in - r_cavity, a_min=0.0, a_max=None)
-                    return z0 * r**psi * np.exp(-np.power(r/r_taper, q_taper))
+                z_func = datacube._get_power_law_z_func(z0=z0, psi=psi,
+                                                        r_cavity=r_cavity,
+                                                        r_taper=r_taper,
+                                                        q_taper=q_taper)
+            if self.z_func_tabulate:
+                z_func = self._tabulate_z_func(z_func, x0, y0, inc)
             if shadowed:
                 r, t, z = self._get_shadowed_coords(x0, y0, inc, PA, z_func)
             else:
@@ -244,11 +294,19 @@ class datacube(object):
     def sky_to_disk(self, coords, x0=0.0, y0=0.0, inc=0.0, PA=0.0, z0=None,
                     psi=None, r_cavity=0.0, r_taper=None, q_taper=1.0,
                     z_func=None, shadowed=True, frame='cartesian',
-                    griddata_kwargs=None):
+                    griddata_kwargs=None, pointwise=False):
         """
         Project sky-frame coordinates onto cylindrical disk-plane coordinates.
         Note that the azimuthal angle is returned in [degrees].
 
+        By default the full image is deprojected and the disk-frame
+        coordinates interpolated at the requested points. With
+        ``pointwise=True`` the surface equations are instead solved directly
+        for each point, which is not limited by the pixel grid and scales with
+        the number of points rather than the image size. Note that this will
+        always return the solution for the side of the surface closest to the
+        midplane, such that ``shadowed`` is ignored.
+
         Args:
             coords (tuple): A tuple of the sky-frame coordinates to transform.
                 Must be either cartestian or polar frames,
@@ -280,6 +338,9 @@ class datacube(object):
                 either ``'cartesian'`` or ``'polar'``.
             griddata_kwargs (Optional[dict]): Kwargs to pass to
                 ``scipy.interpolate.griddata``.
+            pointwise (Optional[bool]): If ``True``, solve for the disk-frame
+                coordinates of each point directly rather than interpolating
+                the deprojected image.
 
         Returns:
             array, array, array: The projection of the input coordinates into
@@ -309,6 +370,14 @@ class datacube(object):
         else:
             raise ValueError("Unknown `frame` value {}.".format(frame))
 
+        if pointwise:
+            return self._sky_to_disk_pointwise(x=x, y=y, x0=x0, y0=y0,
+                                               inc=inc, PA=PA, z0=z0,
+                                               psi=psi, r_cavity=r_cavity,
+                                               r_taper=r_taper,
+                                               q_taper=q_taper,
+                                               z_func=z_func)
+
         # Generate the on-sky pixels.
 
         rvals, tvals, zvals = self.disk_coords(x0=x0,
@@ -348,6 +417,47 @@ class datacube(object):
 
         return r, t, z
 
+    def _sky_to_disk_pointwise(self, x, y, x0=0.0, y0=0.0, inc=0.0, PA=0.0,
+                               z0=None, psi=None, r_cavity=0.0, r_taper=None,
+                               q_taper=1.0, z_func=None):
+        """
+        Solve for the cylindrical disk-frame coordinates of each of the points
+        ``(x, y)`` individually. Follows the axis convention of the
+        interpolation in ``sky_to_disk`` such that ``x`` is the offset along
+        the declination axis and ``y`` along the right ascension axis. Returns
+        ``r``, ``t`` and ``z`` in [arcsec], [degrees] and [arcsec].
+        """
+        shape = np.shape(x)
+        x_sky = np.atleast_1d(y).astype(float) - x0
+        y_sky = np.atleast_1d(x).astype(float) - y0
+        inc = inc if inc < 90.0 else inc - 180.0
+
+        if z0 is None and z_func is None:
+            x_d, y_d = self._rotate_coords(x_sky, y_sky, PA)
+            x_d, y_d = self._deproject_coords(x_d, y_d, inc)
+            r, z = np.hypot(x_d, y_d), np.zeros(x_d.shape)
+        elif psi is None and z_func is None:
+            x_d, y_d, z = self._get_conical_coords(x_sky, y_sky,
+                                                   np.radians(inc),
+                                                   np.radians(PA - 90.0), z0)
+            r = np.hypot(x_d, y_d)
+        else:
+            if z_func is None:
+                z_func = datacube._get_power_law_z_func(z0=z0, psi=psi,
+                                                        r_cavity=r_cavity,
+                                                        r_taper=r_taper,
+                                                        q_taper=q_taper)
+            x_d, y_mid = self._rotate_coords(x_sky, y_sky, PA)
+            x_d, y_mid = self._deproject_coords(x_d, y_mid, inc)
+            y_d, _ = datacube._solve_flared_surface(
+                x_mid=x_d, y_mid=y_mid, z_func=z_func,
+                tan_inc=np.tan(np.radians(inc)),
+                **self._flared_kwargs(method='newton'))
+            r = np.hypot(x_d, y_d)
+            z = z_func(r)
+        t = np.degrees(np.arctan2(y_d, x_d))
+        return r.reshape(shape), t.reshape(shape), z.reshape(shape)
+
     @staticmethod
     def _rotate_coords(x, y, PA):
         """Rotate (x, y) by PA [deg]."""
@@ -362,6 +472,8 @@ class datacube(object):
 
     def _get_cart_sky_coords(self, x0, y0):
         """Return cartesian sky coordinates in [arcsec, arcsec]."""
+        if self._pix_idx is not None:
+            return self._pix_xsky - x0, self._pix_ysky - y0
         return np.meshgrid(self.xaxis - x0, self.yaxis - y0)
 
     def _get_midplane_cart_coords(self, x0, y0, inc, PA):
@@ -380,6 +492,11 @@ class datacube(object):
         inc = np.radians(inc)
         PA = np.radians(PA - 90.0)
         x_sky, y_sky = self._get_cart_sky_coords(x0, y0)
+        return datacube._get_conical_coords(x_sky, y_sky, inc, PA, z0)
+
+    @staticmethod
+    def _get_conical_coords(x_sky, y_sky, inc, PA, z0):
+        """Return cartesian coords of a conical surface, angles in [rad]."""
         x_rot = x_sky * np.cos(PA) - y_sky * np.sin(PA)
         y_rot = x_sky * np.sin(PA) + y_sky * np.cos(PA)
         psi = np.tan(z0)
@@ -397,15 +514,219 @@ class datacube(object):
         x_d, y_d, z_d = self._get_conical_cart_coords(x0, y0, inc, PA, z0)
         return np.hypot(y_d, x_d), np.arctan2(y_d, x_d), z_d
 
+    @staticmethod
+    def _get_power_law_z_func(z0, psi=None, r_cavity=0.0, r_taper=None,
+                              q_taper=1.0):
+        """
+        Return the tapered power-law emission surface as a function of radius
+        in [arcsec]. Terms which do not contribute, i.e. no cavity, no taper or
+        a linear flaring, are dropped from the returned function.
+        """
+        psi = 1.0 if psi is None else psi
+        r_cavity = r_cavity or 0.0
+        has_taper = r_taper is not None and np.isfinite(r_taper)
+
+        def z_func(r_in):
+            if r_cavity > 0.0:
+                r = np.clip(r_in - r_cavity, a_min=0.0, a_max=None)
+            else:
+                r = np.clip(r_in, a_min=0.0, a_max=None)
+            z = z0 * r if psi == 1.0 else z0 * r**psi
+            if has_taper:
+                rr = r / r_taper
+                z *= np.exp(-(rr if q_taper == 1.0 else rr**q_taper))
+            return z
+        return z_func
+
+    def _tabulate_z_func(self, z_func, x0, y0, inc):
+        """
+        Tabulate ``z_func`` on a radial grid of ``z_func_npts`` points which
+        spans the deprojected field of view and return a function which
+        linearly interpolates this table. Any radii beyond the table are
+        evaluated with ``z_func`` directly.
+        """
+        r_max = np.hypot(abs(self.xaxis).max() + abs(x0),
+                         abs(self.yaxis).max() + abs(y0))
+        r_max /= max(abs(np.cos(np.radians(inc))), 0.1)
+        r_grid = np.linspace(0.0, r_max, int(self.z_func_npts))
+        z_grid = z_func(r_grid)
+        dz_grid = np.diff(z_grid)
+        dr = r_grid[1] - r_grid[0]
+
+        def z_tab(r_in):
+            r_in = np.asarray(r_in, dtype=float)
+            f = np.nan_to_num(r_in / dr, nan=0.0)
+            idx = np.clip(f.astype(int), 0, dz_grid.size - 1)
+            z = z_grid[idx] + (f - idx) * dz_grid[idx]
+            z = np.where(np.isfinite(r_in), z, np.nan)
+            outside = r_in > r_max
+            if np.any(outside):
+                z[outside] = z_func(r_in[outside])
+            return z
+        return z_tab
+
     def _get_flared_coords(self, x0, y0, inc, PA, z_func, w_func=None):
         """Return cyclindrical coords of surface in [arcsec, rad, arcsec]."""
         x_mid, y_mid = self._get_midplane_cart_coords(x0, y0, inc, PA)
-        r_tmp, t_tmp = np.hypot(x_mid, y_mid), np.arctan2(y_mid, x_mid)
-        for _ in range(self.flared_niter):
-            y_tmp = y_mid + z_func(r_tmp) * np.tan(np.radians(inc))
-            r_tmp = np.hypot(y_tmp, x_mid)
-            t_tmp = np.arctan2(y_tmp, x_mid)
-        return r_tmp, t_tmp, z_func(r_tmp)
+        y_tmp, self.flared_stats = datacube._solve_flared_surface(
+            x_mid=x_mid, y_mid=y_mid, z_func=z_func,
+            tan_inc=np.tan(np.radians(inc)), **self._flared_kwargs())
+        r_tmp = np.hypot(y_tmp, x_mid)
+        return r_tmp, np.arctan2(y_tmp, x_mid), z_func(r_tmp)
+
+    @staticmethod
+    def _solve_flared_surface(x_mid, y_mid, z_func, tan_inc, tol=1e-6,
+                              maxiter=5, method='fixed'):
+        """
+        Solve ``y = y_mid + z(hypot(x_mid, y)) * tan(inc)`` for the disk-frame
+        y-coordinate of each pixel. Once a pixel has converged, i.e. its
+        update was smaller than ``tol``, it is no longer iterated on. With
+        ``method='newton'`` Newton steps are taken using a finite difference
+        derivative of ``z_func``, falling back to the fixed-point update for
+        any step which does not reduce the residual, ``|y_new - y|``. A
+        warning is raised if any pixels have not converged after ``maxiter``
+        iterations.
+
+        Args:
+            x_mid (array): Midplane x-coordinates in [arcsec].
+            y_mid (array): Midplane y-coordinates in [arcsec].
+            z_func (callable): Emission surface, ``z(r)`` in [arcsec].
+            tan_inc (float/array): Tangent of the disk inclination. An array
+                must be broadcastable to ``y_mid``.
+            tol (Optional[float]): Absolute tolerance in [arcsec]. If ``None``,
+                all ``maxiter`` iterations are run on all pixels.
+            maxiter (Optional[int]): Maximum number of iterations.
+            method (Optional[str]): Update method, ``'fixed'`` or
+                ``'newton'``.
+
+        Returns:
+            y, stats (array, dict): The disk-frame y-coordinates with the same
+            shape as ``y_mid`` and a dictionary describing the convergence.
+        """
+        method = method.lower()
+        if method not in ['fixed', 'newton']:
+            raise ValueError("method must be 'fixed' or 'newton'.")
+        tol = -np.inf if tol is None else tol
+        x, y0 = x_mid.ravel(), y_mid.ravel()
+        if np.ndim(tan_inc):
+            tan_inc = np.broadcast_to(tan_inc, y_mid.shape).ravel()
+        y = y0 + z_func(np.hypot(x, y0)) * tan_inc
+        delta = abs(y - y0)
+
+        # While most pixels are still updating it is cheaper to iterate on
+        # all of them than to gather the unconverged ones.
+
+        niter, active = 1, None
+        while niter < maxiter:
+            if active is None and np.mean(delta > tol) < 0.5:
+                active = np.flatnonzero(delta > tol)
+            if active is not None and active.size == 0:
+                break
+            idx = slice(None) if active is None else active
+            y_a, x_a, y0_a = y[idx], x[idx], y0[idx]
+            t_a = tan_inc[idx] if np.ndim(tan_inc) else tan_inc
+            r_a = np.hypot(x_a, y_a)
+            z_a = z_func(r_a)
+            y_new = y0_a + z_a * t_a
+            if method == 'newton':
+                dzdr = (z_func(r_a + 1e-6) - z_a) / 1e-6
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    dfdy = dzdr * t_a * y_a / r_a - 1.0
+                    y_newton = y_a - (y_new - y_a) / dfdy
+                    z_newton = z_func(np.hypot(x_a, y_newton))
+                    res_newton = abs(y0_a + z_newton * t_a - y_newton)
+                better = res_newton < abs(y_new - y_a)
+                y_new = np.where(better, y_newton, y_new)
+            step = abs(y_new - y_a)
+            y[idx] = y_new
+            if active is None:
+                delta = step
+            else:
+                active = active[step > tol]
+            niter += 1
+
+        # Pixels which diverged are also counted as not converged.
+
+        if active is None:
+            unconverged = ~(delta <= tol)
+        else:
+            unconverged = np.zeros(y.size, dtype=bool)
+            unconverged[active] = True
+        unconverged |= ~np.isfinite(y) & np.isfinite(y0)
+        nunconverged = np.sum(unconverged)
+        if nunconverged > 0:
+            warnings.warn("{:d} of {:d} pixels did not converge onto the "
+                          "emission surface after {:d} iterations. Consider "
+                          "increasing `flared_niter`.".format(
+                              int(nunconverged), y.size, niter))
+        stats = {'niter': niter,
+                 'nunconverged': int(nunconverged),
+                 'npix': y.size}
+        return y.reshape(y_mid.shape), stats
+
+    def _flared_kwargs(self, method=None):
+        """Solver settings for :func:`_solve_flared_surface`."""
+        tol = self.flared_tol
+        return dict(tol=None if tol is None else tol * self.dpix,
+                    maxiter=self.flared_niter,
+                    method=self.flared_method if method is None else method)
+
+    def _batch_disk_coords(self, x0, y0, inc, PA, z0=None, psi=None,
+                           r_cavity=0.0, r_taper=None, q_taper=1.0,
+                           z_func=None, pix=None, **_):
+        """
+        Vectorized version of :func:`disk_coords` for a batch of geometries.
+        Any of ``x0``, ``y0``, ``inc`` and ``PA`` can be arrays of shape
+        ``(nbatch,)`` and the cylindrical coordinates are returned with shape
+        ``(nbatch, npix)`` for the flattened pixels ``pix``, or all pixels if
+        ``None``. Shadowed and tabulated surfaces are not supported, so use
+        the standard flared deprojection.
+        """
+        x_sky, y_sky = self._get_cart_sky_coords(0.0, 0.0)
+        x_sky, y_sky = np.ravel(x_sky), np.ravel(y_sky)
+        if pix is not None:
+            x_sky, y_sky = x_sky[pix], y_sky[pix]
+        return datacube._batch_sky_to_disk(
+            x_sky, y_sky, x0=x0, y0=y0, inc=inc, PA=PA, z0=z0, psi=psi,
+            r_cavity=r_cavity, r_taper=r_taper, q_taper=q_taper,
+            z_func=z_func, flared_kwargs=self._flared_kwargs())
+
+    @staticmethod
+    def _batch_sky_to_disk(x_sky, y_sky, x0, y0, inc, PA, z0=None, psi=None,
+                           r_cavity=0.0, r_taper=None, q_taper=1.0,
+                           z_func=None, flared_kwargs=None, **_):
+        """
+        As :func:`_batch_disk_coords`, but for the 1D sky coordinates
+        ``x_sky`` and ``y_sky`` in [arcsec] of the pixels, such that these can
+        be precomputed when the same pixels are deprojected repeatedly.
+        ``flared_kwargs`` are the settings of :func:`_solve_flared_surface`.
+        """
+        x0, y0, inc, PA = [np.reshape(p, (-1, 1)).astype(float)
+                           for p in (x0, y0, inc, PA)]
+        inc = np.where(inc < 90.0, inc, inc - 180.0)
+        x_sky, y_sky = x_sky[None, :] - x0, y_sky[None, :] - y0
+
+        if z0 is None and z_func is None:
+            x_rot, y_rot = datacube._rotate_coords(x_sky, y_sky, PA)
+            x_mid, y_mid = datacube._deproject_coords(x_rot, y_rot, inc)
+            r = np.hypot(y_mid, x_mid)
+            return r, np.arctan2(y_mid, x_mid), np.zeros(r.shape)
+        if psi is None and z_func is None:
+            x_d, y_d, z_d = datacube._get_conical_coords(
+                x_sky, y_sky, np.radians(inc), np.radians(PA - 90.0), z0)
+            return np.hypot(y_d, x_d), np.arctan2(y_d, x_d), z_d
+        if z_func is None:
+            z_func = datacube._get_power_law_z_func(z0=z0, psi=psi,
+                                                    r_cavity=r_cavity,
+                                                    r_taper=r_taper,
+                                                    q_taper=q_taper)
+        x_rot, y_rot = datacube._rotate_coords(x_sky, y_sky, PA)
+        x_mid, y_mid = datacube._deproject_coords(x_rot, y_rot, inc)
+        y = datacube._solve_flared_surface(
+            x_mid=x_mid, y_mid=y_mid, z_func=z_func,
+            tan_inc=np.tan(np.radians(inc)), **(flared_kwargs or {}))[0]
+        r = np.hypot(y, x_mid)
+        return r, np.arctan2(y, x_mid), z_func(r)
 
     def _get_shadowed_coords(self, x0, y0, inc, PA, z_func, w_func=None):
         """
@@ -442,7 +763,7 @@ class datacube(object):
 
         from scipy.interpolate import griddata
         disk = (x_rot.flatten(), y_rot.flatten())
-        grid = (self.xaxis[None, :], self.yaxis[:, None])
+        grid = self._get_cart_sky_coords(0.0, 0.0)
         r_obs = griddata(disk, rdisk.flatten(), grid,
                          method=self.shadowed_method)
         t_obs = griddata(disk, tdisk.flatten(), grid,
@@ -602,6 +923,51 @@ class datacube(object):
 
         return rgrid, tgrid, gridded
 
+    # -- COMPACT PIXEL FUNCTIONS -- #
+
+    def rasterize(self, values, fill_value=np.nan):
+        """
+        Place values defined only on the pixels, or bins, of a compact
+        representation back onto the 2D image grid. If the data is not held in
+        a compact form, or ``values`` does not match the number of compact
+        pixels, ``values`` is returned unchanged.
+
+        Args:
+            values (array): Array of values for each of the compact pixels.
+            fill_value (Optional[float]): Value to give all other pixels.
+
+        Returns:
+            image (array): The 2D image of ``values``.
+        """
+        if self._pix_idx is None or np.ndim(values) != 1:
+            return values
+        if np.size(values) != self._pix_xsky.size:
+            return values
+        image = np.full((self.nypix, self.nxpix), fill_value,
+                        dtype=np.result_type(values, fill_value))
+        if self._pix_bins is None:
+            image[self._pix_idx] = values
+        else:
+            image[self._pix_idx] = np.asarray(values)[self._pix_bins]
+        return image
+
+    def _compact_values(self, values):
+        """
+        Return the compact pixels of a 2D image if needed. For binned data the
+        average value of the pixels in each bin is returned.
+        """
+        if self._pix_idx is None or np.ndim(values) != 2:
+            return values
+        if np.shape(values) != (self.nypix, self.nxpix):
+            return values
+        values = np.asarray(values)[self._pix_idx]
+        if self._pix_bins is None:
+            return values
+        nbins = self._pix_xsky.size
+        counts = np.bincount(self._pix_bins, minlength=nbins)
+        values = np.bincount(self._pix_bins, weights=values, minlength=nbins)
+        return values / counts
+
     @staticmethod
     def _griddata(points, values, xi, griddata_kwargs=None):
         """Wrapper for ``scipy.interpolate.griddata``."""
@@ -710,13 +1076,14 @@ class datacube(object):
         if np.sum(mask) == 0:
             raise ValueError("There are zero pixels in the mask.")
         if user_mask is not None:
-            mask *= user_mask
+            mask *= self._compact_values(user_mask)
         return mask
 
     # -- DATA I/O -- #
 
     def _read_FITS(self, path, fill=None, force_center=False):
         """Reads the data from the FITS file."""
+        from astropy.io import fits
 
         # File names.
 
@@ -776,6 +1143,7 @@ class datacube(object):
 
     def _read_beam(self):
         """Reads the beam properties from the header."""
+        from astropy.io import fits
         try:
             if self.header.get('CASAMBM', False):
                 beam = fits.open(self.path)[1].data
@@ -785,15 +1153,11 @@ class datacube(object):
                 self.bmaj = self.header['bmaj'] * 3600.
                 self.bmin = self.header['bmin'] * 3600.
                 self.bpa = self.header['bpa']
-            self.beamarea_arcsec = self._calculate_beam_area_arcsec()
-            self.beamarea_str = self._calculate_beam_area_str()
         except Exception:
             print("WARNING: No beam values found. Assuming pixel as beam.")
             self.bmaj = self.dpix
             self.bmin = self.dpix
             self.bpa = 0.0
-            self.beamarea_arcsec = self.dpix**2.0
-            self.beamarea_str = np.radians(self.dpix / 3600.)**2.0
         self.bpa %= 180.0
 
     def print_beam(self):
@@ -805,6 +1169,17 @@ class datacube(object):
         """Returns beam properties."""
         return self.bmaj, self.bmin, self.bpa
 
+    @property
+    def beamarea_arcsec(self):
+        """Beam area in square arcseconds."""
+        return self._cached('beamarea_arcsec',
+                            self._calculate_beam_area_arcsec)
+
+    @property
+    def beamarea_str(self):
+        """Beam area in steradians."""
+        return self._cached('beamarea_str', self._calculate_beam_area_str)
+
     @property
     def beams_per_pix(self):
         """Number of beams per pixel."""
@@ -979,13 +1354,13 @@ class datacube(object):
         nu = self.nu0 if nu is None else nu
         data = self.data if data is None else data
         jy2k = 1e-26 * sc.c**2 / nu**2 / 2. / sc.k
-        return jy2k * data / self._calculate_beam_area_str()
+        return jy2k * data / self.beamarea_str
 
     def jybeam_to_Tb(self, data=None, nu=None):
         """[Jy/beam] to [K] conversion using the full Planck law."""
         nu = self.nu0 if nu is None else nu
         data = self.data if data is None else data
-        Tb = 1e-26 * abs(data) / self._calculate_beam_area_str()
+        Tb = 1e-26 * abs(data) / self.beamarea_str
         Tb = 2.0 * sc.h * nu**3 / Tb / sc.c**2
         Tb = sc.h * nu / sc.k / np.log(Tb + 1.0)
         return np.where(data >= 0.0, Tb, -Tb)
@@ -995,7 +1370,7 @@ class datacube(object):
         nu = self.nu0 if nu is None else nu
         data = self.data if data is None else data
         jy2k = 1e-26 * sc.c**2 / nu**2 / 2. / sc.k
-        return data * self._calculate_beam_area_str() / jy2k
+        return data * self.beamarea_str / jy2k
 
     def Tb_to_jybeam(self, data=None, nu=None):
         """[K] to [Jy/beam] conversion using the full Planck law."""
@@ -1003,7 +1378,7 @@ class datacube(object):
         data = self.data if data is None else data
         Fnu = 2. * sc.h * nu**3 / sc.c**2
         Fnu /= np.exp(sc.h * nu / sc.k / abs(data)) - 1.0
-        Fnu *= self._calculate_beam_area_str() / 1e-26
+        Fnu *= self.beamarea_str / 1e-26
         return np.where(data >= 0.0, Fnu, -Fnu)
 
     # -- BEAM FUNCTIONS -- #
@@ -1052,13 +1427,16 @@ class datacube(object):
             r_out (float): Outer edge of pixels to consider in [arcsec].
 
         Returns:
-            RMS (float): The RMS based on the requested pixel range.
+            RMS (float): The RMS based on the requested pixel range. This is
+            cached until the data or axes change.
         """
-        r_dep = np.hypot(self.xaxis[None, :], self.yaxis[:, None])
-        rmask = np.logical_and(r_dep >= r_in, r_dep <= r_out)
-        rms = np.concatenate([self.data[:int(N)], self.data[-int(N):]])
-        rms = np.where(rmask[None, :, :], rms, np.nan)
-        return np.sqrt(np.nansum(rms**2) / np.sum(np.isfinite(rms)))
+        def calculate_RMS():
+            r_dep = np.hypot(self.xaxis[None, :], self.yaxis[:, None])
+            rmask = np.logical_and(r_dep >= r_in, r_dep <= r_out)
+            rms = np.concatenate([self.data[:int(N)], self.data[-int(N):]])
+            rms = np.where(rmask[None, :, :], rms, np.nan)
+            return np.sqrt(np.nansum(rms**2) / np.sum(np.isfinite(rms)))
+        return self._cached(('rms', int(N), r_in, r_out), calculate_RMS)
 
     def integrated_spectrum(self, x0=0.0, y0=0.0, inc=0.0, PA=0.0, r_min=None,
                             r_max=None):
@@ -1093,7 +1471,7 @@ class datacube(object):
 
         Args:
             beam_spacing (int): Sample pixels separated by roughly
-            `beam_spacing * bmaj` in azimuthal distance.
+            `beam_spacing * bmaj` on the sky.
             rvals (ndarray): Array of radial values in [arcsec].
             pvals (ndarray): Array of polar angles in [radians].
             dvals (ndarray): Array of data values.
@@ -1110,48 +1488,57 @@ class datacube(object):
         if not beam_spacing:
             return rvals, pvals, dvals, xsky, ysky, jidx, iidx
 
-        # Order pixels and arrays in increasing phi.
-
-        idxs = np.argsort(pvals)
-        dvals = dvals[idxs]
-        pvals = pvals[idxs]
-        rvals = rvals[idxs]
-        xsky = xsky[idxs]
-        ysky = ysky[idxs]
-        jidx = jidx[idxs]
-        iidx = iidx[idxs]
-
-        # Calculate the sampling rate.
-
-        sampling = float(beam_spacing) * self.bmaj
-        sampling /= np.mean(rvals) * np.median(np.diff(pvals))
-        sampling = np.floor(sampling).astype('int')
-
-        # If the sampling rate is above 1, start at a random location in
-        # the array and sample at this rate, otherwise don't sample. This
-        # happens at small radii, for example.
-
-        if sampling > 1:
-            start = np.random.randint(0, pvals.size)
-            dvals = np.vstack([dvals[start:], dvals[:start]])
-            pvals = np.concatenate([pvals[start:], pvals[:start]])
-            rvals = np.concatenate([rvals[start:], rvals[:start]])
-            xsky = np.concatenate([xsky[start:], xsky[:start]])
-            ysky = np.concatenate([ysky[start:], ysky[:start]])
-            jidx = np.concatenate([jidx[start:], jidx[:start]])
-            iidx = np.concatenate([iidx[start:], iidx[:start]])
-            dvals = dvals[::sampling]
-            pvals = pvals[::sampling]
-            rvals = rvals[::sampling]
-            xsky = xsky[::sampling]
-            ysky = ysky[::sampling]
-            jidx = jidx[::sampling]
-            iidx = iidx[::sampling]
-        else:
+        idxs = self._beam_grid_samples(xsky=xsky, ysky=ysky,
+                                       beam_spacing=beam_spacing)[0]
+        if idxs.size == pvals.size:
             print("Pixels appear to be close to spatially independent.")
+        idxs = idxs[np.argsort(pvals[idxs])]
+        return (rvals[idxs], pvals[idxs], dvals[idxs], xsky[idxs],
+                ysky[idxs], jidx[idxs], iidx[idxs])
+
+    def _beam_grid_samples(self, xsky, ysky, beam_spacing, ndraws=1):
+        """
+        Draw sets of roughly spatially independent pixels. For each draw the
+        sky is divided into a randomly offset grid of square cells with sides
+        of ``beam_spacing * bmaj`` and a single random pixel is selected from
+        each cell. All draws are made at once such that the cost does not
+        scale with the number of draws.
+
+        Args:
+            xsky (ndarray): On-sky x-offset in [arcsec] of each pixel.
+            ysky (ndarray): On-sky y-offset in [arcsec] of each pixel.
+            beam_spacing (float): Size of the grid cells in units of the beam
+                major axis.
+            ndraws (Optional[int]): Number of independent draws.
+
+        Returns:
+            idxs (list): A list of ``ndraws`` arrays of the indices of the
+                selected pixels.
+        """
+        npix, ndraws = xsky.size, int(ndraws)
+        spacing = float(beam_spacing) * self.bmaj
+        if spacing <= abs(self.dpix) or npix == 0:
+            return [np.arange(npix) for _ in range(ndraws)]
+
+        # Label each pixel with the cell it falls in for each draw. Labels
+        # are unique across draws such that they can be sorted together.
+
+        offsets = np.random.rand(ndraws, 2) * spacing
+        xidx = (xsky[None, :] - xsky.min() + offsets[:, :1]) / spacing
+        yidx = (ysky[None, :] - ysky.min() + offsets[:, 1:]) / spacing
+        xidx, yidx = xidx.astype(int), yidx.astype(int)
+        cells = np.arange(ndraws)[:, None] * (yidx.max() + 1) + yidx
+        cells = (cells * (xidx.max() + 1) + xidx).ravel()
+
+        # Randomly order the pixels within each cell and take the first. The
+        # random values are added to the integer labels such that a single
+        # sort, much faster than `np.lexsort`, is needed.
+
+        order = np.argsort(cells + np.random.rand(cells.size))
+        first = order[np.append(True, np.diff(cells[order]) != 0)]
+        counts = np.bincount(first // npix, minlength=ndraws)
+        return np.split(first % npix, np.cumsum(counts)[:-1])
 
-        return rvals, pvals, dvals, xsky, ysky, jidx, iidx
-    
     def velocity_to_restframe_frequency(self, velax=None, vlsr=0.0):
         """Return restframe frequency [Hz] of the given velocity [m/s]."""
         velax = self.velax if velax is None else np.squeeze(velax)
@@ -1438,6 +1825,7 @@ class datacube(object):
 
     @staticmethod
     def cmap():
+        import matplotlib.pyplot as plt
         import matplotlib.colors as mcolors
         c2 = plt.cm.Reds(np.linspace(0, 1, 16))
         c1 = plt.cm.Blues_r(np.linspace(0, 1, 16))
@@ -1475,6 +1863,7 @@ class datacube(object):
 
     def _gentrify_plot(self, ax):
         """Gentrify the plot with a grid, label axes and a beam."""
+        from matplotlib.ticker import MaxNLocator, MultipleLocator
         ax.set_aspect(1)
         ax.grid(ls='--', color='k', alpha=0.2, lw=0.5)
         ax.tick_params(which='both', right=True, top=True)
@@ -1505,6 +1894,7 @@ class datacube(object):
             fig (matplotlib figure): If ``return_fig=True``, will return the
                 figure for continued plotting.
         """
+        import matplotlib.pyplot as plt
 
         # Dummy axis to overplot.
 
@@ -1580,6 +1970,7 @@ class datacube(object):
         Returns:
             ax (AxesSubplot): Axis with the contours overplotted.
         """
+        import matplotlib.pyplot as plt
 
         # Dummy axis to overplot.
 
@@ -1598,6 +1989,10 @@ class datacube(object):
                                                z_func=z_func,
                                                w_func=w_func,
                                                shadowed=shadowed)
+        rvals = self.rasterize(rvals)
+        tvals = self.rasterize(tvals)
+        zvals = self.rasterize(zvals)
+        mask = self.rasterize(mask, fill_value=0.0)
 
         # Mask the data based on r_max.
 
@@ -1676,6 +2071,8 @@ class datacube(object):
             PA (Optional[float]): Disk position angle in [deg].
             r_max (Optional[float]): Radius to integrate out to in [arcsec].
         """
+        import matplotlib.pyplot as plt
+        from matplotlib.ticker import MultipleLocator
         if ax is None:
             fig, ax = plt.subplots()
         else:
@@ -1,6 +1,3 @@
-from mpl_toolkits.axes_grid1.axes_divider import make_axes_locatable
-from scipy.optimize import curve_fit
-import matplotlib.pyplot as plt
 import numpy as np
 
 
@@ -25,6 +22,125 @@ def random_p0(p0, scatter, nwalkers):
     return np.where(p0[None, :] == 0.0, dp0 - 1.0, dp0)
 
 
+# -- CHECKPOINTING FUNCTIONS -- #
+
+def load_checkpoint(path):
+    """
+    Load the state of a checkpoint directory.
+
+    Args:
+        path (str): Path to the checkpoint directory.
+
+    Returns:
+        state (dict/None): Dictionary of the saved values, including the
+            ``'level'`` (iteration index), ``'step'`` (number of steps taken
+            in that iteration) and ``'walkers'`` (current walker positions).
+            ``None`` if no checkpoint is found.
+    """
+    import os
+    filename = os.path.join(path, 'state.npz')
+    if not os.path.exists(filename):
+        return None
+    with np.load(filename) as state:
+        return {k: state[k] for k in state.files}
+
+
+def save_checkpoint(path, **state):
+    """
+    Save the values in ``state`` to the checkpoint directory. The file is
+    written to a temporary file first so a job killed while writing will not
+    corrupt the previous checkpoint.
+
+    Args:
+        path (str): Path to the checkpoint directory.
+    """
+    import os
+    os.makedirs(path, exist_ok=True)
+    temp = os.path.join(path, 'state_temp.npz')
+    np.savez(temp, **state)
+    os.replace(temp, os.path.join(path, 'state.npz'))
+
+
+def clear_checkpoint(path):
+    """Remove any previous checkpoint state and chains from ``path``."""
+    import os
+    import glob
+    for filename in glob.glob(os.path.join(path, 'chain_*.npz')):
+        os.remove(filename)
+    if os.path.exists(os.path.join(path, 'state.npz')):
+        os.remove(os.path.join(path, 'state.npz'))
+
+
+def run_checkpointed(sampler, p0, nsteps, path, level=0, start=0, every=100,
+                     progress=True, state=None, **kwargs):
+    """
+    Run an ``emcee`` or ``zeus`` ``EnsembleSampler`` in chunks of ``every``
+    steps. After each chunk the chain and log-probabilities are written to
+    ``path``, the checkpoint state is updated and the sampler is reset, such
+    that the memory used does not grow with the number of steps.
+
+    Args:
+        sampler (EnsembleSampler): The sampler to run.
+        p0 (ndarray): Starting positions of the walkers, (nwalkers, ndim).
+        nsteps (int): Total number of steps for this iteration.
+        path (str): Path to the checkpoint directory.
+        level (Optional[int]): Index of the iteration.
+        start (Optional[int]): Number of steps already taken, if resuming.
+        every (Optional[int]): Number of steps between checkpoints.
+        progress (Optional[bool]): Show the progress bar.
+        state (Optional[dict]): Additional values to save with the state,
+            e.g., masks or the starting parameters.
+
+    Returns:
+        p0 (ndarray): Final positions of the walkers.
+    """
+    import os
+    state = {} if state is None else state
+    step = int(start)
+    save_checkpoint(path, level=level, step=step, walkers=p0, **state)
+    while step < nsteps:
+        nchunk = int(min(every, nsteps - step))
+        sampler.run_mcmc(p0, nchunk, progress=progress, **kwargs)
+        chain, lnprob = sampler.get_chain(), sampler.get_log_prob()
+        filename = 'chain_{:d}_{:08d}.npz'.format(level, step)
+        np.savez(os.path.join(path, filename), chain=chain, lnprob=lnprob)
+        p0, step = chain[-1], step + nchunk
+        save_checkpoint(path, level=level, step=step, walkers=p0, **state)
+        sampler.reset()
+    return p0
+
+
+def load_checkpoint_chain(path, level=0, nsteps=None):
+    """
+    Load the chain written by :func:`run_checkpointed`.
+
+    Args:
+        path (str): Path to the checkpoint directory.
+        level (Optional[int]): Index of the iteration to load.
+        nsteps (Optional[int]): Only load chunks starting before this step,
+            e.g., the step in the saved state.
+
+    Returns:
+        chain, lnprob (ndarray, ndarray): The chain with shape (nsteps,
+            nwalkers, ndim) and log-probabilities with shape (nsteps,
+            nwalkers).
+    """
+    import os
+    import glob
+    filenames = glob.glob(os.path.join(path, 'chain_{:d}_*.npz'.format(level)))
+    chain, lnprob = [], []
+    for filename in sorted(filenames):
+        step = int(filename[-12:-4])
+        if nsteps is not None and step >= nsteps:
+            continue
+        with np.load(filename) as chunk:
+            chain += [chunk['chain']]
+            lnprob += [chunk['lnprob']]
+    if not len(chain):
+        raise ValueError("No chains found for level {:d}.".format(level))
+    return np.concatenate(chain), np.concatenate(lnprob)
+
+
 def _errors(x, dy, return_uncertainty):
     """
     Parse the inputs related to errors for use with scipy.optimize.curve_fit.
@@ -64,6 +180,7 @@ def fit_gaussian(x, y, dy=None, return_uncertainty=None):
         popt (array)[, cvar(array)]: The best fit parameters and, optionally,
         the uncertainty on those parameters.
     """
+    from scipy.optimize import curve_fit
     dy, return_uncertainty, absolute_sigma = _errors(x, dy, return_uncertainty)
     p0 = get_p0_gaussian(x, y)
     try:
@@ -77,6 +194,95 @@ def fit_gaussian(x, y, dy=None, return_uncertainty=None):
     return (popt, cvar) if return_uncertainty else popt
 
 
+def fit_gaussian_batch(x, y, mask=None, niter=100):
+    """
+    Fit a Gaussian form to a batch of spectra at once with a vectorized
+    Levenberg-Marquardt optimization. This is equivalent to calling
+    :func:`fit_gaussian` on each spectrum without uncertainties, but with a
+    single set of array operations for the whole batch.
+
+    Args:
+        x (array): Dependent coordinates, either shape ``(nbatch, npnts)`` or
+            ``(npnts,)`` if shared by all spectra.
+        y (array): Data coordinates with shape ``(nbatch, npnts)``.
+        mask (Optional[array]): Boolean array with the same shape as ``y``
+            of the points to include in each fit, or the non-negative weight
+            of each point in the sum of squared residuals.
+        niter (Optional[int]): Maximum number of iterations.
+
+    Returns:
+        popt (array): A ``(nbatch, 3)`` shaped array of the best fit
+        ``(x0, dV, Tb)`` for each spectrum. Failed fits are NaNs.
+    """
+    y = np.atleast_2d(y)
+    x = np.broadcast_to(x, y.shape)
+    w = np.ones(y.shape) if mask is None else np.asarray(mask, dtype=float)
+    mask = (w > 0.0) & np.isfinite(y)
+    w = np.where(mask, np.sqrt(w), 0.0)
+    y = np.where(mask, y, 0.0)
+    x = np.where(mask, x, 0.0)
+
+    # Starting positions as in get_p0_gaussian, integrating over the
+    # included points once they are ordered in x.
+
+    peak = np.argmax(np.where(mask, y, -np.inf), axis=1)[:, None]
+    Tb = np.take_along_axis(y, peak, axis=1)[:, 0]
+    x0 = np.take_along_axis(x, peak, axis=1)[:, 0]
+    idxs = np.argsort(np.where(mask, x, np.inf), axis=1)
+    xs = np.take_along_axis(x, idxs, axis=1)
+    ys = np.take_along_axis(y, idxs, axis=1)
+    pair = np.take_along_axis(mask, idxs, axis=1)
+    pair = pair[:, 1:] & pair[:, :-1]
+    area = np.where(pair, 0.5 * np.diff(xs) * (ys[:, 1:] + ys[:, :-1]), 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dV = np.sum(area, axis=1) / Tb / np.sqrt(2.0 * np.pi)
+    popt = np.stack([x0, dV, Tb], axis=1)
+    failed = (mask.sum(axis=1) < 3) | ~np.all(np.isfinite(popt), axis=1)
+    popt[failed] = [0.0, 1.0, 0.0]
+
+    def residuals(popt):
+        u = (x - popt[:, 0, None]) / popt[:, 1, None]
+        e = np.exp(-u**2)
+        return w * (y - popt[:, 2, None] * e), u, e
+
+    # Iterate, accepting only the steps which reduce the chi-squared. A fit
+    # has converged once an accepted step barely improves the chi-squared,
+    # or no step is accepted even with a heavily damped step.
+
+    lam = np.full(y.shape[0], 1e-3)
+    done = np.zeros(y.shape[0], dtype=bool)
+    eye = np.eye(3)[None]
+    with np.errstate(all='ignore'):
+        r, u, e = residuals(popt)
+        chi2 = np.sum(r**2, axis=1)
+        for _ in range(int(niter)):
+            dm = popt[:, 2, None] * e * 2.0 * u / popt[:, 1, None]
+            jac = w[..., None] * np.stack([dm, dm * u, e], axis=-1)
+            JTJ = np.einsum('kpi,kpj->kij', jac, jac)
+            JTr = np.einsum('kpi,kp->ki', jac, r)
+            A = JTJ + lam[:, None, None] * JTJ * eye
+            bad = ~np.all(np.isfinite(A), axis=(1, 2))
+            bad |= np.linalg.det(A) == 0.0
+            A[bad], JTr[bad] = eye, 0.0
+            trial = popt + np.linalg.solve(A, JTr[..., None])[..., 0]
+            r_new, u_new, e_new = residuals(trial)
+            chi2_new = np.sum(r_new**2, axis=1)
+            better = chi2_new < chi2
+            done |= better & (chi2 - chi2_new <= 1e-10 * chi2)
+            popt = np.where(better[:, None], trial, popt)
+            r = np.where(better[:, None], r_new, r)
+            u = np.where(better[:, None], u_new, u)
+            e = np.where(better[:, None], e_new, e)
+            chi2 = np.where(better, chi2_new, chi2)
+            lam = np.where(better, lam / 10.0, lam * 10.0)
+            done |= lam > 1e10
+            if np.all(done):
+                break
+    failed |= ~np.all(np.isfinite(popt), axis=1)
+    popt[failed] = np.nan
+    return popt
+
+
 def fit_gaussian_thick(x, y, dy=None, return_uncertainty=None):
     """
     Fit an optically thick Gaussian function to (x, y[, dy]).
@@ -91,6 +297,7 @@ def fit_gaussian_thick(x, y, dy=None, return_uncertainty=None):
         popt (array)[, cvar(array)]: The best fit parameters and, optionally,
         the uncertainty on those parameters.
     """
+    from scipy.optimize import curve_fit
     dy, return_uncertainty, absolute_sigma = _errors(x, dy, return_uncertainty)
     p0 = fit_gaussian(x=x, y=y, dy=dy,
                       return_uncertainty=False)
@@ -121,6 +328,7 @@ def fit_double_gaussian(x, y, dy=None, return_uncertainty=None):
         popt (array)[, cvar(array)]: The best fit parameters and, optionally,
         the uncertainty on those parameters.
     """
+    from scipy.optimize import curve_fit
 
     # Defaults.
 
@@ -172,6 +380,7 @@ def fit_double_gaussian_fixeddV(x, y, dy=None, return_uncertainty=None):
         popt (array)[, cvar(array)]: The best fit parameters and, optionally,
         the uncertainty on those parameters.
     """
+    from scipy.optimize import curve_fit
 
     # Defaults.
 
@@ -351,6 +560,148 @@ def get_p0_gaussian(x, y):
     return x0, dV, Tb
 
 
+# -- STREAMING STATISTICS -- #
+
+class running_statistics(object):
+    """
+    Accumulate the element-wise mean and variance, and optionally a single
+    quantile, of a stream of equally shaped arrays without storing them. The
+    arrays are passed in batches with shape ``(nbatch, ...)``. The mean and
+    variance are merged exactly for each batch, while the quantile is
+    estimated with the P-squared algorithm of `Jain & Chlamtac (1985)`_, which
+    tracks five markers per element and is updated for a whole batch at once
+    rather than for each array in turn. As with the Numpy functions, any
+    element which is ever NaN will be NaN in the returned statistics.
+
+    .. _Jain & Chlamtac (1985): https://doi.org/10.1145/4372.4378
+
+    Args:
+        quantile (Optional[float]): Quantile, between 0 and 1, to estimate.
+    """
+
+    def __init__(self, quantile=None):
+        if quantile is not None and not 0.0 < quantile < 1.0:
+            raise ValueError("`quantile` must be between 0 and 1.")
+        self.p = quantile
+        self.count = 0
+        self._mean = None
+        self._M2 = None
+        self._nan = None
+        self._init = []
+        self._q = None
+
+    def update(self, batch):
+        """Add a batch of arrays, stacked along the first axis."""
+        batch = np.asarray(batch, dtype=float)
+        if self._mean is None:
+            self._mean = np.zeros(batch.shape[1:])
+            self._M2 = np.zeros(batch.shape[1:])
+            self._nan = np.zeros(batch.shape[1:], dtype=bool)
+        self._nan |= np.any(np.isnan(batch), axis=0)
+        batch = np.where(np.isnan(batch), 0.0, batch)
+
+        # Merge the batch mean and variance with the running values.
+
+        nbatch = batch.shape[0]
+        mean = np.mean(batch, axis=0)
+        M2 = np.sum((batch - mean[None])**2, axis=0)
+        delta = mean - self._mean
+        total = self.count + nbatch
+        self._mean += delta * nbatch / total
+        self._M2 += M2 + delta**2 * self.count * nbatch / total
+
+        # Update the quantile markers. As the markers are held fixed while
+        # the values are counted, large batches are split into chunks no
+        # larger than the number of values already seen.
+
+        if self.p is not None:
+            x, seen = batch.reshape(nbatch, -1), self.count
+            while x.shape[0] > 0:
+                size = x.shape[0] if self._q is None else seen
+                self._update_quantile(x[:size])
+                x, seen = x[size:], seen + size
+        self.count = total
+
+    def _update_quantile(self, batch):
+        """P-squared update of the markers for a batch of flattened arrays."""
+
+        # Use the values from the first update, of at least five values, to
+        # initialize the markers at the order statistics nearest to their
+        # desired positions.
+
+        if self._q is None:
+            self._init += list(batch)
+            if len(self._init) < 5:
+                return
+            m = len(self._init)
+            self._dnd = np.array([0, self.p / 2, self.p,
+                                  (1 + self.p) / 2, 1])
+            self._nd = (m - 1) * self._dnd
+            idx = np.arange(5) + np.round((m - 5) * self._dnd).astype(int)
+            self._q = np.sort(self._init, axis=0)[idx]
+            self._n = idx[:, None] * np.ones(self._q.shape[1])
+            self._init = []
+            return
+
+        # Update the extreme markers and count the values below each of the
+        # central markers, which are held fixed for the batch.
+
+        q, n, nbatch = self._q, self._n, batch.shape[0]
+        q[0] = np.minimum(q[0], batch.min(axis=0))
+        q[4] = np.maximum(q[4], batch.max(axis=0))
+        for i in range(1, 4):
+            n[i] += np.sum(batch < q[i][None, :], axis=0)
+        n[4] += nbatch
+        self._nd = self._nd + nbatch * self._dnd
+
+        # Move the three central markers towards their desired positions,
+        # keeping them between their neighbours, with a parabolic prediction,
+        # falling back to a linear prediction if out of order.
+
+        for i in range(1, 4):
+            d = np.clip(np.trunc(self._nd[i] - n[i]),
+                        n[i-1] - n[i] + 1, n[i+1] - n[i] - 1)
+            move = d != 0
+            if not np.any(move):
+                continue
+            d = d[move]
+            qm, qi, qp = q[i-1, move], q[i, move], q[i+1, move]
+            nm, ni, np_ = n[i-1, move], n[i, move], n[i+1, move]
+            qpar = (ni - nm + d) * (qp - qi) / (np_ - ni)
+            qpar = qpar + (np_ - ni - d) * (qi - qm) / (ni - nm)
+            qpar = qi + d / (np_ - nm) * qpar
+            qlin = qi + d * np.where(d > 0, (qp - qi) / (np_ - ni),
+                                     (qm - qi) / (nm - ni))
+            q[i, move] = np.where((qm < qpar) & (qpar < qp), qpar, qlin)
+            n[i, move] += d
+
+    @property
+    def mean(self):
+        return np.where(self._nan, np.nan, self._mean)
+
+    @property
+    def var(self):
+        return np.where(self._nan, np.nan, self._M2 / self.count)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    @property
+    def quantile(self):
+        if self.p is None:
+            raise ValueError("No quantile was specified.")
+        if self._q is None:
+            q = np.quantile(self._init, self.p, axis=0)
+        else:
+            q = self._q[2]
+        return np.where(self._nan, np.nan, q.reshape(self._mean.shape))
+
+    @property
+    def median(self):
+        return self.quantile
+
+
 # -- MODEL FUNCTIONS --#
 
 def gaussian(x, x0, dV, Tb):
@@ -411,6 +762,8 @@ def plot_walkers(samples, nburnin=None, labels=None, histogram=True):
         samples (ndarray):
         nburnin (Optional[int])
     """
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.axes_grid1.axes_divider import make_axes_locatable
 
     # Check the length of the label list.
 
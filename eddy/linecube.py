@@ -33,7 +33,8 @@ class linecube(datacube):
             w_t=None, z_func=None, shadowed=False, phi_min=None, phi_max=None,
             exclude_phi=False, abs_phi=False, mask_frame='disk', user_mask=None,
             beam_spacing=True, niter=1, get_vlos_kwargs=None,
-            weighted_average=True, return_samples=False, repeat_with_mask=0):
+            weighted_average=True, return_samples=False, repeat_with_mask=0,
+            crop_velax=None, crop_width=1e3):
         """
         Returns the rotational and, optionally, radial velocity profiles under
         the assumption that the disk is azimuthally symmetric (at least across
@@ -107,7 +108,7 @@ class linecube(datacube):
             user_mask (Optional[array]): A user-specified mask to include. Must
                 have the same shape as ``self.data``.
             beam_spacing (int): Sample pixels separated by roughly
-            `beam_spacing * bmaj` in azimuthal distance.
+            `beam_spacing * bmaj` on the sky.
             niter (Optional[int]): Number of iterations to run.
             get_vlos_kwargs=None,
             weighted_average (Optional[bool]): Whether to combine multiple
@@ -117,6 +118,17 @@ class linecube(datacube):
             return_samples (Optional[bool]): Whether to return the samples
                 instead of combining them.
             repeat_with_mask (Optional[int]):
+            crop_velax (Optional[callable/str]): Crop the velocity axis of each
+                annulus to the window where the line is expected. Either a
+                function returning a model rotation velocity in [m/s] for a
+                radius in [arcsec], or ``'previous'`` to use the rotation
+                velocity of the previous annulus. The window spans the
+                projected rotation velocity plus ``crop_width`` either side of
+                the systemic velocity, taken from ``fix_vlsr`` or otherwise
+                estimated from the intensity-weighted velocity of the cube.
+            crop_width (Optional[float]): Additional half-width of the velocity
+                window in [m/s]. This must be wide enough to include the line
+                wings and some line-free channels to estimate the noise.
 
         Returns:
             samples (array): If ``return_samples=True``. The array of ``niter``
@@ -158,41 +170,45 @@ class linecube(datacube):
                                           user_mask=user_mask,
                                           beam_spacing=beam_spacing,
                                           get_vlos_kwargs=get_vlos_kwargs,
-                                          repeat_with_mask=repeat_with_mask)
+                                          repeat_with_mask=repeat_with_mask,
+                                          crop_velax=crop_velax,
+                                          crop_width=crop_width)
 
         # Multiple iterations.
 
         if beam_spacing is False:
             raise ValueError("niter must equal 1 when beam_spacing=False.")
 
-        samples = [self._velocity_profile(rbins=rbins,
-                                          fit_method=fit_method,
-                                          fit_vrad=fit_vrad,
-                                          fix_vlsr=fix_vlsr,
-                                          x0=x0,
-                                          y0=y0,
-                                          inc=inc,
-                                          PA=PA,
-                                          z0=z0,
-                                          psi=psi,
-                                          r_cavity=r_cavity,
-                                          r_taper=r_taper,
-                                          q_taper=q_taper,
-                                          w_i=w_i,
-                                          w_r=w_r,
-                                          w_t=w_t,
-                                          z_func=z_func,
-                                          shadowed=shadowed,
-                                          phi_min=phi_min,
-                                          phi_max=phi_max,
-                                          exclude_phi=exclude_phi,
-                                          abs_phi=abs_phi,
-                                          mask_frame=mask_frame,
-                                          user_mask=user_mask,
-                                          beam_spacing=beam_spacing,
-                                          get_vlos_kwargs=get_vlos_kwargs,
-                                          repeat_with_mask=repeat_with_mask)
-                   for _ in range(niter)]
+        samples = self._velocity_profile(rbins=rbins,
+                                         fit_method=fit_method,
+                                         fit_vrad=fit_vrad,
+                                         fix_vlsr=fix_vlsr,
+                                         x0=x0,
+                                         y0=y0,
+                                         inc=inc,
+                                         PA=PA,
+                                         z0=z0,
+                                         psi=psi,
+                                         r_cavity=r_cavity,
+                                         r_taper=r_taper,
+                                         q_taper=q_taper,
+                                         w_i=w_i,
+                                         w_r=w_r,
+                                         w_t=w_t,
+                                         z_func=z_func,
+                                         shadowed=shadowed,
+                                         phi_min=phi_min,
+                                         phi_max=phi_max,
+                                         exclude_phi=exclude_phi,
+                                         abs_phi=abs_phi,
+                                         mask_frame=mask_frame,
+                                         user_mask=user_mask,
+                                         beam_spacing=beam_spacing,
+                                         get_vlos_kwargs=get_vlos_kwargs,
+                                         repeat_with_mask=repeat_with_mask,
+                                         ndraws=niter,
+                                         crop_velax=crop_velax,
+                                         crop_width=crop_width)
 
         # Just return the samples if requested.
 
@@ -237,9 +253,13 @@ class linecube(datacube):
             w_t=None, z_func=None, shadowed=False, phi_min=None, phi_max=None,
             exclude_phi=False, abs_phi=False, mask_frame='disk',
             user_mask=None, beam_spacing=True, get_vlos_kwargs=None,
-            repeat_with_mask=0):
+            repeat_with_mask=0, ndraws=None, crop_velax=None, crop_width=1e3):
         """
-        Returns the velocity (rotational and radial) profiles.
+        Returns the velocity (rotational and radial) profiles. If ``ndraws``
+        is given, a list of ``ndraws`` profiles is returned, each using an
+        independent draw of the pixels in each annulus. With ``crop_velax``
+        the spectra of each annulus are cropped to the velocity window where
+        the line is expected, see :func:`get_velocity_profile`.
 
         Args:
             TBD
@@ -262,12 +282,34 @@ class linecube(datacube):
         kw['fit_method'] = fit_method
         kw['repeat_with_mask'] = repeat_with_mask
 
+        # Systemic velocity used to center the cropped velocity axes.
+
+        if crop_velax is not None:
+            if not callable(crop_velax) and crop_velax != 'previous':
+                raise ValueError("`crop_velax` must be callable or "
+                                 + "'previous'.")
+            vlsr = self._estimate_vlsr() if fix_vlsr is None else fix_vlsr
+        vrot = None
+
         # Cycle through the annuli.
 
-        profiles = []
-        uncertainties = []
+        nsamples = 1 if ndraws is None else int(ndraws)
+        profiles = [[] for _ in range(nsamples)]
+        uncertainties = [[] for _ in range(nsamples)]
         for r_min, r_max in zip(rbins[:-1], rbins[1:]):
-            annulus = self.get_annulus(r_min=r_min,
+
+            # Velocity window expected for the annulus.
+
+            if callable(crop_velax):
+                vrot = max(abs(crop_velax(r_min)), abs(crop_velax(r_max)))
+            if crop_velax is not None and vrot is not None and \
+                    np.isfinite(vrot):
+                dv = abs(vrot * np.sin(np.radians(inc))) + crop_width
+                velocity_window = (vlsr - dv, vlsr + dv)
+            else:
+                velocity_window = None
+
+            annuli = self.get_annulus(r_min=r_min,
                                        r_max=r_max,
                                        phi_min=phi_min,
                                        phi_max=phi_max,
@@ -289,20 +331,34 @@ class linecube(datacube):
                                        shadowed=shadowed,
                                        mask_frame=mask_frame,
                                        user_mask=user_mask,
-                                       beam_spacing=beam_spacing)
-
-            output = annulus.get_vlos(**kw)
-            profiles += [output[0]]
-            uncertainties += [output[1]]
+                                       beam_spacing=beam_spacing,
+                                       ndraws=ndraws,
+                                       velocity_window=velocity_window)
+            annuli = [annuli] if ndraws is None else annuli
+
+            for i, ann in enumerate(annuli):
+                output = ann.get_vlos(**kw)
+                profiles[i] += [output[0]]
+                uncertainties[i] += [output[1]]
+            if crop_velax == 'previous':
+                vrot = profiles[0][-1][0]
 
         # Make sure the returned arrays are in the (nparam, nrad) form.
 
-        profiles = np.atleast_2d(profiles).T
-        uncertainties = np.atleast_2d(uncertainties).T
-        assert profiles.shape[0] == uncertainties.shape[0] == 3
-        assert profiles.shape[1] == uncertainties.shape[1] == rpnts.size
+        samples = []
+        for profile, uncertainty in zip(profiles, uncertainties):
+            profile = np.atleast_2d(profile).T
+            uncertainty = np.atleast_2d(uncertainty).T
+            assert profile.shape[0] == uncertainty.shape[0] == 3
+            assert profile.shape[1] == uncertainty.shape[1] == rpnts.size
+            samples += [(rpnts, profile, uncertainty)]
+
+        return samples[0] if ndraws is None else samples
 
-        return rpnts, profiles, uncertainties
+    def _estimate_vlsr(self):
+        """Intensity-weighted velocity of the spatially integrated cube."""
+        spectrum = np.clip(np.nansum(self.data, axis=(1, 2)), 0.0, None)
+        return np.sum(spectrum * self.velax) / np.sum(spectrum)
 
     # -- ANNULUS FUNCTIONS -- #
 
@@ -311,9 +367,13 @@ class linecube(datacube):
             z0=0.0, psi=1.0, r_cavity=0.0, r_taper=np.inf, q_taper=1.0,
             w_i=None, w_r=None, w_t=None, z_func=None, shadowed=False,
             mask_frame='disk', user_mask=None, beam_spacing=True,
-            annulus_kwargs=None):
+            annulus_kwargs=None, ndraws=None, bin_width=None,
+            velocity_window=None):
         """
-        Returns an annulus instance.
+        Returns an annulus instance. If ``ndraws`` is specified, a list of
+        ``ndraws`` annulus instances is returned, each with an independent
+        draw of pixels spaced by ``beam_spacing``. The annulus is only
+        extracted once, so this is much quicker than repeated calls.
 
         Args:
             r_min (float): Inner radius of the annulus in [arcsec].
@@ -346,6 +406,20 @@ class linecube(datacube):
             w_i: [coming soon]
             w_r: [coming soon]
             w_t: [coming soon]
+            beam_spacing (Optional[float]): Sample pixels separated by roughly
+                ``beam_spacing * bmaj`` on the sky.
+            annulus_kwargs (Optional[dict]): Kwargs to pass to ``annulus``.
+            ndraws (Optional[int]): Number of independent draws of pixels.
+            bin_width (Optional[float]): Average the spectra in azimuthal bins
+                of this width in [deg], propagating the noise. As neighbouring
+                spectra are averaged, this is best used with
+                ``beam_spacing=False``, in which case the noise of each bin
+                accounts for the number of beams it covers. See
+                :class:`annulus` for details.
+            velocity_window (Optional[tuple]): Minimum and maximum velocity in
+                [m/s] of the channels to include in the spectra. The RMS of
+                the spectra is still estimated from the edge channels of the
+                full velocity axis and passed to :class:`annulus`.
 
         """
 
@@ -379,10 +453,24 @@ class linecube(datacube):
 
         # Flatten the data and get the deprojected pixel coordinates.
         # We will record the on-sky pixels, their deprojected disk-frame polar
-        # coordinates and the array indices.
-
-        dvals = self.data.copy().reshape(self.data.shape[0], -1)
-        dvals = dvals[:, mask].T
+        # coordinates and the array indices. The data is kept as a flattened
+        # view of the cube and the spectra are only gathered once the final
+        # pixels are known, with ``dvals`` holding the flattened pixel index.
+
+        # Only the channels within the velocity window are extracted.
+
+        if velocity_window is not None:
+            chans = np.flatnonzero((self.velax >= min(velocity_window)) &
+                                   (self.velax <= max(velocity_window)))
+            if chans.size < 3:
+                raise ValueError("Fewer than 3 channels in `velocity_window`.")
+            chans = slice(chans[0], chans[-1] + 1)
+        else:
+            chans = slice(None)
+        velax = self.velax[chans]
+        full = self.data.reshape(self.velax.size, -1)
+        cube = full[chans]
+        dvals = np.flatnonzero(mask)
 
         rvals, pvals = self.disk_coords(x0=x0,
                                         y0=y0,
@@ -414,22 +502,59 @@ class linecube(datacube):
 
         # Thin down to spatially independent pixels.
 
-        thinned = self._independent_samples(beam_spacing=beam_spacing,
-                                            rvals=rvals,
-                                            pvals=pvals,
-                                            dvals=dvals,
-                                            xsky=xsky,
-                                            ysky=ysky,
-                                            jidx=jidx,
-                                            iidx=iidx)
-        rvals, pvals, dvals, xsky, ysky, jidx, iidx = thinned
-
-        # Return the annulus instance.
-
         annulus_kwargs = {} if annulus_kwargs is None else annulus_kwargs
-        return annulus(spectra=dvals, pvals=pvals, velax=self.velax, inc=inc,
-                       rvals=rvals, xsky=xsky, ysky=ysky, jidx=jidx, iidx=iidx,
-                       **annulus_kwargs)
+        if bin_width is not None:
+            annulus_kwargs = dict(annulus_kwargs, bin_width=bin_width)
+            if not beam_spacing:
+                annulus_kwargs.setdefault('pix_per_beam', self.pix_per_beam)
+        if ndraws is None:
+            thinned = self._independent_samples(beam_spacing=beam_spacing,
+                                                rvals=rvals,
+                                                pvals=pvals,
+                                                dvals=dvals,
+                                                xsky=xsky,
+                                                ysky=ysky,
+                                                jidx=jidx,
+                                                iidx=iidx)
+            rvals, pvals, dvals, xsky, ysky, jidx, iidx = thinned
+            idx = np.argsort(pvals)
+            if velocity_window is not None:
+                annulus_kwargs = dict(annulus_kwargs,
+                                      rms=self._edge_rms(full, dvals))
+            return annulus(spectra=cube[:, dvals[idx]].T, pvals=pvals[idx],
+                           velax=velax, inc=inc, rvals=rvals[idx],
+                           xsky=xsky[idx], ysky=ysky[idx], jidx=jidx[idx],
+                           iidx=iidx[idx], **annulus_kwargs)
+
+        # Make all the draws at once and return a list of annulus instances.
+
+        if beam_spacing:
+            idxs = self._beam_grid_samples(xsky=xsky, ysky=ysky,
+                                           beam_spacing=beam_spacing,
+                                           ndraws=ndraws)
+        else:
+            idxs = [np.arange(pvals.size) for _ in range(int(ndraws))]
+        annuli = []
+        for idx in idxs:
+            idx = idx[np.argsort(pvals[idx])]
+            if velocity_window is not None:
+                annulus_kwargs = dict(annulus_kwargs,
+                                      rms=self._edge_rms(full, dvals[idx]))
+            annuli += [annulus(spectra=cube[:, dvals[idx]].T,
+                               pvals=pvals[idx], velax=velax, inc=inc,
+                               rvals=rvals[idx], xsky=xsky[idx],
+                               ysky=ysky[idx], jidx=jidx[idx],
+                               iidx=iidx[idx], **annulus_kwargs)]
+        return annuli
+
+    @staticmethod
+    def _edge_rms(data, dvals, N=15):
+        """
+        RMS of the first and last ``N`` channels of the flattened pixels
+        ``dvals`` of ``data``, shaped ``(nchan, npix)``, matching
+        :func:`annulus._estimate_RMS` for the uncropped spectra.
+        """
+        return np.nanstd([data[:N, dvals], data[-N:, dvals]])
 
     # -- PLOTTING FUNCTIONS -- #
 
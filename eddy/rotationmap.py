@@ -1,19 +1,34 @@
 # -*- coding: utf-8 -*-
 
 import time
-import yaml
-import zeus
-import emcee
+import copy
+import functools
 import numpy as np
 import scipy.constants as sc
 from .datacube import datacube
 from .helper_functions import plot_walkers, plot_corner, random_p0
-import matplotlib.pyplot as plt
+from .helper_functions import load_checkpoint, clear_checkpoint
+from .helper_functions import run_checkpointed, running_statistics
+from .helper_functions import load_checkpoint_chain
 import warnings
 
 warnings.filterwarnings("ignore")
 
 
+@functools.lru_cache(maxsize=None)
+def _read_default_parameters(path):
+    """Read and parse the default parameter table once per process."""
+    import yaml
+    with open(path) as stream:
+        parameters = yaml.safe_load(stream)
+    for p in parameters.keys():
+        if parameters[p]['prior_type'] is not None:
+            values = parameters[p]['prior_values']
+            if len(values) == 1:
+                parameters[p]['prior_values'] = [-values[0], values[0]]
+    return parameters
+
+
 class rotationmap(datacube):
     """
     Read in the velocity maps and initialize the class. To make the fitting
@@ -39,14 +54,21 @@ class rotationmap(datacube):
         force_center (Optional[bool]): If ``True`` define the spatial axes such
             that they describe offset from the array center in [arcsec]. This
             is useful if the FITS header does not contain axis information.
+        compact (Optional[bool]): If ``True``, only store the finite pixels of
+            the map. See :func:`compact_map` for more details.
     """
 
-    priors = {}
-    SHO_priors = {}
     _vortex_layers = 2
 
+    # Collapse functions which are reduced in batches in `evaluate_models`,
+    # and the maximum size in bytes of the draws to stack for an exact median.
+
+    _streaming_reductions = {np.mean: 'mean', np.std: 'std', np.var: 'var',
+                             np.median: 'median'}
+    collapse_max_memory = 2**30
+
     def __init__(self, path, FOV=None, uncertainty=None, downsample=None,
-                 fill=None, force_center=False):
+                 fill=None, force_center=False, compact=False):
         datacube.__init__(self, path=path, FOV=FOV, fill=fill,
                           force_center=force_center)
 
@@ -64,13 +86,26 @@ class rotationmap(datacube):
 
         if downsample is not None:
             self.downsample_cube(downsample)
+        if compact:
+            self.compact_map()
+
+        # Priors are stored per instance as (type, values) pairs so that
+        # several maps can be fit concurrently and pickled to a pool.
 
+        self.priors = {}
+        self.SHO_priors = {}
         self.default_parameters = self._load_default_parameters()
         self._set_default_priors()
 
+    def __setattr__(self, name, value):
+        if name in ('data', 'error', 'xaxis', 'yaxis'):
+            self.__dict__.pop('_full_resolution', None)
+        super().__setattr__(name, value)
+
     @property
     def vlsr(self):
-        return np.nanmedian(self.data)
+        """Median of the map in [m/s], cached until the data changes."""
+        return self._cached('vlsr', lambda: np.nanmedian(self.data))
 
     @property
     def vlsr_kms(self):
@@ -81,7 +116,9 @@ class rotationmap(datacube):
     def fit_map(self, p0, params, r_min=None, r_max=None, optimize=True,
                 nwalkers=None, nburnin=300, nsteps=100, scatter=1e-3,
                 plots=None, returns=None, pool=None, mcmc='emcee',
-                mcmc_kwargs=None, niter=1):
+                mcmc_kwargs=None, niter=1, pyramid=None, checkpoint=None,
+                resume=False, checkpoint_every=100, linear=None,
+                linear_method='marginalize', warm_start=False, search=None):
         """
         Fit a rotation profile to the data. Note that for a disk with
         a non-zero height, the sign of the inclination dictates the direction
@@ -118,13 +155,16 @@ class rotationmap(datacube):
             params (dictionary): Dictionary of the model parameters.
             r_min (optional[float]): Inner radius to fit in [arcsec].
             r_max (optional[float]): Outer radius to fit in [arcsec].
-            optimize (optional[bool]): Use ``scipy.optimize`` to find the
-                ``p0`` values which maximize the likelihood. Better results
+            optimize (optional[bool or int]): Use ``scipy.optimize`` to find
+                the ``p0`` values which maximize the likelihood. Better results
                 will likely be found. Note that for the masking the default
                 ``p0`` and ``params`` values are used for the deprojection, or
                 those foundvfrom the optimization. If this results in a poor
                 initial mask, try with ``optimise=False`` or with a ``niter``
-                value larger than 1.
+                value larger than 1. The optimization is bounded by the flat
+                priors. If an integer larger than 1, this many starting
+                positions are optimized, using ``pool`` if provided, and the
+                best is kept.
             nwalkers (optional[int]): Number of walkers to use for the MCMC.
             nburnin (optional[int]): Number of steps to discard for burn-in.
             nsteps (optional[int]): Number of steps to use to sample the
@@ -147,6 +187,53 @@ class rotationmap(datacube):
                 positions. This is probably only useful if you have no idea
                 about the starting positions for the emission surface or if you
                 want to remove walkers stuck in local minima.
+            pyramid (optional[list]): List of downsampling factors, ordered
+                from coarsest to finest, e.g., ``[4, 2, 1]``. Each level is
+                block averaged with :func:`set_resolution` and run as a
+                separate iteration, replacing ``niter``, with the walkers
+                starting from the posterior of the previous level. The
+                optimization is only run on the coarsest level. As with
+                ``niter``, ``nwalkers``, ``nburnin`` and ``nsteps`` can be
+                lists to specify the values for each level, such that the
+                final, full resolution level only needs a short run.
+            checkpoint (optional[str]): Path to a directory to write the chains
+                and the sampler state to. The chains are written every
+                ``checkpoint_every`` steps and the sampler is reset, so the
+                memory used does not grow with ``nsteps``. Note that a returned
+                ``'sampler'`` will only contain the final chunk of steps.
+            resume (optional[bool]): If ``True``, continue from the last
+                checkpoint in ``checkpoint``, skipping the optimization and any
+                completed iterations. The saved inverse variance mask is used
+                for the iteration being resumed.
+            checkpoint_every (optional[int]): Number of steps between each
+                checkpoint.
+            linear (optional[list]): Parameters, ``'vlsr'`` and/or
+                ``'vp_100'``, which enter the model linearly and are solved for
+                with weighted least squares in each likelihood call rather
+                than sampled. They must not be included in ``p0``. After
+                sampling they are drawn from their conditional posteriors and
+                appended to the samples, and their indices are added to a copy
+                of ``params``, returned with ``'params'``. Samples where the best-fit linear parameters fall
+                outside of their flat prior bounds are rejected, otherwise
+                their priors are ignored. ``'vp_100'`` is only linear for the
+                power-law rotation profile, so requires ``vp_q`` and no
+                ``mstar`` in ``params``.
+            linear_method (optional[str]): Either ``'marginalize'``, to
+                marginalize the likelihood over the linear parameters, or
+                ``'profile'``, to use their best-fit values.
+            warm_start (optional[bool/float]): If ``True``, or a float between
+                0 and 1, each iteration after the first starts from the final
+                walkers of the previous iteration, rather than new walkers
+                scattered about the median. If the number of walkers changes,
+                a subset of the final walkers, or of the posterior samples if
+                more walkers are needed, is used. The burn-in of these
+                iterations is reduced to this fraction of ``nburnin``, with
+                ``True`` using 0.2.
+            search (optional[bool/dict]): If ``True``, or a dictionary of
+                kwargs for :func:`search_p0`, scan the geometrical parameters
+                before the optimization. The best candidates are used as the
+                starting positions for the optimization, or the best as
+                ``p0`` if ``optimize=False``.
 
         Returns:
             to_return (list): Depending on the returns list provided.
@@ -154,7 +241,9 @@ class rotationmap(datacube):
                 the burn-in periods removed). ``'percentiles'`` will return the
                 16th, 50th and 84th percentiles of each posterior functions.
                 ``'dict'`` will return a dictionary of the median parameters
-                which can be directly input to other functions.
+                which can be directly input to other functions. ``'params'``
+                will return the ``params`` dictionary matching the samples,
+                i.e. including the indices of any ``linear`` parameters.
         """
 
         # Check the dictionary. May need some more work.
@@ -168,7 +257,29 @@ class rotationmap(datacube):
                 print("Found `r_max` in `params`. Overwriting value.")
             params['r_max'] = r_max
 
-        params_tmp = self.verify_params_dictionary(params.copy())
+        # Linear parameters are replaced by placeholder values which are used
+        # to build the model basis in the likelihood.
+
+        linear = rotationmap._check_linear(params, linear, linear_method)
+        params_tmp = params.copy()
+        if linear is not None:
+            for p in linear[0]:
+                params_tmp[p] = rotationmap._linear_placeholders[p]
+        params_tmp = self.verify_params_dictionary(params_tmp)
+        user_mask = params_tmp['user_mask']
+
+        # Set the resolution levels to use. Without a pyramid, all iterations
+        # are run at the current resolution.
+
+        if pyramid is None:
+            levels = np.ones(int(niter)).astype('int')
+        else:
+            self._check_image()
+            levels = np.atleast_1d(pyramid).astype('int')
+            if np.any(levels < 1):
+                raise ValueError("All `pyramid` levels must be >= 1.")
+            self.set_resolution(levels[0])
+            params_tmp['user_mask'] = self._level_mask(user_mask, levels[0])
 
         # Generate the mask for fitting based on the params.
 
@@ -188,11 +299,39 @@ class rotationmap(datacube):
             raise ValueError("Mismatch in labels and p0. Check for integers.")
         print("Assuming:\n\tp0 = [%s]." % (', '.join(labels_raw)))
 
-        # Run an initial optimization using scipy.minimize. Recalculate the
-        # inverse variance mask.
+        # Load the checkpoint if resuming. Otherwise clear any previous
+        # checkpoint in the directory so that chains are not mixed.
 
-        if optimize:
-            p0 = self._optimize_p0(p0, params_tmp)
+        state = None
+        if checkpoint is not None:
+            if resume:
+                state = load_checkpoint(checkpoint)
+                if state is None:
+                    print("WARNING: No checkpoint found. Starting from p0.")
+            else:
+                clear_checkpoint(checkpoint)
+        elif resume:
+            raise ValueError("Must specify `checkpoint` to resume.")
+
+        # Run an initial search of the geometrical parameters and/or an
+        # optimization using scipy.minimize. Recalculate the inverse variance
+        # mask.
+
+        if state is not None:
+            p0 = state['p0']
+            print("Resuming from iteration %d, step %d." % (state['level'],
+                                                             state['step']))
+        else:
+            if search:
+                search = {} if search is True else dict(search)
+                search['nbest'] = search.pop('nbest', max(int(optimize), 1))
+                search['pool'] = search.pop('pool', pool)
+                search['linear'] = () if linear is None else linear[0]
+                p0 = self._search_p0(p0, params_tmp, **search)
+                p0 = p0 if optimize else p0[0]
+            if optimize:
+                p0 = self._optimize_p0(p0, params_tmp, linear=linear,
+                                       nstarts=int(optimize), pool=pool)
 
         # Set up and run the MCMC with emcee.
 
@@ -204,32 +343,111 @@ class rotationmap(datacube):
         mcmc_kwargs = {} if mcmc_kwargs is None else mcmc_kwargs
         mcmc_kwargs['scatter'], mcmc_kwargs['pool'] = scatter, pool
 
-        for n in range(int(niter)):
+        warm_start = 0.2 if warm_start is True else float(warm_start)
+        if not 0.0 <= warm_start <= 1.0:
+            raise ValueError("`warm_start` must be between 0 and 1.")
+
+        n_start = 0 if state is None else int(state['level'])
+        samples = chain = None
+
+        for n, level in enumerate(levels):
 
-            # Make the mask for fitting.
+            # Skip the iterations already completed in the checkpoint.
 
-            temp = rotationmap._populate_dictionary(p0, params_tmp)
-            temp = self.verify_params_dictionary(temp)
-            self.ivar = self._calc_ivar(temp)
+            if n < n_start:
+                continue
+            resuming = state is not None and n == n_start
+
+            # Change the resolution if using a pyramid. Walkers are drawn
+            # from the posterior samples of the previous level.
+
+            p0_mcmc, start = p0, 0
+            discard = nburnin[n % nburnin.size]
+            nw = nwalkers[n % nwalkers.size]
+            if pyramid is not None:
+                self.set_resolution(level)
+                params_tmp['user_mask'] = self._level_mask(user_mask, level)
+                if samples is not None and not resuming:
+                    p0_mcmc = samples[np.random.choice(samples.shape[0], nw,
+                                                       replace=False)]
+
+            # For a warm start, carry over the final walkers from the previous
+            # iteration and shorten the burn-in.
+
+            if warm_start and n > 0:
+                discard = int(np.ceil(warm_start * discard))
+                if pyramid is None and chain is not None and not resuming:
+                    if nw <= chain.shape[1]:
+                        idx = np.random.choice(chain.shape[1], nw,
+                                               replace=False)
+                        p0_mcmc = chain[-1, idx]
+                    else:
+                        idx = np.random.choice(samples.shape[0], nw,
+                                               replace=False)
+                        p0_mcmc = samples[idx]
+
+            # Make the mask for fitting. When resuming, the walkers and mask
+            # are taken from the checkpoint.
+
+            if resuming:
+                p0_mcmc, start = state['walkers'], int(state['step'])
+                self.ivar = state['ivar']
+            else:
+                temp = rotationmap._populate_dictionary(p0, params_tmp)
+                temp = self.verify_params_dictionary(temp)
+                self.ivar = self._calc_ivar(temp)
 
             # Run the sampler.
 
-            sampler = self._run_mcmc(p0=p0, params=params_tmp,
-                                     nwalkers=nwalkers[n % nwalkers.size],
-                                     nburnin=nburnin[n % nburnin.size],
+            sampler = self._run_mcmc(p0=p0_mcmc, params=params_tmp,
+                                     nwalkers=nw, nburnin=discard,
                                      nsteps=nsteps[n % nsteps.size],
-                                     mcmc=mcmc, **mcmc_kwargs)
-
+                                     mcmc=mcmc, checkpoint=checkpoint,
+                                     level=n, start=start,
+                                     checkpoint_every=checkpoint_every,
+                                     checkpoint_state=dict(p0=p0,
+                                                           ivar=self.ivar),
+                                     linear=linear, **mcmc_kwargs)
+
+            if checkpoint is None:
+                chain, lnprob = sampler.get_chain(), sampler.get_log_prob()
+            else:
+                total = discard + nsteps[n % nsteps.size]
+                chain, lnprob = load_checkpoint_chain(checkpoint, n, total)
             if type(params_tmp['PA']) is int:
-                sampler.chain[:, :, params_tmp['PA']] %= 360.0
+                chain[:, :, params_tmp['PA']] %= 360.0
 
             # Split off the samples.
 
-            samples = sampler.get_chain(discard=nburnin[-1], flat=True)
+            samples = chain[discard:]
+            samples = samples.reshape(-1, samples.shape[-1])
             p0 = np.median(samples, axis=0)
-            medians = rotationmap._populate_dictionary(p0, params.copy())
+            medians = rotationmap._populate_dictionary(p0, params_tmp.copy())
             medians = self.verify_params_dictionary(medians)
 
+        # Return to the full resolution data for the outputs.
+
+        if pyramid is not None and levels[-1] != 1:
+            self.set_resolution(1)
+            medians['user_mask'] = user_mask
+            self.ivar = self._calc_ivar(medians)
+
+        # Draw the linear parameters and add them to the free parameters.
+
+        medians = rotationmap._populate_dictionary(p0, params.copy())
+        if linear is not None:
+            params_tmp['user_mask'] = user_mask
+            samples = self._sample_linear(samples, params_tmp, linear)
+            params = params.copy()
+            for i, p in enumerate(linear[0]):
+                params[p] = samples.shape[1] - len(linear[0]) + i
+            print("Added {} to `samples`. Use `returns=['params']` for "
+                  "their indices.".format(linear[0]))
+            labels = rotationmap._get_labels(params)
+            p0 = np.median(samples, axis=0)
+            medians = rotationmap._populate_dictionary(p0, params.copy())
+        medians = self.verify_params_dictionary(medians)
+
         # Diagnostic plots.
 
         if plots is None:
@@ -238,11 +456,8 @@ class rotationmap(datacube):
         if 'none' in plots:
             plots = []
         if 'walkers' in plots:
-            if mcmc == 'emcee':
-                walkers = sampler.chain.T
-            else:
-                walkers = np.rollaxis(sampler.chain.copy(), 2)
-            plot_walkers(walkers, nburnin[-1], labels)
+            plot_walkers(np.rollaxis(chain.copy(), 2), discard,
+                         labels[:chain.shape[-1]])
         if 'corner' in plots:
             plot_corner(samples, labels)
         if 'bestfit' in plots:
@@ -271,11 +486,13 @@ class rotationmap(datacube):
         if 'sampler' in returns:
             to_return += [sampler]
         if 'lnprob' in returns:
-            to_return += [sampler.lnprobability[nburnin:]]
+            to_return += [lnprob[discard:]]
         if 'percentiles' in returns:
             to_return += [np.percentile(samples, [16, 50, 84], axis=0)]
         if 'dict' in returns:
             to_return += [medians]
+        if 'params' in returns:
+            to_return += [params]
         if 'model' in returns or 'residual' in returns:
             model = self.evaluate_models(samples, params)
             if 'model' in returns:
@@ -291,7 +508,8 @@ class rotationmap(datacube):
                    phi_max=None, exclude_phi=False, abs_phi=False,
                    mask_frame='disk', user_mask=None, fit_vrad=True,
                    fix_vlsr=None, beam_spacing=0, niter=1, plots=None,
-                   returns=None, optimize_kwargs=None, MCMC=False):
+                   returns=None, optimize_kwargs=None, MCMC=False,
+                   joint=False, smooth=None):
         r"""
         Splits the map into concentric annuli based on the geometrical
         parameters, then fits each annnulus with a simple harmonic oscillator
@@ -303,6 +521,14 @@ class rotationmap(datacube):
 
         where :math:`i` is the inclination of the disk.
 
+        As the model is linear in the projected velocities, with ``joint=True``
+        all annuli are instead solved at once with a single sparse
+        least-squares solve using all pixels. The optional ``smooth`` penalty
+        then regularizes the second radial derivatives of the projected
+        velocities, such that noisy annuli are informed by their neighbours,
+        and the covariances of the profiles are returned with
+        ``'covariance'`` in ``returns``.
+
         .. note::
             If you find negative :math:`v_{\phi}` values then your chosen
             position angle is likely off by 180 degrees.
@@ -350,15 +576,28 @@ class rotationmap(datacube):
                 such that returned velocity component is the deprojected
                 vertical velocity.
             beam_spacing (Optional[int/float]): If provided, sample pixels that
-                are roughly this fraction of a beam separated.
+                are roughly this fraction of a beam separated on the sky.
+                All ``niter`` draws are made at once for each annulus.
             niter (Optional[int]): Run ``niter`` iterations. Should only be
                 used when `beam_spacing > 0`.
             plots (Optional[list]): Plots to generate after the fitting. Can be
                 either of ``'model'`` and ``'residual'``. Default is both.
             returns (Optional[list]): List of objects to return. Can be any of
-                ``'profiles'``, ``'model'`` or ``'residual'``.
+                ``'profiles'``, ``'model'``, ``'residual'`` or
+                ``'covariance'``, the ``(nannuli, 4, 4)`` covariance of the
+                profiles. Only the diagonal is available unless
+                ``joint=True``.
             optimize_kwargs (Optional[dict]): Kwargs to pass to
                 ``scipy.optimize.curve_fit``.
+            joint (Optional[bool]): Solve for all annuli at once with a sparse
+                linear least-squares solve rather than fitting each annulus.
+                ``beam_spacing`` and ``niter`` are ignored.
+            smooth (Optional[float]): If ``joint=True``, the standard deviation
+                in [m/s/arcsec^2] of the second radial derivative of the
+                projected velocities, evaluated between contiguous annuli.
+                Smaller values give smoother profiles. As a Keplerian profile
+                has a curvature of :math:`3 v_{\phi} / 4 r^2`, values well
+                below this will flatten the rotation curve.
 
         Returns:
             Depends on the value of ``returns``.
@@ -366,7 +605,11 @@ class rotationmap(datacube):
 
         # Remove possbility to run niter > 1 with beam_spacing = 0.
 
-        if niter > 1 and beam_spacing == 0:
+        if joint and (niter > 1 or beam_spacing):
+            print("WARNING: Joint fits use all pixels in a single solve.")
+            print("\t Ignoring `niter` and `beam_spacing`.")
+            niter, beam_spacing = 1, 0
+        elif niter > 1 and beam_spacing == 0:
             print("WARNING: Can't run multiple iterations using all pixels.")
             print("\t Setting niter = 1 and continuing.")
 
@@ -386,18 +629,43 @@ class rotationmap(datacube):
                                         q_taper=q_taper,
                                         z_func=z_func,
                                         shadowed=shadowed)[:2]
+        x_sky, y_sky = self._get_cart_sky_coords(0.0, 0.0)
 
         # Empty lists to hold the results. `velo_proj` are the projected
         # velocities, i.e., the {A, B, C} parameters from a SHO fit. `velo` are
         # these values deprojected accounting for the disk inclination and
         # rotation.
 
-        velo, dvelo = [], []
+        velo, dvelo, cvelo = [], [], None
         empty = [np.nan, np.nan, np.nan, np.nan]
 
-        # Cycle through each annulus to include the fit.
+        # Either solve all annuli at once or cycle through each annulus to
+        # include the fit.
+
+        if joint:
+            mask_kwargs = dict(phi_min=phi_min, phi_max=phi_max,
+                               exclude_phi=exclude_phi, abs_phi=abs_phi,
+                               x0=x0, y0=y0, inc=inc, PA=PA, z0=z0, psi=psi,
+                               r_cavity=r_cavity, r_taper=r_taper,
+                               q_taper=q_taper, z_func=z_func,
+                               shadowed=shadowed, mask_frame=mask_frame,
+                               user_mask=user_mask)
+            if mask_frame.lower() == 'sky':
+                rmask = self.disk_coords(x0=x0, y0=y0, z0=z0, psi=psi,
+                                         r_cavity=r_cavity, r_taper=r_taper,
+                                         q_taper=q_taper, z_func=z_func,
+                                         shadowed=shadowed)[0]
+            else:
+                rmask = rvals
+            velo, dvelo, cvelo = self._fit_annuli_joint(
+                rbins=rbins, rvals=rmask, pvals=pvals, inc=inc,
+                mask_kwargs=mask_kwargs, fit_vrad=fit_vrad,
+                fix_vlsr=fix_vlsr, smooth=smooth)
+            annuli = []
+        else:
+            annuli = zip(rbins[:-1], rbins[1:])
 
-        for r_min, r_max in zip(rbins[:-1], rbins[1:]):
+        for r_min, r_max in annuli:
 
             # Define the annulus mask. If there are no pixels in it, after
             # removing all the NaNs values, continue to the next annulus.
@@ -432,10 +700,14 @@ class rotationmap(datacube):
             x = pvals.copy()[mask].flatten()
             y = self.data.copy()[mask].flatten()
             dy = self.error.copy()[mask].flatten()
+            xsky = x_sky[mask].flatten()
+            ysky = y_sky[mask].flatten()
             isfinite = np.isfinite(y) & np.isfinite(dy)
             x, y, dy = x[isfinite], y[isfinite], dy[isfinite]
+            xsky, ysky = xsky[isfinite], ysky[isfinite]
             sorted = np.argsort(x)
             x, y, dy = x[sorted], y[sorted], dy[sorted]
+            xsky, ysky = xsky[sorted], ysky[sorted]
 
             if len(x) < 2:
                 velo += [empty]
@@ -451,23 +723,35 @@ class rotationmap(datacube):
             velo_tmp = []
             dvelo_tmp = []
 
-            for _ in range(niter):
+            if beam_spacing and beam_spacing * self.bmaj <= abs(self.dpix):
+                print("Pixels appear to be spatially independent.")
+                print("Will set `beam_spacing=0`.")
+                beam_spacing = 0.0
+            if beam_spacing:
+                draws = self._beam_grid_samples(xsky=xsky, ysky=ysky,
+                                                beam_spacing=beam_spacing,
+                                                ndraws=niter)
+
+            # As the SHO model is linear, all draws can be solved at once
+            # unless a custom fit is requested.
+
+            if beam_spacing and not MCMC and optimize_kwargs is None:
+                velo_tmp, dvelo_tmp = self._fit_SHO_draws(x=x, y=y, dy=dy,
+                                                          draws=draws,
+                                                          inc=inc,
+                                                          fit_vrad=fit_vrad,
+                                                          fix_vlsr=fix_vlsr)
+                iterations = []
+            else:
+                iterations = range(niter)
 
-                sampling = float(beam_spacing) * self.bmaj
-                sampling /= np.mean([r_min, r_max]) * np.median(np.diff(x))
-                sampling = np.floor(sampling).astype('int')
-                if sampling < 1 and beam_spacing > 0.0:
-                    print("Pixels appear to be spatially independent.")
-                    print("Will set `beam_spacing=0`.")
-                    beam_spacing = 0.0
+            for n in iterations:
 
                 if not beam_spacing:
                     x_tmp, y_tmp, dy_tmp = x, y, dy
                 else:
-                    start = np.random.randint(0, x.size)
-                    x_tmp = np.hstack([x[start:], x[:start]])[::sampling]
-                    y_tmp = np.hstack([y[start:], y[:start]])[::sampling]
-                    dy_tmp = np.hstack([dy[start:], dy[:start]])[::sampling]
+                    idx = np.sort(draws[n])
+                    x_tmp, y_tmp, dy_tmp = x[idx], y[idx], dy[idx]
 
                 # Fit the pixels, and correct the radial velocity to have
                 # positive velocities describining motions away from the star.
@@ -530,6 +814,8 @@ class rotationmap(datacube):
 
         velo = np.where(np.isfinite(velo), velo, np.nan)
         dvelo = np.where(np.isfinite(dvelo), dvelo, np.nan)
+        if cvelo is None:
+            cvelo = np.einsum('ij,jk->kij', np.eye(4), dvelo**2)
 
         # Build the linearly interpolated model noting that the velocities need
         # to be projected into the sky.
@@ -568,8 +854,185 @@ class rotationmap(datacube):
             to_return += [model]
         if 'residual' in returns:
             to_return += [self.data - model]
+        if 'covariance' in returns:
+            to_return += [cvelo]
         return to_return
 
+    def _fit_annuli_joint(self, rbins, rvals, pvals, inc, mask_kwargs,
+                          fit_vrad=True, fix_vlsr=None, smooth=None):
+        """
+        Solve for the projected SHO coefficients, ``A``, ``B`` and ``C``, of
+        all annuli at once as a single sparse weighted least-squares problem.
+        With ``smooth``, a penalty on the second radial derivative of each
+        coefficient, with a standard deviation of ``smooth`` in
+        [m/s/arcsec^2], is added which couples each run of three contiguous
+        annuli. The derivative is taken at the annuli centers so allows for a
+        non-uniform spacing, and annuli are not coupled across any dropped
+        annuli. Without it, the result is the same as fitting each annulus
+        independently. Annuli without enough pixels to constrain them are
+        returned as NaNs.
+
+        Args:
+            rbins (array): Array of annuli edges in [arcsec].
+            rvals (array): A 2D array of the radii in [arcsec], in the frame
+                used for the annuli masks.
+            pvals (array): A 2D array of the polar angles in [radians].
+            inc (float): Inclination of the disk in [degrees].
+            mask_kwargs (dict): Kwargs to pass to :func:`get_mask` for the
+                azimuthal and user masks.
+            fit_vrad (Optional[bool]): Whether to include radial velocities.
+            fix_vlsr (Optional[float]): Fixed systemic velocity.
+            smooth (Optional[float]): Standard deviation of the second
+                radial derivative of the projected coefficients in
+                [m/s/arcsec^2].
+
+        Returns:
+            velo, dvelo, cvelo (ndarray, ndarray, ndarray): The deprojected
+                ``[v_phi, v_r, v_z, v_lsr]`` values, their uncertainties, both
+                shaped ``(nannuli, 4)``, and their covariances, shaped
+                ``(nannuli, 4, 4)``.
+        """
+        import scipy.sparse as sparse
+        from scipy.sparse.linalg import splu
+
+        nring, npar = rbins.size - 1, 3 if fit_vrad else 2
+        velo = np.full((nring, 4), np.nan)
+        dvelo = np.full((nring, 4), np.nan)
+        cvelo = np.full((nring, 4, 4), np.nan)
+
+        # Collect the finite pixels of each annulus. The azimuthal and user
+        # masks are shared by all annuli so only need to be calculated once,
+        # with the pixels then labelled by the annulus they fall in.
+
+        try:
+            mask = self.get_mask(**mask_kwargs)
+        except ValueError:
+            print("WARNING: Not enough annuli with pixels to fit.")
+            return velo, dvelo, cvelo
+        mask &= np.isfinite(self.data) & np.isfinite(self.error)
+        mask &= np.isfinite(rvals)
+        pix = np.flatnonzero(mask)
+        ring = np.digitize(rvals.ravel()[pix], rbins) - 1
+        inside = (ring >= 0) & (ring < nring)
+        pix, ring = pix[inside], ring[inside]
+
+        # Only annuli with enough pixels are included. With smoothing, the
+        # contiguous neighbouring annuli also constrain those with only a few
+        # pixels. `triple` marks the annuli centering a smoothed triplet.
+
+        counts = np.bincount(ring, minlength=nring)
+        used = counts >= npar
+        triple = np.zeros(nring, dtype=bool)
+        if smooth:
+            filled = counts > 0
+            triple[1:-1] = filled[:-2] & filled[1:-1] & filled[2:]
+            coupled = triple.copy()
+            coupled[:-2] |= triple[1:-1]
+            coupled[2:] |= triple[1:-1]
+            used |= coupled
+        order = np.cumsum(used) - 1
+        if not used.any():
+            print("WARNING: Not enough annuli with pixels to fit.")
+            return velo, dvelo, cvelo
+        keep = used[ring]
+        pix, ring = pix[keep], order[ring[keep]]
+
+        # Build the banded design matrix and the normal equations.
+
+        phi = pvals.ravel()[pix]
+        y, w = self.data.ravel()[pix], self.error.ravel()[pix]**-2.0
+        basis = [np.cos(phi), np.sin(phi), np.ones(phi.size)]
+        basis = basis if fit_vrad else [basis[0], basis[2]]
+        rows = np.tile(np.arange(pix.size), npar)
+        cols = np.concatenate([ring * npar + k for k in range(npar)])
+        X = sparse.csr_matrix((np.concatenate(basis), (rows, cols)),
+                              shape=(pix.size, used.sum() * npar))
+        N = X.T @ sparse.diags(w) @ X
+        b = X.T @ (w * y)
+        if smooth and triple.any():
+            D = self._second_derivative_operator(rbins, used, triple)
+            D = sparse.kron(D, sparse.identity(npar))
+            N = N + (D.T @ D) / smooth**2
+
+        # Solve the system and calculate the covariance matrix.
+
+        try:
+            lu = splu(sparse.csc_matrix(N))
+            coeffs = lu.solve(b).reshape(-1, npar)
+            cov = self._block_diagonal_inverse(lu, used.sum(), npar)
+        except RuntimeError:
+            print("WARNING: Joint annuli solve is singular.")
+            return velo, dvelo, cvelo
+
+        # Convert from projected velocities into disk-frame velocities,
+        # matching `_fit_SHO`, where T maps [A, (B), C] to
+        # [v_phi, v_r, v_z, v_lsr].
+
+        sini, cosi = np.sin(np.radians(inc)), np.cos(np.radians(inc))
+        T, offset = np.zeros((4, npar)), np.zeros(4)
+        T[0, 0] = 1.0 / abs(sini)
+        if fit_vrad:
+            T[1, 1] = -1.0 / sini
+        if fix_vlsr is None:
+            T[3, -1] = 1.0
+        else:
+            T[2, -1] = -1.0 / cosi
+            offset[2], offset[3] = fix_vlsr / cosi, fix_vlsr
+        velo[used] = np.dot(coeffs, T.T) + offset[None, :]
+        cvelo[used] = np.einsum('ij,njk,lk->nil', T, cov, T)
+        dvelo[used] = np.diagonal(cvelo[used], axis1=1, axis2=2)**0.5
+        return velo, dvelo, cvelo
+
+    @staticmethod
+    def _second_derivative_operator(rbins, used, triple):
+        """
+        Sparse operator returning the second radial derivative, in units of
+        [arcsec^-2], at the center of each triplet of contiguous annuli
+        marked by ``triple``, acting on the values of the ``used`` annuli. The
+        three-point derivative is taken for the annuli centers, allowing for
+        a non-uniform spacing of ``rbins``.
+        """
+        import scipy.sparse as sparse
+
+        rc = 0.5 * (rbins[1:] + rbins[:-1])
+        order = np.cumsum(used) - 1
+        idx = np.flatnonzero(triple)
+        h1, h2 = rc[idx] - rc[idx - 1], rc[idx + 1] - rc[idx]
+        vals = [2.0 / h1 / (h1 + h2), -2.0 / h1 / h2, 2.0 / h2 / (h1 + h2)]
+        cols = [order[idx - 1], order[idx], order[idx + 1]]
+        rows = np.tile(np.arange(idx.size), 3)
+        return sparse.csr_matrix((np.concatenate(vals),
+                                  (rows, np.concatenate(cols))),
+                                 shape=(idx.size, used.sum()))
+
+    @staticmethod
+    def _block_diagonal_inverse(lu, nblock, npar, chunk=64):
+        """
+        Return the ``(npar, npar)`` diagonal blocks of the inverse of a
+        factorized matrix without forming the full dense inverse. The unit
+        vectors are solved for in chunks of ``chunk`` blocks at a time and only
+        the rows of the matching diagonal blocks are kept.
+
+        Args:
+            lu (SuperLU): The factorized matrix.
+            nblock (int): Number of diagonal blocks.
+            npar (int): Size of each diagonal block.
+            chunk (Optional[int]): Number of blocks to solve for at once.
+
+        Returns:
+            cov (ndarray): The diagonal blocks, shaped
+                ``(nblock, npar, npar)``.
+        """
+        cov = np.empty((nblock, npar, npar))
+        for i in range(0, nblock, chunk):
+            j = min(i + chunk, nblock)
+            rhs = np.zeros((nblock * npar, (j - i) * npar))
+            rhs[i * npar:j * npar] = np.eye((j - i) * npar)
+            sol = lu.solve(rhs)[i * npar:j * npar]
+            sol = sol.reshape(j - i, npar, j - i, npar)
+            cov[i:j] = sol[np.arange(j - i), :, np.arange(j - i), :]
+        return cov
+
     def _evaluate_annuli_model(self, rpnts, velo_proj, rvals, pvals):
         """
         Evaluate the annuli models onto a 2D map. The velocity profiles must be
@@ -646,6 +1109,65 @@ class rotationmap(datacube):
 
         return popt, cvar
 
+    def _fit_SHO_draws(self, x, y, dy, draws, inc, fit_vrad=True,
+                       fix_vlsr=None):
+        """
+        Fit each set of pixel indices in ``draws`` with a simple harmonic
+        oscillator. As the model is linear, the normal equations of all draws
+        are built at once with ``np.bincount`` and solved together, giving the
+        same results as :func:`_fit_SHO` for each draw. Draws with too few
+        pixels, or a singular system, are returned as NaNs.
+
+        Returns:
+            velo, dvelo (ndarray, ndarray): The ``[v_rot, v_rad, v_alt,
+                v_lsr]`` values and uncertainties for each draw, both with a
+                shape of ``(ndraws, 4)``.
+        """
+        ndraws = len(draws)
+        label = np.repeat(np.arange(ndraws), [d.size for d in draws])
+        idx = np.concatenate(draws).astype(int)
+
+        # Build the normal equations for all draws.
+
+        basis = [np.cos(x[idx]), np.sin(x[idx]), np.ones(idx.size)]
+        basis = basis if fit_vrad else [basis[0], basis[2]]
+        w, yw = dy[idx]**-2.0, y[idx] * dy[idx]**-2.0
+        npar = len(basis)
+        N = np.empty((ndraws, npar, npar))
+        b = np.empty((ndraws, npar))
+        for i in range(npar):
+            b[:, i] = np.bincount(label, yw * basis[i], minlength=ndraws)
+            for j in range(i, npar):
+                N[:, i, j] = np.bincount(label, w * basis[i] * basis[j],
+                                         minlength=ndraws)
+                N[:, j, i] = N[:, i, j]
+
+        # Solve, skipping the draws which are underconstrained.
+
+        popt = np.full((ndraws, npar), np.nan)
+        cvar = np.full((ndraws, npar), np.nan)
+        ok = np.bincount(label, minlength=ndraws) >= npar
+        ok &= abs(np.linalg.det(N)) > 0.0
+        if np.any(ok):
+            cov = np.linalg.inv(N[ok])
+            popt[ok] = np.einsum('nij,nj->ni', cov, b[ok])
+            cvar[ok] = np.diagonal(cov, axis1=1, axis2=2)**0.5
+
+        # Convert from projected velocities into disk-frame velocities,
+        # matching `_fit_SHO`.
+
+        sini, cosi = np.sin(np.radians(inc)), np.cos(np.radians(inc))
+        zero = np.zeros(ndraws)
+        velo = [popt[:, 0] / abs(sini),
+                popt[:, 1] / -sini if fit_vrad else zero,
+                zero if fix_vlsr is None else (fix_vlsr - popt[:, -1]) / cosi,
+                popt[:, -1] if fix_vlsr is None else zero + fix_vlsr]
+        dvelo = [cvar[:, 0] / abs(sini),
+                 cvar[:, 1] / abs(sini) if fit_vrad else zero,
+                 zero if fix_vlsr is None else cvar[:, -1] / cosi,
+                 cvar[:, -1] if fix_vlsr is None else zero]
+        return np.array(velo).T, np.array(dvelo).T
+
     def _SHO_chi2(self, x, y, dy, func, p0, optimize_kwargs=None):
         """Use scipy.optimize.curve_fit for the fitting."""
         from scipy.optimize import curve_fit
@@ -670,14 +1192,13 @@ class rotationmap(datacube):
 
     def _SHO_MCMC(self, x, y, dy, func, p0, priors, optimize_kwargs=None):
         """Use an MCMC sampler to model the posteriors."""
-
-        # Set up the optimization.
+        # Set up the optimization, importing only the requested backend.
 
         kw = {} if optimize_kwargs is None else optimize_kwargs
         if kw.pop('mcmc', 'emcee') == 'zeus':
-            EnsembleSampler = zeus.EnsembleSampler
+            from zeus import EnsembleSampler
         else:
-            EnsembleSampler = emcee.EnsembleSampler
+            from emcee import EnsembleSampler
         nwalkers = kw.pop('nwalkers', 128)
         nburnin = kw.pop('nburnin', 200)
         nsteps = kw.pop('nsteps', 100)
@@ -689,8 +1210,8 @@ class rotationmap(datacube):
         # Check that the starting positions are OK. If not, return NaN.
         # TODO: Check how to handle this in the model making.
 
-        if not np.isfinite(np.sum([rotationmap.SHO_priors[p](t)
-                                   for t, p in zip(p0, priors)])):
+        prior_plan = self._SHO_prior_plan(priors)
+        if not np.isfinite(self._SHO_ln_prior(p0, prior_plan)):
             return [np.nan for _ in p0], [np.nan for _ in p0]
 
         # Run the EnsembleSampler
@@ -699,7 +1220,7 @@ class rotationmap(datacube):
         sampler = EnsembleSampler(nwalkers,
                                   p0.shape[1],
                                   self._SHO_ln_probability,
-                                  args=[func, priors, x, y, dy],
+                                  args=[func, prior_plan, x, y, dy],
                                   moves=moves,
                                   pool=pool)
         sampler.run_mcmc(p0, nburnin + nsteps, progress=progress, **kw)
@@ -710,21 +1231,22 @@ class rotationmap(datacube):
         samples = np.percentile(samples, [16, 50, 84], axis=0)
         return samples[1], 0.5 * (samples[2] - samples[0])
 
-    def _SHO_ln_probability(self, theta, func, priors, x, y, dy):
+    def _SHO_ln_probability(self, theta, func, prior_plan, x, y, dy):
         """Log-probablility function."""
-        lnp = self._SHO_ln_prior(theta, priors)
+        lnp = self._SHO_ln_prior(theta, prior_plan)
         if np.isfinite(lnp):
             return lnp + self._SHO_ln_likelihood(theta, func, x, y, dy)
         return -np.inf
 
-    def _SHO_ln_prior(self, theta, priors):
+    def _SHO_prior_plan(self, priors):
+        """Vectorized priors for the list of SHO parameter names."""
+        return rotationmap._build_prior_plan(self.SHO_priors, priors,
+                                             lnmin=-np.inf)
+
+    @staticmethod
+    def _SHO_ln_prior(theta, prior_plan):
         """Priors for the MCMC fitting of the annuli."""
-        lnp = 0.0
-        for t, p in zip(theta, priors):
-            lnp += rotationmap.SHO_priors[p](t)
-            if not np.isfinite(lnp):
-                return lnp
-        return lnp
+        return rotationmap._eval_prior_plan(np.asarray(theta), prior_plan)
 
     def _SHO_ln_likelihood(self, theta, func, x, y, dy):
         """Log-likelihood for the MCMC fitting of the annuli."""
@@ -746,6 +1268,210 @@ class rotationmap(datacube):
             rbins = np.insert(rpnts + dr, 0, rpnts[0] - dr[0])
         return rpnts, rbins
 
+    def fit_tilted_rings(self, rpnts=None, rbins=None, x0=0.0, y0=0.0,
+                         inc=30.0, PA=0.0, z0=0.0, psi=1.0, r_cavity=0.0,
+                         r_taper=np.inf, q_taper=1.0, z_func=None,
+                         user_mask=None, fit_vrad=False, fix_vlsr=None,
+                         niter=1, pool=None, plots=None, returns=None,
+                         optimize_kwargs=None):
+        r"""
+        Tilted-ring fit of the map. Unlike :func:`fit_annuli`, each annulus
+        independently fits its own inclination and position angle, along with
+        the rotation velocity, systemic velocity and, optionally, the radial
+        velocity with the model,
+
+        .. math::
+
+            v_0 = v_{\phi} \cos(\phi) \sin(|i|)
+            - v_{\rm r} \sin(\phi) \sin(i) + v_{\rm lsr}
+
+        where the polar angle, :math:`\phi`, of each pixel is recalculated for
+        the geometry of the ring. The source center and emission surface are
+        shared by all rings. The pixels of each ring are selected using the
+        provided geometry or, for ``niter > 1``, the geometry fit to that ring
+        in the previous iteration. Each ring is fit with
+        ``scipy.optimize.curve_fit``, with the inclination restricted to the
+        sign of ``inc``, the position angle to within 180 degrees of ``PA``
+        and a positive rotation velocity. The rings can be fit in parallel
+        with ``pool``, with only the pixels of each ring sent to the workers.
+
+        Args:
+            rpnts (Optional[array]): Array of radial position in [arcsec] to
+                center the annuli on. Only ``rpnts`` or ``rbins`` need to be
+                set.
+            rbins (Optional[array]): Array of annuli edges in [arcsec] to use.
+                Only ``rpnts`` or ``rbins`` need to be set.
+            x0 (Optional[float]): Source right ascension offset [arcsec].
+            y0 (Optional[float]): Source declination offset [arcsec].
+            inc (Optional[float]): Initial source inclination [degrees].
+            PA (Optional[float]): Initial source position angle [degrees].
+            z0 (Optional[float]): Aspect ratio at 1" for the emission surface.
+            psi (Optional[float]): Flaring angle for the emission surface.
+            r_cavity (Optional[float]): Outer radius of a cavity.
+            r_taper (Optional[float]): Radius for tapered emission surface.
+            q_taper (Optional[float]): Exponent for tapered emission surface.
+            z_func (Optional[callable]): A user-defined emission surface
+                function that will return ``z`` in [arcsec] for a given ``r``
+                in [arcsec]. This will override the analytical form.
+            user_mask (Optional[ndarray]): A 2D mask to use.
+            fit_vrad (Optional[bool]): Whether to include radial velocities in
+                the fit. Default is ``False``.
+            fix_vlsr (Optional[float]): Fix the systemic velocity to this
+                value.
+            niter (Optional[int]): Number of iterations of selecting the ring
+                pixels and fitting. Must be at least 1.
+            pool (Optional): An object with a ``map`` method.
+            plots (Optional[list]): Plots to generate after the fitting. Can be
+                any of ``'profiles'``, ``'model'`` and ``'residual'``. Default
+                is all.
+            returns (Optional[list]): List of objects to return. Can be any of
+                ``'profiles'``, ``'model'`` or ``'residual'``.
+            optimize_kwargs (Optional[dict]): Kwargs to pass to
+                ``scipy.optimize.curve_fit``.
+
+        Returns:
+            Depends on the value of ``returns``. ``'profiles'`` returns the
+            annuli centers and the ``[inc, PA, v_phi, v_r, v_lsr]`` profiles
+            and their uncertainties, each with a shape of ``(5, nannuli)``.
+        """
+        if int(niter) < 1:
+            raise ValueError("Must have at least one iteration.")
+        rpnts, rbins = self._get_radial_bins(rpnts=rpnts, rbins=rbins)
+        surface = dict(x0=x0, y0=y0, z0=z0, psi=psi, r_cavity=r_cavity,
+                       r_taper=r_taper, q_taper=q_taper, z_func=z_func)
+        vlsr = np.nanmean(self.data) if fix_vlsr is None else fix_vlsr
+        geometry = np.array([[inc, PA, np.nan, 0.0, vlsr]] * rpnts.size)
+        func = functools.partial(rotationmap._fit_tilted_ring,
+                                 surface=surface,
+                                 flared_kwargs=self._flared_kwargs(), PA=PA,
+                                 fit_vrad=fit_vrad, fix_vlsr=fix_vlsr,
+                                 optimize_kwargs=optimize_kwargs)
+        x_sky, y_sky = self._get_cart_sky_coords(0.0, 0.0)
+        x_sky, y_sky = np.ravel(x_sky), np.ravel(y_sky)
+        data, error = self.data.ravel(), self.error.ravel()
+
+        # Cycle through the iterations, selecting the pixels of each ring
+        # based on the current geometry. Each ring carries the sky positions,
+        # values and uncertainties of its pixels so that neither the map nor
+        # the sky coordinates need to be rebuilt or sent to the workers.
+
+        for _ in range(int(niter)):
+            pixels, rings = [], []
+            for i, (r_min, r_max) in enumerate(zip(rbins[:-1], rbins[1:])):
+                try:
+                    mask = self.get_mask(r_min=r_min, r_max=r_max,
+                                         inc=geometry[i, 0],
+                                         PA=geometry[i, 1],
+                                         user_mask=user_mask, **surface)
+                except ValueError:
+                    mask = np.zeros(self.data.shape, dtype=bool)
+                mask &= np.isfinite(self.data) & np.isfinite(self.error)
+                pix = np.flatnonzero(mask)
+                pixels += [pix]
+                rings += [(x_sky[pix], y_sky[pix], data[pix], error[pix],
+                           geometry[i])]
+            if pool is not None:
+                results = list(pool.map(func, rings))
+            else:
+                results = [func(ring) for ring in rings]
+            fits = np.array([r[0] for r in results])
+            dfits = np.array([r[1] for r in results])
+            geometry = np.where(np.isfinite(fits), fits, geometry)
+
+        # Build the model from the pixels of each ring.
+
+        model = np.full(self.data.size, np.nan)
+        for pix, ring, popt in zip(pixels, rings, fits):
+            if pix.size and np.all(np.isfinite(popt)):
+                model[pix] = rotationmap._tilted_ring_model(
+                    ring[0], ring[1], popt, surface, self._flared_kwargs())
+        model = model.reshape(self.data.shape)
+        fits, dfits = fits.T, dfits.T
+
+        # Make the plots.
+
+        plots = ['profiles', 'model', 'residual'] if plots is None else plots
+        plots = np.atleast_1d(plots)
+        if 'profiles' in plots:
+            self.plot_tilted_ring_profiles(rpnts=rpnts, fits=fits,
+                                           dfits=dfits)
+        if 'model' in plots:
+            self.plot_model(model=model)
+        if 'residual' in plots:
+            self.plot_model_residual(model=model)
+
+        # Generate the returns.
+
+        to_return = []
+        returns = ['profiles'] if returns is None else np.atleast_1d(returns)
+        if 'profiles' in returns:
+            to_return += [rpnts, fits, dfits]
+        if 'model' in returns:
+            to_return += [model]
+        if 'residual' in returns:
+            to_return += [self.data - model]
+        return to_return
+
+    @staticmethod
+    def _tilted_ring_model(x_sky, y_sky, popt, surface, flared_kwargs=None):
+        """Projected velocities of the pixels at ``x_sky, y_sky`` of a ring."""
+        inc, PA, vrot, vrad, vlsr = popt
+        tvals = datacube._batch_sky_to_disk(
+            x_sky, y_sky, inc=inc, PA=PA, flared_kwargs=flared_kwargs,
+            **surface)[1][0]
+        v0 = vrot * np.cos(tvals) * np.sin(abs(np.radians(inc)))
+        return v0 - vrad * np.sin(tvals) * np.sin(np.radians(inc)) + vlsr
+
+    @staticmethod
+    def _fit_tilted_ring(ring, surface, PA, flared_kwargs=None,
+                         fit_vrad=False, fix_vlsr=None, optimize_kwargs=None):
+        """
+        Fit a single ring for :func:`fit_tilted_rings`, where ``ring`` holds
+        the sky coordinates, values and uncertainties of its pixels and the
+        starting ``[inc, PA, v_phi, v_r, v_lsr]``. Returns the best-fit values
+        and their uncertainties, or NaNs if the fit failed.
+        """
+        from scipy.optimize import curve_fit
+
+        x_sky, y_sky, y, dy, p0 = ring
+        free = [True, True, True, fit_vrad, fix_vlsr is None]
+        empty = np.full(5, np.nan)
+        if y.size <= sum(free):
+            return empty, empty
+
+        # Starting positions and bounds. The rotation velocity is estimated
+        # from the range of projected velocities if not yet known.
+
+        p0 = np.array(p0, dtype=float)
+        if not np.isfinite(p0[2]):
+            p0[2] = 0.5 * (y.max() - y.min())
+            p0[2] /= max(abs(np.sin(np.radians(p0[0]))), 0.1)
+        sign = -1.0 if p0[0] < 0.0 else 1.0
+        lo = [min(0.0, sign * 90.0), PA - 180.0, 0.0, -np.inf, -np.inf]
+        hi = [max(0.0, sign * 90.0), PA + 180.0, np.inf, np.inf, np.inf]
+        p0 = np.clip(p0, lo, hi)
+
+        def func(_, *theta):
+            popt = p0.copy()
+            popt[free] = theta
+            return rotationmap._tilted_ring_model(x_sky, y_sky, popt, surface,
+                                                  flared_kwargs)
+
+        kw = {} if optimize_kwargs is None else optimize_kwargs.copy()
+        kw['p0'] = p0[free]
+        kw['sigma'] = dy
+        kw['absolute_sigma'] = True
+        kw['bounds'] = (np.array(lo)[free], np.array(hi)[free])
+        kw['max_nfev'] = kw.pop('max_nfev', 10000)
+
+        try:
+            popt, cvar = curve_fit(func, x_sky, y, **kw)
+        except (RuntimeError, ValueError):
+            return empty, empty
+        fits, dfits = p0.copy(), np.zeros(5)
+        fits[free], dfits[free] = popt, np.diag(cvar)**0.5
+        return fits, dfits
+
     def set_prior(self, param, args, type='flat'):
         """
         Set the prior for the given parameter. There are two types of priors
@@ -757,18 +1483,7 @@ class rotationmap(datacube):
             args (list): Values to use depending on the type of prior.
             type (optional[str]): Type of prior to use.
         """
-        type = type.lower()
-        if type not in ['flat', 'gaussian']:
-            raise ValueError("type must be 'flat' or 'gaussian'.")
-        if type == 'flat':
-            def prior(p):
-                if not min(args) <= p <= max(args):
-                    return -np.inf
-                return max(-100.0, np.log(1.0 / (max(args) - min(args))))
-        else:
-            def prior(p):
-                return -0.5 * ((args[0] - p) / args[1])**2
-        rotationmap.priors[param] = prior
+        self.priors[param] = rotationmap._verify_prior(args, type)
 
     def set_SHO_prior(self, param, args, type='flat'):
         """
@@ -783,18 +1498,66 @@ class rotationmap(datacube):
             args (list): Values to use depending on the type of prior.
             type (optional[str]): Type of prior to use.
         """
+        self.SHO_priors[param] = rotationmap._verify_prior(args, type)
+
+    @staticmethod
+    def _verify_prior(args, type='flat'):
+        """Check the prior values and return a picklable (type, args) pair."""
         type = type.lower()
         if type not in ['flat', 'gaussian']:
             raise ValueError("type must be 'flat' or 'gaussian'.")
+        args = [float(a) for a in np.atleast_1d(args)]
+        if len(args) != 2:
+            raise ValueError("Priors must be specified by two values.")
         if type == 'flat':
-            def prior(p):
-                if not min(args) <= p <= max(args):
-                    return -np.inf
-                return np.log(1.0 / (args[1] - args[0]))
-        else:
-            def prior(p):
-                return -0.5 * ((args[0] - p) / args[1])**2
-        rotationmap.SHO_priors[param] = prior
+            args = [min(args), max(args)]
+        elif args[1] <= 0.0:
+            raise ValueError("Gaussian prior must have a positive width.")
+        return type, args
+
+    @staticmethod
+    def _build_prior_plan(priors, names, lnmin=-100.0):
+        """
+        Convert the priors for the parameters in ``names`` into arrays such
+        that they can be evaluated for a whole vector of values at once.
+        Parameters without a prior are given an unbounded flat prior which
+        does not contribute to the log-prior.
+
+        Args:
+            priors (dict): Dictionary of (type, args) pairs.
+            names (list): Names of the parameters, in the order of ``theta``.
+            lnmin (Optional[float]): Minimum log-prior for flat priors.
+
+        Returns:
+            prior_plan (tuple): Arrays of the lower and upper bounds, the
+                indices, means and inverse widths of the Gaussian priors and
+                the constant flat log-prior term.
+        """
+        lo = np.full(len(names), -np.inf)
+        hi = np.full(len(names), np.inf)
+        gidx, mu, isig = [], [], []
+        lnnorm = 0.0
+        for i, name in enumerate(names):
+            if name not in priors:
+                continue
+            type, args = priors[name]
+            if type == 'flat':
+                lo[i], hi[i] = args
+                lnnorm += max(lnmin, -np.log(args[1] - args[0]))
+            else:
+                gidx += [i]
+                mu += [args[0]]
+                isig += [1.0 / args[1]]
+        return lo, hi, np.array(gidx, dtype=int), np.array(mu), \
+            np.array(isig), lnnorm
+
+    @staticmethod
+    def _eval_prior_plan(theta, prior_plan):
+        """Evaluate the log-prior of ``theta`` for a given prior plan."""
+        lo, hi, gidx, mu, isig, lnnorm = prior_plan
+        if np.any(theta < lo) or np.any(theta > hi):
+            return -np.inf
+        return lnnorm - 0.5 * np.sum(((theta[gidx] - mu) * isig)**2)
 
     def plot_data(self, vmin=None, vmax=None, ivar=None, return_fig=False):
         """
@@ -814,6 +1577,7 @@ class rotationmap(datacube):
         """
         import matplotlib.pyplot as plt
         fig, ax = plt.subplots()
+        data = self.rasterize(self.data)
     
         if vmin is None or vmax is None:
             vmin_tmp, vmax_tmp = np.nanpercentile(self.data, [2, 98])
@@ -825,7 +1589,7 @@ class rotationmap(datacube):
             if vmax is None:
                 vmax = vmax_tmp
 
-        im = ax.imshow(self.data / 1e3, origin='lower', extent=self.extent,
+        im = ax.imshow(data / 1e3, origin='lower', extent=self.extent,
                        vmin=vmin, vmax=vmax,
                        cmap=rotationmap.cmap(), zorder=-9)
         cb = plt.colorbar(im, pad=0.03, extend='both', format='%.2f')
@@ -833,6 +1597,7 @@ class rotationmap(datacube):
         cb.set_label(r'${\rm v_{0} \quad (km\,s^{-1})}$',
                      rotation=270, labelpad=15)
         if ivar is not None:
+            ivar = self.rasterize(ivar, fill_value=0.0)
             ax.contour(self.xaxis, self.yaxis, ivar,
                        [0.0], colors='k')
             ax.contourf(self.xaxis, self.yaxis, ivar,
@@ -841,18 +1606,238 @@ class rotationmap(datacube):
         if return_fig:
             return fig
 
-    # -- MCMC Functions -- #
+    # -- GEOMETRY SEARCH -- #
 
-    def _optimize_p0(self, theta, params, **kwargs):
-        """Optimize the initial starting positions."""
-        from scipy.optimize import minimize
+    _search_params = ('x0', 'y0', 'inc', 'PA')
+
+    def search_p0(self, p0, params, ranges=None, npts=10000, method='lhs',
+                  nbest=1, batch_size=64, pool=None):
+        """
+        Scan the geometrical parameters, ``x0``, ``y0``, ``inc`` and ``PA``, to
+        find starting positions for :func:`fit_map`. For each geometry the
+        chi-squared of the masked pixels is calculated with ``vlsr`` and the
+        amplitude of the rotation curve, ``mstar`` for a Keplerian profile
+        without a disk mass or ``vp_100`` for a power-law profile, solved for
+        with weighted least squares if they are free parameters. Only the
+        geometrical parameters therefore need to be scanned. Batches of
+        ``batch_size`` geometries are evaluated at once and can be distributed
+        with ``pool.map``.
+
+        Beam convolution and any vortex component are neglected and the mask
+        is calculated once using ``p0``. The runtime scales with the number of
+        pixels, so for a quick search use a block averaged map, see
+        :func:`set_resolution`, or a compacted map, see :func:`compact_map`.
+
+        Args:
+            p0 (list): Starting positions, as for :func:`fit_map`.
+            params (dict): Dictionary of the model parameters, as for
+                :func:`fit_map`.
+            ranges (Optional[dict]): The ``(min, max)`` range to scan for each
+                of the free geometrical parameters. By default ``x0`` and
+                ``y0`` span one beam major axis either side of ``p0``, ``inc``
+                spans 5 to 85 degrees with the sign of ``p0`` and ``PA``
+                spans 180 degrees either side of ``p0``, all limited to the
+                flat prior bounds.
+            npts (Optional[int]): Number of geometries to evaluate. For
+                ``method='grid'`` the number of points along each axis is
+                ``npts**(1 / nparams)``, rounded to the nearest integer.
+            method (Optional[str]): Either ``'lhs'`` for a Latin hypercube
+                sample of the ranges or ``'grid'`` for a regular grid.
+            nbest (Optional[int]): Number of candidates to return.
+            batch_size (Optional[int]): Number of geometries to evaluate at
+                once. Memory usage scales with ``batch_size`` times the
+                number of pixels in the mask.
+            pool (Optional): An object with a ``map`` method.
+
+        Returns:
+            p0 (ndarray): The ``(nbest, ndim)`` best starting positions,
+                ordered by increasing chi-squared.
+        """
+        params = self.verify_params_dictionary(params.copy())
+        p0 = np.atleast_1d(np.squeeze(p0)).astype(float)
+        self.ivar = self._calc_ivar(rotationmap._populate_dictionary(p0,
+                                                                     params))
+        return self._search_p0(p0, params, ranges=ranges, npts=npts,
+                               method=method, nbest=nbest,
+                               batch_size=batch_size, pool=pool)
+
+    def _search_p0(self, p0, params, linear=(), ranges=None, npts=10000,
+                   method='lhs', nbest=1, batch_size=64, pool=None):
+        """
+        Run :func:`search_p0` for a verified ``params`` dictionary. Any
+        ``linear`` parameters, from :func:`_check_linear`, are also solved for
+        in the search but are not included in the returned positions.
+        """
+        p0 = np.atleast_1d(np.squeeze(p0)).astype(float)
+        model = rotationmap._populate_dictionary(p0, params)
+        t0 = time.time()
+
+        def is_free(key):
+            return isinstance(params.get(key, None), int) and \
+                not isinstance(params[key], bool)
+
+        # Build the parameter ranges.
+
+        ranges = {} if ranges is None else dict(ranges)
+        keys = [k for k in rotationmap._search_params if is_free(k)]
+        for key in ranges:
+            if key not in keys:
+                raise ValueError("Can only search the free geometrical "
+                                 + "parameters: {}.".format(keys))
+        if not len(keys):
+            raise ValueError("No free geometrical parameters to search.")
+        lo, hi = rotationmap._build_prior_plan(self.priors, keys)[:2]
+        for i, key in enumerate(keys):
+            if key in ranges:
+                lo[i], hi[i] = ranges[key]
+                continue
+            value = model[key]
+            if key in ['x0', 'y0']:
+                width = np.array([-1.0, 1.0]) * self.bmaj
+            elif key == 'inc':
+                value, width = 0.0, np.array([5.0, 85.0])
+                width *= -1.0 if model['inc'] < 0.0 else 1.0
+            else:
+                width = np.array([-180.0, 180.0])
+            lo[i] = max(lo[i], min(value + width))
+            hi[i] = min(hi[i], max(value + width))
+        if np.any(~np.isfinite(lo)) or np.any(~np.isfinite(hi)) or \
+                np.any(hi < lo):
+            raise ValueError("Invalid search ranges.")
+
+        # Generate the geometries.
+
+        npts, ndim = int(npts), len(keys)
+        if method == 'grid':
+            n = max(int(round(npts**(1.0 / ndim))), 1)
+            axes = [np.linspace(low, high, n) for low, high in zip(lo, hi)]
+            axes = np.meshgrid(*axes, indexing='ij')
+            geometries = np.stack([a.ravel() for a in axes], axis=1)
+        elif method == 'lhs':
+            u = np.argsort(np.random.rand(ndim, npts), axis=1).T
+            u = (u + np.random.rand(npts, ndim)) / npts
+            geometries = lo[None, :] + u * (hi - lo)[None, :]
+        else:
+            raise ValueError("`method` must be 'lhs' or 'grid'.")
+
+        # Determine which velocity parameters to solve for.
 
-        # TODO: implement bounds.
+        vfunc = getattr(params['vfunc'], '__func__', None)
+        if vfunc is rotationmap._vpow:
+            amp = 'vp_100'
+        elif vfunc is rotationmap._vkep and params['mdisk'] is None:
+            amp = 'mstar'
+        else:
+            amp = None
+        if amp is not None and not (is_free(amp) or amp in linear):
+            amp = None
+        pix = np.flatnonzero(self.mask)
+        plan = dict(model=model, keys=keys, pix=pix,
+                    data=self.data.ravel()[pix], ivar=self.ivar.ravel()[pix],
+                    amp=amp, vlsr=is_free('vlsr') or 'vlsr' in linear)
+
+        # Evaluate the batches and rank the results.
+
+        nbatch = int(np.ceil(geometries.shape[0] / float(batch_size)))
+        batches = np.array_split(geometries, nbatch)
+        func = functools.partial(self._search_batch, plan=plan)
+        if pool is not None:
+            results = list(pool.map(func, batches))
+        else:
+            results = [func(batch) for batch in batches]
+        chi2, vlsr, amps = [np.concatenate(r) for r in zip(*results)]
+        idx = np.argsort(chi2)[:int(nbest)]
+
+        # Build the starting positions.
+
+        theta = np.repeat(p0[None, :], idx.size, axis=0)
+        for i, key in enumerate(keys):
+            theta[:, params[key]] = geometries[idx, i]
+        if plan['vlsr'] and is_free('vlsr'):
+            theta[:, params['vlsr']] = vlsr[idx]
+        if amp is not None and is_free(amp):
+            theta[:, params[amp]] = amps[idx]**2 if amp == 'mstar' \
+                else amps[idx]
+        print("Searched %d geometries in %.1f seconds." %
+              (geometries.shape[0], time.time() - t0))
+        print('\tp0 =', ['%.2e' % t for t in theta[0]])
+        return theta
+
+    def _search_batch(self, geometries, plan):
+        """
+        Evaluate the chi-squared for a batch of geometries, solving for the
+        velocity parameters in ``plan``. Returns the chi-squared values and
+        the best-fit ``vlsr`` and rotation amplitudes, where the amplitude is
+        the square root of ``mstar`` for a Keplerian profile.
+        """
+        model = plan['model']
+        model = dict(model, **dict(zip(plan['keys'], geometries.T)))
+        rvals, tvals, zvals = self._batch_disk_coords(pix=plan['pix'], **model)
+        model['inc'] = np.reshape(model['inc'], (-1, 1))
+        if plan['amp'] is not None:
+            model[plan['amp']] = 1.0
+        v = model['vfunc'](rvals, tvals, zvals, model)
+        v = self._proj_vphi(v, tvals, model)
+
+        # Pixels where the model is not defined, e.g. the disk center, are
+        # given zero weight.
+
+        w = np.where(np.isfinite(v), plan['ivar'][None, :], 0.0)
+        v = np.where(np.isfinite(v), v, 0.0)
+        d = plan['data'][None, :]
+        if not plan['vlsr']:
+            d = d - model['vlsr']
+
+        Sw, Sd, Sdd = np.sum(w, axis=1), np.sum(w * d, axis=1), \
+            np.sum(w * d * d, axis=1)
+        if plan['amp'] is None:
+            a = np.ones(v.shape[0])
+            if plan['vlsr']:
+                c = (Sd - np.sum(w * v, axis=1)) / Sw
+            else:
+                c = np.zeros(v.shape[0])
+            chi2 = np.sum(w * (d - v - c[:, None])**2, axis=1)
+        else:
+            Sb, Sbb = np.sum(w * v, axis=1), np.sum(w * v * v, axis=1)
+            Sbd = np.sum(w * v * d, axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                if plan['vlsr']:
+                    det = Sw * Sbb - Sb * Sb
+                    a = (Sw * Sbd - Sb * Sd) / det
+                    c = (Sbb * Sd - Sb * Sbd) / det
+                    chi2 = Sdd - a * Sbd - c * Sd
+                else:
+                    a = Sbd / Sbb
+                    c = np.zeros(v.shape[0])
+                    chi2 = Sdd - a * Sbd
+            chi2 = np.where(a > 0.0, chi2, np.inf)
+        if not plan['vlsr']:
+            c = c + model['vlsr']
+        chi2 = np.where(np.isfinite(chi2), chi2, np.inf)
+        return chi2, c, a
+
+    # -- MCMC Functions -- #
+
+    def _optimize_p0(self, theta, params, linear=None, nstarts=1, pool=None,
+                     **kwargs):
+        """
+        Optimize the initial starting positions. The optimization is bounded
+        by the flat priors and, where :func:`_has_analytic_gradient` allows,
+        uses the analytic gradient of the log-probability rather than finite
+        differences. If ``nstarts > 1``, additional starting positions are
+        scattered about ``theta`` by ``start_scatter`` (relative) and the best
+        result is kept. These are distributed with ``pool.map`` if provided.
+        If ``theta`` is two dimensional, e.g. the candidates from
+        :func:`search_p0`, each row is used as a starting position.
+        """
         # TODO: cycle through parameters one at a time for a better fit.
 
-        # Negative log-likelihood function.
-        def nlnL(theta):
-            return -self._ln_probability(theta, params)
+        plan = self._compile_model_plan(params, linear)
+        jac = self._has_analytic_gradient(plan)
+        lo, hi = plan['prior'][:2]
+        bounds = [(low if np.isfinite(low) else None,
+                   high if np.isfinite(high) else None)
+                  for low, high in zip(lo, hi)]
 
         method = kwargs.pop('method', 'TNC')
         options = kwargs.pop('options', {})
@@ -860,8 +1845,26 @@ class rotationmap(datacube):
         options['maxfun'] = options.pop('maxfun', 10000)
         options['ftol'] = options.pop('ftol', 1e-3)
 
-        res = minimize(nlnL, x0=theta, method=method, options=options)
-        if res.success:
+        # Starting positions, clipped to lie within the bounds.
+
+        starts = np.atleast_2d(theta).astype(float)
+        theta = starts[0]
+        if nstarts > starts.shape[0]:
+            scatter = kwargs.pop('start_scatter', 0.05)
+            scatter = random_p0(theta, scatter, nstarts - starts.shape[0])
+            starts = np.vstack([starts, scatter])
+        starts = np.clip(starts, lo, hi)
+
+        func = functools.partial(self._minimize_from, plan=plan, jac=jac,
+                                 bounds=bounds, method=method, options=options)
+        if pool is not None and starts.shape[0] > 1:
+            results = list(pool.map(func, starts))
+        else:
+            results = [func(start) for start in starts]
+
+        results = [res for res in results if res.success]
+        if len(results):
+            res = min(results, key=lambda res: res.fun)
             theta = res.x
             print("Optimized starting positions:")
         else:
@@ -871,56 +1874,398 @@ class rotationmap(datacube):
         time.sleep(0.3)
         return theta
 
-    def _run_mcmc(self, p0, params, nwalkers, nburnin, nsteps, mcmc, **kwargs):
-        """Run the MCMC sampling. Returns the sampler."""
-
+    def _minimize_from(self, theta, plan, jac, bounds, method, options):
+        """Minimize the negative log-probability from ``theta``."""
+        from scipy.optimize import minimize
+        if jac:
+            def nlnL(theta):
+                lnp, grad = self._ln_probability_grad(theta, plan)
+                return -lnp, -grad
+        else:
+            def nlnL(theta):
+                return -self._ln_probability(theta, plan)
+        return minimize(nlnL, x0=theta, jac=jac, bounds=bounds, method=method,
+                        options=dict(options))
+
+    def _run_mcmc(self, p0, params, nwalkers, nburnin, nsteps, mcmc,
+                  checkpoint=None, level=0, start=0, checkpoint_every=100,
+                  checkpoint_state=None, linear=None, **kwargs):
+        """
+        Run the MCMC sampling. Returns the sampler. If ``checkpoint`` is
+        provided the chains are written to disk with :func:`run_checkpointed`,
+        continuing from step ``start``, rather than kept in the sampler. Any
+        values in ``checkpoint_state`` are saved with the checkpoint.
+        """
         if mcmc == 'zeus':
-            EnsembleSampler = zeus.EnsembleSampler
+            from zeus import EnsembleSampler
         else:
-            EnsembleSampler = emcee.EnsembleSampler
+            from emcee import EnsembleSampler
 
-        p0 = random_p0(p0, kwargs.pop('scatter', 1e-3), nwalkers)
+        scatter = kwargs.pop('scatter', 1e-3)
+        if np.ndim(p0) == 1:
+            p0 = random_p0(p0, scatter, nwalkers)
         moves = kwargs.pop('moves', None)
         pool = kwargs.pop('pool', None)
 
         sampler = EnsembleSampler(nwalkers,
                                   p0.shape[1],
                                   self._ln_probability,
-                                  args=[params, np.nan],
+                                  args=[self._compile_model_plan(params,
+                                                                 linear)],
                                   moves=moves,
                                   pool=pool)
 
         progress = kwargs.pop('progress', True)
 
-        sampler.run_mcmc(p0, nburnin + nsteps, progress=progress, **kwargs)
+        if checkpoint is None:
+            sampler.run_mcmc(p0, nburnin + nsteps, progress=progress, **kwargs)
+        else:
+            run_checkpointed(sampler, p0, nburnin + nsteps, checkpoint,
+                             level=level, start=start, every=checkpoint_every,
+                             progress=progress, state=checkpoint_state,
+                             **kwargs)
 
         return sampler
 
-    def _ln_likelihood(self, params):
+    def _compile_model_plan(self, params, linear=None):
+        """
+        Compile a verified parameter dictionary into a plan for the likelihood
+        calls such that the bookkeeping is done once, rather than for every
+        sample. This splits the free parameters, in the order of ``theta``,
+        from the fixed parameters (including the resolved ``vfunc`` and
+        ``vortex`` flags from :func:`verify_params_dictionary`), builds the
+        vectorized priors and extracts the data and inverse variances of the
+        pixels in the mask.
+
+        Note that this uses the current ``ivar`` so must be recompiled if the
+        mask or the resolution of the data changes.
+
+        Args:
+            params (dict): Verified dictionary of model parameters.
+            linear (optional[tuple]): The linear parameters and method from
+                :func:`_check_linear`.
+
+        Returns:
+            plan (dict): The compiled model plan to pass to
+                :func:`_ln_probability`.
+        """
+        free = {}
+        for key in params.keys():
+            if isinstance(params[key], int) and \
+                    not isinstance(params[key], bool):
+                free[params[key]] = key
+        keys = tuple(free[i] for i in sorted(free))
+        fixed = {k: v for k, v in params.items() if k not in keys}
+        prior, lnp_fixed = self._prior_plan(params)
+        pix = np.flatnonzero(self.mask)
+        linear, method = ((), None) if linear is None else linear
+        bounds = rotationmap._build_prior_plan(self.priors, linear)[:2]
+        return dict(keys=keys, fixed=fixed, prior=prior, lnp_fixed=lnp_fixed,
+                    pix=pix, data=self.data.ravel()[pix],
+                    ivar=self.ivar.ravel()[pix], linear=tuple(linear),
+                    linear_method=method, linear_bounds=bounds)
+
+    # Placeholder values of the linear parameters used to build the basis.
+
+    _linear_placeholders = {'vlsr': 0.0, 'vp_100': 1.0}
+
+    @staticmethod
+    def _check_linear(params, linear=None, method='marginalize'):
+        """Verify ``linear``. Returns ``None`` or (names, method)."""
+        if linear is None:
+            return None
+        linear = tuple(np.atleast_1d(linear).tolist())
+        for p in linear:
+            if p not in rotationmap._linear_placeholders:
+                raise ValueError("Only 'vlsr' and 'vp_100' can be linear.")
+            if isinstance(params.get(p, None), int) and \
+                    not isinstance(params[p], bool):
+                raise ValueError("Linear parameter `{}` must not be ".format(p)
+                                 + "included in `p0`.")
+        if 'vp_100' in linear:
+            if params.get('vp_q', None) is None or 'mstar' in params:
+                raise ValueError("`vp_100` can only be linear for a power-law "
+                                 + "rotation profile, requiring `vp_q` and "
+                                 + "no `mstar`.")
+        if method not in ['marginalize', 'profile']:
+            raise ValueError("`linear_method` must be 'marginalize' or "
+                             + "'profile'.")
+        return linear, method
+
+    def _solve_linear(self, params, plan):
+        """
+        Solve for the linear parameters with weighted least squares. The model
+        is written as ``v = offset + X^T beta`` where ``X`` contains a constant
+        for ``'vlsr'`` and the rotation model with ``vp_100 = 1`` for
+        ``'vp_100'``. The constant offset is only evaluated as a separate
+        model if there is a vortex component.
+
+        Args:
+            params (dict): Model parameters including the placeholder values.
+            plan (dict): Compiled model plan.
+
+        Returns:
+            chi2, beta, F (float, ndarray, ndarray): The minimum chi-squared,
+                the best-fit linear parameters and their Fisher matrix.
+        """
+        v1 = self._make_model(params).ravel()[plan['pix']]
+        basis = {'vlsr': np.ones(v1.size)}
+        if 'vp_100' in plan['linear']:
+            if params['vortex']:
+                v0 = dict(params, vp_100=0.0)
+                v0 = self._make_model(v0).ravel()[plan['pix']]
+            else:
+                v0 = params['vlsr']
+            basis['vp_100'] = v1 - v0
+        else:
+            v0 = v1
+        X = np.array([basis[p] for p in plan['linear']])
+        residual = plan['data'] - v0
+        XW = X * plan['ivar'][None, :]
+        F, b = np.dot(XW, X.T), np.dot(XW, residual)
+        try:
+            beta = np.linalg.solve(F, b)
+        except np.linalg.LinAlgError:
+            return np.inf, np.full(b.size, np.nan), F
+        chi2 = np.sum(plan['ivar'] * residual * residual) - np.dot(b, beta)
+        return chi2, beta, F
+
+    def _sample_linear(self, samples, params, linear):
+        """
+        Draw the linear parameters from their Gaussian conditional posteriors
+        for each of the samples and append them to the samples.
+        """
+        plan = self._compile_model_plan(params, linear)
+        draws = []
+        for theta in samples:
+            model = plan['fixed'].copy()
+            model.update(zip(plan['keys'], theta))
+            _, beta, F = self._solve_linear(model, plan)
+            try:
+                L = np.linalg.cholesky(np.linalg.inv(F))
+                draws += [beta + np.dot(L, np.random.randn(beta.size))]
+            except np.linalg.LinAlgError:
+                draws += [np.full(beta.size, np.nan)]
+        return np.hstack([samples, draws])
+
+    def _ln_likelihood(self, params, plan=None):
         """Log-likelihood function. Simple chi-squared likelihood."""
+        if plan is not None and len(plan['linear']):
+            chi2, beta, F = self._solve_linear(params, plan)
+            if np.any(beta < plan['linear_bounds'][0]) or \
+                    np.any(beta > plan['linear_bounds'][1]):
+                return -np.inf
+            lnx2 = -0.5 * chi2
+            if plan['linear_method'] == 'marginalize':
+                lnx2 -= 0.5 * np.linalg.slogdet(F)[1]
+            return lnx2 if np.isfinite(lnx2) else -np.inf
         model = self._make_model(params)
-        lnx2 = np.where(self.mask, np.power((self.data - model), 2), 0.0)
-        lnx2 = -0.5 * np.sum(lnx2 * self.ivar)
+        if plan is not None:
+            lnx2 = plan['data'] - model.ravel()[plan['pix']]
+            lnx2 = -0.5 * np.sum(plan['ivar'] * lnx2 * lnx2)
+        else:
+            lnx2 = np.where(self.mask, np.power((self.data - model), 2), 0.0)
+            lnx2 = -0.5 * np.sum(lnx2 * self.ivar)
         return lnx2 if np.isfinite(lnx2) else -np.inf
 
-    def _ln_probability(self, theta, *params_in):
+    def _ln_probability(self, theta, plan):
         """Log-probablility function."""
-        model = rotationmap._populate_dictionary(theta, params_in[0])
-        lnp = self._ln_prior(model)
+        lnp = rotationmap._eval_prior_plan(np.asarray(theta), plan['prior'])
+        lnp += plan['lnp_fixed']
         if np.isfinite(lnp):
-            return lnp + self._ln_likelihood(model)
+            model = plan['fixed'].copy()
+            model.update(zip(plan['keys'], theta))
+            return lnp + self._ln_likelihood(model, plan)
         return -np.inf
 
+    # Parameters for which the analytic gradient of the model is implemented.
+
+    _gradient_params = ('x0', 'y0', 'inc', 'PA', 'mstar', 'dist', 'vlsr',
+                        'z0', 'psi')
+
+    def _has_analytic_gradient(self, plan):
+        """
+        Whether :func:`_model_gradient` supports the compiled model, i.e. a
+        Keplerian rotation curve without a disk mass, a midplane or tapered
+        power-law emission surface which is not shadowed or tabulated, no beam
+        convolution and no vortex. Only ``vlsr`` can be a linear parameter.
+        """
+        fixed = plan['fixed']
+        if any(k not in rotationmap._gradient_params for k in plan['keys']):
+            return False
+        if plan['linear'] not in [(), ('vlsr',)]:
+            return False
+        if getattr(fixed['vfunc'], '__func__', None) is not rotationmap._vkep:
+            return False
+        if fixed['beam'] or fixed['vortex'] or fixed['shadowed']:
+            return False
+        if fixed.get('mdisk', None) is not None:
+            return False
+        if fixed['z_func'] is not None or self.z_func_tabulate:
+            return False
+        z0, psi = fixed.get('z0', 0), fixed.get('psi', 0)
+        return (z0 is None) == (psi is None)
+
+    def _model_gradient(self, params, plan):
+        """
+        Evaluate the model and its gradient with respect to the free
+        parameters for the pixels in the plan. This follows the chain rule
+        through the midplane deprojection, the implicit solution of the flared
+        surface, ``y = y_mid + z(r) * tan(inc)``, and :func:`_vkep`, so is only
+        valid for models passing :func:`_has_analytic_gradient`. For binned
+        maps with ``average_model``, the model and its derivatives are
+        evaluated on the pixels of each bin and averaged with the same
+        weights as the data.
+
+        Args:
+            params (dict): Model parameters.
+            plan (dict): Compiled model plan.
+
+        Returns:
+            v, dv (ndarray, ndarray): The model velocities for the masked
+                pixels and their derivatives, shaped ``(nfree, npix)``.
+        """
+        deg = np.pi / 180.0
+        average = self._pix_average and self._pix_bins is not None
+        if average:
+            x_sky = self.xaxis[self._pix_idx[1]] - params['x0']
+            y_sky = self.yaxis[self._pix_idx[0]] - params['y0']
+        else:
+            x_sky, y_sky = self._get_cart_sky_coords(params['x0'],
+                                                     params['y0'])
+            x_sky = np.ravel(x_sky)[plan['pix']]
+            y_sky = np.ravel(y_sky)[plan['pix']]
+        inc = params['inc'] if params['inc'] < 90.0 else params['inc'] - 180.0
+        cosPA, sinPA = np.cos(params['PA'] * deg), np.sin(params['PA'] * deg)
+        cosi, tani = np.cos(inc * deg), np.tan(inc * deg)
+
+        # Midplane coordinates and their derivatives, (dx_mid, dy_mid).
+
+        x_mid = y_sky * cosPA + x_sky * sinPA
+        y_rot = x_sky * cosPA - y_sky * sinPA
+        y_mid = y_rot / cosi
+        dmid = {'x0': (-sinPA, -cosPA / cosi),
+                'y0': (-cosPA, sinPA / cosi),
+                'PA': (y_rot * deg, -x_mid * deg / cosi),
+                'inc': (0.0, y_mid * tani * deg)}
+
+        # Emission surface. The derivatives of y follow from the implicit
+        # function theorem applied to F = y_mid + z(r) * tan(inc) - y.
+
+        zero = np.zeros(x_mid.size)
+        if params['z0'] is None:
+            y, z, dzdr, dzdp = y_mid, zero, zero, {}
+        else:
+            z_func = datacube._get_power_law_z_func(
+                z0=params['z0'], psi=params['psi'],
+                r_cavity=params['r_cavity'], r_taper=params['r_taper'],
+                q_taper=params['q_taper'])
+            y, self.flared_stats = datacube._solve_flared_surface(
+                x_mid=x_mid, y_mid=y_mid, z_func=z_func, tan_inc=tani,
+                **self._flared_kwargs())
+            rr = np.clip(np.hypot(x_mid, y) - (params['r_cavity'] or 0.0),
+                         a_min=0.0, a_max=None)
+            base = rr**params['psi']
+            taper = params['r_taper'] is not None
+            taper = taper and np.isfinite(params['r_taper'])
+            if taper:
+                rt = (rr / params['r_taper'])**params['q_taper']
+                base = base * np.exp(-rt)
+            else:
+                rt = zero
+            z = params['z0'] * base
+            with np.errstate(divide='ignore', invalid='ignore'):
+                dzdr = params['psi'] - params['q_taper'] * rt * taper
+                dzdr = np.where(rr > 0.0, z * dzdr / rr, 0.0)
+                dzdp = {'z0': base,
+                        'psi': np.where(rr > 0.0, z * np.log(rr), 0.0)}
+
+        r = np.hypot(x_mid, y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dFdy = dzdr * tani * y / r - 1.0
+
+        # Rotation velocity, v = A * sin|i| * x * (r^2 + z^2)^(-3/4).
+
+        A = np.sqrt(sc.G * params['mstar'] * self.msun
+                    / sc.au / params['dist'])
+        sini = np.sin(abs(params['inc'] * deg))
+        S = r * r + z * z
+        with np.errstate(divide='ignore', invalid='ignore'):
+            u = x_mid * S**-0.75
+        vrot = A * sini * u
+
+        dv = []
+        for key in plan['keys']:
+            if key == 'mstar':
+                dv += [0.5 * vrot / params['mstar']]
+            elif key == 'dist':
+                dv += [-0.5 * vrot / params['dist']]
+            elif key == 'vlsr':
+                dv += [np.ones(vrot.size)]
+            else:
+                dx, dym = dmid.get(key, (0.0, 0.0))
+                dF = dym + tani * dzdr * x_mid * dx / r
+                dF = dF + tani * dzdp.get(key, 0.0)
+                if key == 'inc':
+                    dF = dF + z * deg / cosi**2
+                dy = dym if params['z0'] is None else -dF / dFdy
+                dr = (x_mid * dx + y * dy) / r
+                dS = 2.0 * r * dr + 2.0 * z * (dzdr * dr + dzdp.get(key, 0.0))
+                du = dx * S**-0.75 - 0.75 * x_mid * S**-1.75 * dS
+                dvk = A * sini * du
+                if key == 'inc':
+                    dvk = dvk + A * u * np.sign(params['inc']) \
+                        * np.cos(params['inc'] * deg) * deg
+                dv += [dvk]
+        v, dv = vrot + params['vlsr'], np.atleast_2d(dv)
+        if average:
+            finite = np.isfinite(v)
+            dv = [self._bin_average(d, finite)[plan['pix']] for d in dv]
+            v, dv = self._bin_average(v)[plan['pix']], np.atleast_2d(dv)
+        return v, dv
+
+    def _ln_probability_grad(self, theta, plan):
+        """
+        Log-probability function and its gradient with respect to ``theta``.
+        Equivalent to :func:`_ln_probability` for models which pass
+        :func:`_has_analytic_gradient`. As the Fisher matrix of a linear
+        ``vlsr`` does not depend on the other parameters, both methods of
+        handling it share the same gradient.
+        """
+        theta = np.asarray(theta, dtype=float)
+        grad = np.zeros(theta.size)
+        lo, hi, gidx, mu, isig, _ = plan['prior']
+        lnp = rotationmap._eval_prior_plan(theta, plan['prior'])
+        lnp += plan['lnp_fixed']
+        if not np.isfinite(lnp):
+            return -np.inf, grad
+        grad[gidx] -= (theta[gidx] - mu) * isig**2
+
+        model = plan['fixed'].copy()
+        model.update(zip(plan['keys'], theta))
+        if len(plan['linear']):
+            model['vlsr'] = rotationmap._linear_placeholders['vlsr']
+        v, dv = self._model_gradient(model, plan)
+        residual = plan['data'] - v
+        if len(plan['linear']):
+            F = np.sum(plan['ivar'])
+            beta = np.sum(plan['ivar'] * residual) / F
+            if beta < plan['linear_bounds'][0][0] or \
+                    beta > plan['linear_bounds'][1][0]:
+                return -np.inf, grad
+            residual = residual - beta
+            if plan['linear_method'] == 'marginalize':
+                lnp -= 0.5 * np.log(F)
+        lnp -= 0.5 * np.sum(plan['ivar'] * residual * residual)
+        grad += np.dot(dv, plan['ivar'] * residual)
+        if not np.isfinite(lnp) or not np.all(np.isfinite(grad)):
+            return -np.inf, np.zeros(theta.size)
+        return lnp, grad
+
     def _load_default_parameters(self, path='default_parameters.yml'):
         """Load the default parameters."""
-        with open(__file__.replace('rotationmap.py', path)) as stream:
-            parameters = yaml.safe_load(stream)
-        for p in parameters.keys():
-            if parameters[p]['prior_type'] is not None:
-                values = parameters[p]['prior_values']
-                if len(values) == 1:
-                    parameters[p]['prior_values'] = [-values[0], values[0]]
-        return parameters
+        path = __file__.replace('rotationmap.py', path)
+        return copy.deepcopy(_read_default_parameters(path))
 
     def print_default_prior(self, parameter):
         """Print the default prior for a given parameter."""
@@ -954,18 +2299,40 @@ class rotationmap(datacube):
         self.set_SHO_prior('vrad', [-1e2, 1e2], 'flat')
         self.set_SHO_prior('vlsr', [-1e4, 1e4], 'flat')
 
+    def _prior_plan(self, params):
+        """
+        Build the vectorized priors for the free parameters in ``params``. Any
+        fixed parameters which have a prior are evaluated once here.
+
+        Args:
+            params (dict): Dictionary of the model parameters where the free
+                parameters are given by their index in ``theta``.
+
+        Returns:
+            prior_plan (tuple): The prior plan for the free parameters (see
+                :func:`_build_prior_plan`) and the constant log-prior from the
+                fixed parameters.
+        """
+        free, fixed = {}, {}
+        for key in params.keys():
+            if isinstance(params[key], int) and \
+                    not isinstance(params[key], bool):
+                free[params[key]] = key
+            elif key in self.priors and params[key] is not None:
+                fixed[key] = params[key]
+        names = [free.get(i, None) for i in range(max(free, default=-1) + 1)]
+        plan = rotationmap._build_prior_plan(self.priors, names)
+        fixed_plan = rotationmap._build_prior_plan(self.priors, list(fixed))
+        values = np.array([fixed[k] for k in fixed], dtype=float)
+        return plan, rotationmap._eval_prior_plan(values, fixed_plan)
+
     def _ln_prior(self, params):
         """Log-priors."""
-        lnp = 0.0
-        for key in params.keys():
-            if key in rotationmap.priors.keys() and params[key] is not None:
-                try:
-                    lnp += rotationmap.priors[key](params[key])
-                except:
-                    print(key, params[key])
-                if not np.isfinite(lnp):
-                    return lnp
-        return lnp
+        names = [k for k in params.keys()
+                 if k in self.priors and params[k] is not None]
+        values = np.array([params[k] for k in names], dtype=float)
+        plan = rotationmap._build_prior_plan(self.priors, names)
+        return rotationmap._eval_prior_plan(values, plan)
 
     def _calc_ivar(self, params):
         """Calculate the inverse variance including radius mask."""
@@ -1072,12 +2439,13 @@ class rotationmap(datacube):
         params['z_func'] = params.pop('z_func', None)
         params['shadowed'] = params.pop('shadowed', False)
         params['user_mask'] = params.pop('user_mask', np.ones(self.data.shape))
+        params['user_mask'] = self._compact_values(params['user_mask'])
 
         return params
 
     def evaluate_models(self, samples=None, params=None, draws=50,
                         collapse_func=np.median, coords_only=False,
-                        profile_only=False):
+                        profile_only=False, batch_size=None):
         """
         Evaluate models based on the samples provided and the parameter
         dictionary. If ``draws`` is an integer, it represents the number of
@@ -1093,13 +2461,19 @@ class rotationmap(datacube):
                 random draws averaged to form the returned model. If a float,
                 represents the percentile used from the samples. Must be
                 between 0 and 1 if a float.
-            collapse_func (Optional[callable]): How to collapse the random
+            collapse_func (Optional[callable/str]): How to collapse the random
                 number of samples. Must be a function which allows an ``axis``
-                argument (as with most Numpy functions).
+                argument (as with most Numpy functions). ``np.mean``,
+                ``np.std``, ``np.var`` and ``np.median``, or their names as
+                strings, are instead reduced in batches without storing all
+                the draws. See :func:`_collapse_draws` for more details.
             coords_only (Optional[bool]): Return the deprojected coordinates
                 rather than the v0 model. Default is False.
             profile_only (Optional[bool]): Return the radial profiles of the
                 velocity profiles rather than the v0 model. Default is False.
+            batch_size (Optional[int]): Number of draws to hold in memory at
+                once for the streaming reductions. If not specified, as many
+                as fit within ``collapse_max_memory`` bytes.
 
         Returns:
             model (ndarray): The sampled model, either the v0 model, or, if
@@ -1128,27 +2502,25 @@ class rotationmap(datacube):
         if samples.shape[1] != nparam:
             warning = "Invalid number of free parameters in 'samples': {:d}."
             raise ValueError(warning.format(nparam))
-        if not callable(collapse_func):
-            raise ValueError("'collapse_func' must be callable.")
+        rotationmap._check_collapse_func(collapse_func)
         verified_params = self.verify_params_dictionary(params.copy())
 
         # Avearge over a random draw of models.
 
         if isinstance(int(draws) if draws > 1.0 else draws, int):
-            rvals, models = [], []
-            for idx in np.random.randint(0, samples.shape[0], draws):
+
+            def make_model(idx):
                 tmp = self._populate_dictionary(samples[idx], verified_params)
                 if coords_only:
-                    models += [self.disk_coords(**tmp)]
+                    return self.disk_coords(**tmp)
                 elif profile_only:
-                    _rval, _model = self._make_profile(tmp)
-                    rvals += [_rval]
-                    models += [_model]
-                else:
-                    models += [self._make_model(tmp)]
-            rvals = collapse_func(rvals, axis=0)
-            models = collapse_func(models, axis=0)
-            return (rvals, models) if profile_only else models
+                    return self._make_profile(tmp)
+                return self._make_model(tmp)
+
+            idxs = np.random.randint(0, samples.shape[0], draws)
+            models = self._collapse_draws(make_model, idxs, collapse_func,
+                                          batch_size)
+            return (models[0], models[1]) if profile_only else models
 
         # Take a percentile of the samples.
 
@@ -1228,21 +2600,22 @@ class rotationmap(datacube):
         if samples.shape[1] != nparam:
             warning = "Invalid number of free parameters in 'samples': {:d}."
             raise ValueError(warning.format(nparam))
-        if not callable(collapse_func):
-            raise ValueError("'collapse_func' must be callable.")
+        rotationmap._check_collapse_func(collapse_func)
         verified_params = self.verify_params_dictionary(params.copy())
 
         # Average over draw of random model samples.
 
         if isinstance(int(draws) if draws > 1.0 else draws, int):
-            models = []
-            for idx in np.random.randint(0, samples.shape[0], draws):
+
+            def make_model(idx):
                 tmp = self._populate_dictionary(samples[idx], verified_params)
-                models += [self._make_model_vortex(rvals=rvals, 
-                                                   tvals=tvals,
-                                                   params=tmp,
-                                                   frame=frame)]
-            return collapse_func(models, axis=0)
+                return self._make_model_vortex(rvals=rvals,
+                                               tvals=tvals,
+                                               params=tmp,
+                                               frame=frame)
+
+            idxs = np.random.randint(0, samples.shape[0], draws)
+            return self._collapse_draws(make_model, idxs, collapse_func)
         
         # Take a percentile of the samples.
 
@@ -1259,6 +2632,66 @@ class rotationmap(datacube):
         else:
             raise ValueError("'draws' must be a float or integer.")
         
+    @staticmethod
+    def _check_collapse_func(collapse_func):
+        """Check ``collapse_func`` is callable or a streaming reduction."""
+        if isinstance(collapse_func, str):
+            if collapse_func not in rotationmap._streaming_reductions.values():
+                raise ValueError("Unknown 'collapse_func': "
+                                 "'{}'.".format(collapse_func))
+        elif not callable(collapse_func):
+            raise ValueError("'collapse_func' must be callable.")
+
+    def _collapse_draws(self, make_model, idxs, collapse_func,
+                        batch_size=None):
+        """
+        Collapse the models made from the sample indices ``idxs``. If
+        ``collapse_func`` is the mean, standard deviation or variance, the
+        models are made in batches of ``batch_size`` and combined with
+        :class:`running_statistics` so only one batch is held in memory. The
+        median is calculated exactly if all the draws would take less than
+        ``collapse_max_memory`` bytes, otherwise it is estimated with the
+        P-squared algorithm. Any other function is applied to all draws.
+
+        Args:
+            make_model (callable): Function returning the model (or tuple of
+                models) for a given sample index.
+            idxs (list): Indices of the samples to draw.
+            collapse_func (callable/str): How to collapse the draws.
+            batch_size (Optional[int]): Number of draws per batch. If not
+                specified, as many as fit within ``collapse_max_memory``.
+
+        Returns:
+            model (ndarray): The collapsed model.
+        """
+        stat = rotationmap._streaming_reductions.get(collapse_func, None)
+        if isinstance(collapse_func, str):
+            stat = collapse_func
+        if stat is None:
+            return collapse_func([make_model(idx) for idx in idxs], axis=0)
+
+        # The median is exact unless it would exceed the memory limit.
+
+        batch = [np.asarray(make_model(idxs[0]))]
+        nbytes = max(batch[0].nbytes, 1)
+        if stat == 'median' and nbytes * len(idxs) <= self.collapse_max_memory:
+            batch += [make_model(idx) for idx in idxs[1:]]
+            return np.median(batch, axis=0)
+
+        # Otherwise stream the draws through in batches.
+
+        if batch_size is None:
+            batch_size = self.collapse_max_memory // nbytes
+        batch_size = max(1, int(batch_size))
+        stats = running_statistics(quantile=0.5 if stat == 'median' else None)
+        for idx in idxs[1:]:
+            if len(batch) >= batch_size:
+                stats.update(np.array(batch))
+                batch = []
+            batch += [make_model(idx)]
+        stats.update(np.array(batch))
+        return getattr(stats, stat)
+
     def save_model(self, samples=None, params=None, model=None, filename=None,
                    overwrite=True):
         """
@@ -1268,6 +2701,7 @@ class rotationmap(datacube):
         from astropy.io import fits
         if model is None:
             model = self.evaluate_models(samples, params)
+        model = self.rasterize(model)
         if self.header['naxis1'] > self.nypix:
             canvas = np.ones(self._original_shape) * np.nan
             canvas[self._ya:self._yb, self._xa:self._xb] = model
@@ -1307,6 +2741,7 @@ class rotationmap(datacube):
 
         # Calculate the image to mirror.
 
+        self._check_image()
         if mirror_velocity_residual:
             to_mirror = self.data * 1e3 - self.evaluate_models(samples, params)
         else:
@@ -1500,7 +2935,7 @@ class rotationmap(datacube):
             assert x_disk.shape == y_disk.shape == v_disk.shape
             return x_disk, y_disk, v_disk
         elif frame == 'sky':
-            x_sky, y_sky = np.meshgrid(self.xaxis, self.yaxis)
+            x_sky, y_sky = self._get_cart_sky_coords(0.0, 0.0)
             assert x_sky.shape == y_sky.shape == v_proj.shape
             return x_sky, y_sky, v_proj
 
@@ -1520,6 +2955,35 @@ class rotationmap(datacube):
     def _make_model(self, params):
         """Build the velocity model from the dictionary of parameters."""
 
+        # Convolution with the beam requires the model for the full image, so
+        # build this before extracting the pixels of a compact map.
+
+        if params['beam'] and self._pix_idx is not None:
+            pix_idx, self._pix_idx = self._pix_idx, None
+            try:
+                v0 = self._make_model(params)
+            finally:
+                self._pix_idx = pix_idx
+            if self._pix_bins is not None:
+                return self._bin_average(v0[pix_idx])
+            return self._compact_values(v0)
+
+        # For binned maps the model is evaluated at the bin centroids unless
+        # averaging was requested, in which case it is evaluated on the pixels
+        # of each bin and averaged with the same weights as the data.
+
+        if self._pix_average and self._pix_bins is not None:
+            pix_bins, self._pix_bins = self._pix_bins, None
+            xsky, ysky = self._pix_xsky, self._pix_ysky
+            self._pix_xsky = self.xaxis[self._pix_idx[1]]
+            self._pix_ysky = self.yaxis[self._pix_idx[0]]
+            try:
+                v0 = self._make_model(params)
+            finally:
+                self._pix_bins = pix_bins
+                self._pix_xsky, self._pix_ysky = xsky, ysky
+            return self._bin_average(v0)
+
         # Get the model pixel-to-disk mappings.
 
         rvals, tvals, zvals = self.disk_coords(**params)
@@ -1545,6 +3009,22 @@ class rotationmap(datacube):
 
         return v0
 
+    def _bin_average(self, values, finite=None):
+        """
+        Average the values of the pixels of a binned map over each bin using
+        the inverse-variance weights of the pixels. Pixels which are not
+        ``finite``, by default the non-finite ``values``, are ignored, with
+        bins without any finite values returned as NaN.
+        """
+        nbins = self._pix_xsky.size
+        finite = np.isfinite(values) if finite is None else finite
+        w = np.where(finite, self._pix_weights, 0.0)
+        v = np.where(finite, values, 0.0)
+        wsum = np.bincount(self._pix_bins, weights=w, minlength=nbins)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.bincount(self._pix_bins, weights=w * v,
+                               minlength=nbins) / wsum
+
     def _make_profile(self, params):
         """Build the velocity profile from the dictionary of parameters."""
         rvals, _, zvals = self.disk_coords(**params)
@@ -1598,6 +3078,7 @@ class rotationmap(datacube):
         """
         from astropy.convolution import convolve, Box2DKernel
 
+        self._check_image()
         data_tmp = self.data.copy()
 
         for _ in range(niter):
@@ -1657,6 +3138,7 @@ class rotationmap(datacube):
         """
 
         # Default parameters.
+        self._check_image()
         vlsr = np.nanmedian(self.data) if vlsr is None else vlsr
         r_max = 0.5 * self.xaxis.max() if r_max is None else r_max
         r_min = 0.0 if r_min is None else r_min
@@ -1717,6 +3199,7 @@ class rotationmap(datacube):
         """
 
         # Default parameters.
+        self._check_image()
         vlsr = np.nanmedian(self.data) if vlsr is None else vlsr
         r_max = 0.5 * self.xaxis.max() if r_max is None else r_max
         r_min = 0.0 if r_min is None else r_min
@@ -1810,6 +3293,7 @@ class rotationmap(datacube):
 
     def downsample_cube(self, N, randomize=False):
         """Downsample the cube to make faster calculations."""
+        self._check_image()
         N = int(np.ceil(self.bmaj / self.dpix)) if N == 'beam' else N
         if randomize:
             N0x, N0y = np.random.randint(0, N, 2)
@@ -1822,6 +3306,231 @@ class rotationmap(datacube):
             self.error = self.error[N0y::N, N0x::N]
             self.mask = self.mask[N0y::N, N0x::N]
 
+    def set_resolution(self, N):
+        """
+        Replace the attached data with a block averaged version where each
+        block of ``N`` x ``N`` pixels is combined using an inverse-variance
+        weighted average. The axes are averaged in the same way and any
+        trailing pixels which do not fill a block are dropped. The full
+        resolution data is kept so that any level can be selected, with
+        ``N=1`` returning the original data. Note that the uncertainties
+        assume independent pixels so will be underestimated for blocks smaller
+        than the beam. Reassigning ``data``, ``error`` or the axes discards
+        the stored full resolution data, such that the new arrays are taken
+        as the full resolution.
+
+        Args:
+            N (int): Number of pixels along each axis to combine.
+        """
+        self._check_image()
+        N = int(N)
+        if N < 1:
+            raise ValueError("`N` must be a positive integer.")
+        if not hasattr(self, '_full_resolution'):
+            if N == 1:
+                return
+            self._full_resolution = (self.xaxis, self.yaxis, self.data,
+                                     self.error)
+        full = self._full_resolution
+        xaxis, yaxis, data, error = full
+        if N > 1:
+            weights = np.where(np.isfinite(data) & (error > 0.0),
+                               np.power(error, -2.0), 0.0)
+            wsum = rotationmap._block_sum(weights, N)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                data = np.where(weights > 0.0, data, 0.0) * weights
+                data = rotationmap._block_sum(data, N) / wsum
+                error = np.where(wsum > 0.0, wsum**-0.5, 0.0)
+            data = np.where(wsum > 0.0, data, np.nan)
+            xaxis = rotationmap._block_sum(xaxis, N) / N
+            yaxis = rotationmap._block_sum(yaxis, N) / N
+        self.xaxis, self.yaxis = xaxis, yaxis
+        self.data, self.error = data, error
+        self.mask = np.isfinite(self.data)
+        if N > 1:
+            self._full_resolution = full
+
+    @staticmethod
+    def _block_sum(array, N):
+        """Sum ``N`` consecutive elements along each axis of ``array``."""
+        for axis in range(array.ndim):
+            size = array.shape[axis] // N * N
+            array = np.take(array, np.arange(size), axis=axis)
+            shape = array.shape[:axis] + (size // N, N) + array.shape[axis+1:]
+            array = array.reshape(shape).sum(axis=axis+1)
+        return array
+
+    def _level_mask(self, user_mask, N):
+        """Block average ``user_mask`` to match the level ``N`` data."""
+        if N == 1 or np.ndim(user_mask) != 2:
+            return user_mask
+        return rotationmap._block_sum(user_mask.astype(float), N) >= 0.5 * N**2
+
+    def compact_map(self):
+        """
+        Store only the finite pixels of the map. The ``data``, ``error`` and
+        ``mask`` attributes become 1D arrays of these pixels, with their (y, x)
+        indices and sky-plane offsets stored internally. All deprojections,
+        models and fits are then only calculated for these pixels. Arrays are
+        placed back onto the image grid with :func:`rasterize` for plotting and
+        saving models. Functions which operate on the full image, such as
+        ``remove_hot_pixels``, require :func:`expand_map` to be called first.
+        """
+        if self._pix_idx is not None:
+            return
+        self._pix_idx = np.nonzero(np.isfinite(self.data))
+        self._pix_xsky = self.xaxis[self._pix_idx[1]]
+        self._pix_ysky = self.yaxis[self._pix_idx[0]]
+        self.data = self.data[self._pix_idx]
+        self.error = self._compact_values(self.error)
+        self.mask = self._compact_values(self.mask)
+        if hasattr(self, 'ivar'):
+            self.ivar = self._compact_values(self.ivar)
+
+    def expand_map(self):
+        """
+        Return the map to the full 2D images after ``compact_map`` or
+        ``voronoi_bin``.
+        """
+        if self._pix_idx is None:
+            return
+        if self._pix_bins is not None:
+            self.data, self.error = self._unbinned
+            self.mask = np.isfinite(self.data)
+            if hasattr(self, 'ivar'):
+                del self.ivar
+            self._pix_bins = None
+            self._pix_average = False
+            del self._unbinned, self._pix_weights
+        else:
+            self.data = self.rasterize(self.data)
+            self.error = self.rasterize(self.error, fill_value=0.0)
+            self.mask = self.rasterize(self.mask, fill_value=False)
+            if hasattr(self, 'ivar'):
+                self.ivar = self.rasterize(self.ivar, fill_value=0.0)
+        self._pix_idx = None
+
+    def voronoi_bin(self, target_error=None, min_beams=0.5, max_size=None,
+                    niter=5, average_model=False):
+        """
+        Adaptively bin the map into weighted Voronoi bins. Initial bins are
+        found by recursively splitting the image into square blocks while each
+        of the sub-blocks covers at least ``min_beams`` beams and, if
+        ``target_error`` is given, has a combined uncertainty no larger than
+        ``target_error``. The inverse-variance weighted centroids of these
+        blocks are then used as the generators of a weighted Voronoi
+        tessellation (`Diehl & Statler 2006`__), which is iterated ``niter``
+        times, moving the generators to the weighted centroids of their bins.
+
+        Each bin is represented by the inverse-variance weighted average of
+        its pixels, with an uncertainty of ``sum(error**-2)**-0.5``, placed at
+        the weighted centroid, where models are evaluated. As with
+        :func:`compact_map`, ``data``, ``error`` and ``mask`` become 1D arrays
+        of the bins such that ``fit_map`` and ``fit_annuli`` can be used
+        directly, with the model evaluated once per bin. Use
+        :func:`rasterize` to view bin values as an image and
+        :func:`expand_map` to return to the original data.
+
+        .. __: https://ui.adsabs.harvard.edu/abs/2006MNRAS.368..497D
+
+        Args:
+            target_error (Optional[float]): Target uncertainty of each bin in
+                [m/s]. If not specified, bins are only set by ``min_beams``.
+            min_beams (Optional[float]): Minimum size of a bin in units of the
+                beam area.
+            max_size (Optional[int]): Size in pixels of the largest square
+                block. Defaults to the smallest power of two which is greater
+                than 4 times the beam major axis.
+            niter (Optional[int]): Number of iterations of the tessellation.
+            average_model (Optional[bool]): If ``True``, evaluate models on
+                every pixel of each bin and average them with the same weights
+                as the data, rather than at the bin centroids. This removes
+                the bias from the curvature of the velocity field across large
+                bins, but costs as much per model as the unbinned map.
+
+        Returns:
+            nbins (int): The number of bins.
+        """
+        from scipy.spatial import cKDTree
+
+        self.expand_map()
+        data, error = self.data, self.error
+        weights = np.where(np.isfinite(data) & (error > 0.0),
+                           np.power(error, -2.0), 0.0)
+
+        # Recursively split the image into blocks. `leaf` holds the ID of the
+        # block each pixel belongs to.
+
+        min_npix = max(1.0, min_beams * self.pix_per_beam)
+        min_wsum = 0.0 if target_error is None else target_error**-2.0
+        if max_size is None:
+            max_size = 4.0 * self.bmaj / self.dpix
+        N = int(2**np.ceil(np.log2(max(max_size, 2))))
+        ny, nx = -(-self.nypix // N) * N, -(-self.nxpix // N) * N
+        wpad = np.zeros((ny, nx))
+        wpad[:self.nypix, :self.nxpix] = weights
+        leaf = np.arange((ny // N) * (nx // N)).reshape(ny // N, nx // N)
+        leaf = np.kron(leaf, np.ones((N, N), dtype=int))
+        split = np.ones((ny, nx), dtype=bool)
+        while N > 1:
+            n = N // 2
+            wsum = rotationmap._block_sum(wpad, n)
+            good = (wsum >= min_wsum) | (wsum == 0.0)
+            good &= n**2 >= min_npix
+            good = rotationmap._block_sum((~good).astype(int), 2) == 0
+            good = np.kron(good, np.ones((N, N), dtype=bool))
+            split &= good
+            ids = np.arange((ny // n) * (nx // n)).reshape(ny // n, nx // n)
+            ids = np.kron(ids, np.ones((n, n), dtype=int))
+            leaf = np.where(split, ids + leaf.max() + 1, leaf)
+            N = n
+        leaf = leaf[:self.nypix, :self.nxpix]
+
+        # Initial generators from the weighted centroids of the blocks.
+
+        pix_idx = np.nonzero(weights > 0.0)
+        x_pix = self.xaxis[pix_idx[1]]
+        y_pix = self.yaxis[pix_idx[0]]
+        w_pix = weights[pix_idx]
+        _, bins = np.unique(leaf[pix_idx], return_inverse=True)
+
+        # Iterate the weighted Voronoi tessellation. Each pixel is assigned to
+        # the generator with the smallest distance scaled by the bin size.
+
+        for i in range(int(niter) + 1):
+            bins = np.unique(bins, return_inverse=True)[1]
+            wsum = np.bincount(bins, weights=w_pix)
+            x_gen = np.bincount(bins, weights=w_pix * x_pix) / wsum
+            y_gen = np.bincount(bins, weights=w_pix * y_pix) / wsum
+            if i == int(niter):
+                break
+            scale = np.sqrt(np.bincount(bins))
+            k = min(8, x_gen.size)
+            dist, idx = cKDTree(np.vstack([x_gen, y_gen]).T).query(
+                np.vstack([x_pix, y_pix]).T, k=k)
+            dist, idx = dist.reshape(-1, k), idx.reshape(-1, k)
+            best = np.argmin(dist / scale[idx], axis=1)
+            bins = idx[np.arange(idx.shape[0]), best]
+
+        # Store the binned data.
+
+        self._unbinned = (self.data, self.error)
+        self._pix_idx, self._pix_bins = pix_idx, bins
+        self._pix_xsky, self._pix_ysky = x_gen, y_gen
+        self._pix_weights = w_pix
+        self._pix_average = bool(average_model)
+        self.data = np.bincount(bins, weights=w_pix * data[pix_idx]) / wsum
+        self.error = wsum**-0.5
+        self.mask = np.isfinite(self.data)
+        if hasattr(self, 'ivar'):
+            del self.ivar
+        return self.data.size
+
+    def _check_image(self):
+        """Make sure the data is stored as a 2D image."""
+        if self._pix_idx is not None:
+            raise ValueError("Data is compact. Call `expand_map()` first.")
+
     def _shift_center(self, dx=0.0, dy=0.0, data=None, save=True):
         """
         Shift the center of the image.
@@ -1834,6 +3543,8 @@ class rotationmap(datacube):
             save (optional[bool]): If True, overwrite ``rotationmap.data``.
         """
         from scipy.ndimage import shift
+        if data is None:
+            self._check_image()
         data = self.data.copy() if data is None else data
         to_shift = np.where(np.isfinite(data), data, 0.0)
         data = shift(to_shift, [-dy / self.dpix, dx / self.dpix])
@@ -1852,6 +3563,8 @@ class rotationmap(datacube):
             save (optional[bool]): If True, overwrite ``rotationmap.data``.
         """
         from scipy.ndimage import rotate
+        if data is None:
+            self._check_image()
         data = self.data.copy() if data is None else data
         to_rotate = np.where(np.isfinite(data), data, 0.0)
         data = rotate(to_rotate, PA - 90.0, reshape=False)
@@ -1895,6 +3608,7 @@ class rotationmap(datacube):
             dvelo (ndarray): Array of the uncertainties of the velocity
                 profiles with the same shape as ``fits``.
         """
+        import matplotlib.pyplot as plt
 
         # Make the axes.
 
@@ -1964,6 +3678,42 @@ class rotationmap(datacube):
             ax.tick_params(which='both', bottom=True, right=True, top=True)
         fig.align_labels(axs)
 
+    def plot_tilted_ring_profiles(self, rpnts, fits, dfits):
+        """
+        Plot the profiles from :func:`fit_tilted_rings`. The ``fits`` array
+        must specify ``[inc, PA, v_phi, v_r, v_lsr]`` in that order.
+
+        Args:
+            rpnts (array): Array of the annulus centers.
+            fits (ndarray): Array of the profiles with a shape of
+                ``(5, nannuli)``.
+            dfits (ndarray): Array of the uncertainties of the profiles with
+                the same shape as ``fits``.
+        """
+        import matplotlib.pyplot as plt
+
+        fig, axs = plt.subplots(nrows=3, ncols=1, figsize=(6.75, 6.25))
+
+        axs[0].errorbar(rpnts, fits[0], dfits[0], fmt='-o', ms=3)
+        axs[0].set_xlabel(r'Radius (arcsec)', labelpad=8)
+        axs[0].xaxis.set_label_position('top')
+        axs[0].xaxis.tick_top()
+        axs[0].set_ylabel(r'$i$' + ' (deg)')
+
+        axs[1].errorbar(rpnts, fits[1], dfits[1], fmt='-o', ms=3)
+        axs[1].set_xticklabels([])
+        axs[1].set_ylabel(r'PA' + ' (deg)')
+
+        axs[2].errorbar(rpnts, fits[2] / 1e3, dfits[2] / 1e3, fmt='-o', ms=3)
+        axs[2].set_xlabel(r'Radius (arcsec)')
+        axs[2].set_ylabel(r'$v_{\rm \phi}$' + ' (km/s)')
+
+        for ax in axs:
+            ax.grid(ls='--', color='0.9', lw=1.0)
+            ax.set_xlim(rpnts.min(), rpnts.max())
+            ax.tick_params(which='both', bottom=True, right=True, top=True)
+        fig.align_labels(axs)
+
     def plot_model(self, samples=None, params=None, model=None, draws=0.5,
                    mask=None, ax=None, imshow_kwargs=None, cb_label=None,
                    return_fig=False):
@@ -1991,6 +3741,7 @@ class rotationmap(datacube):
             fig (Matplotlib figure): If ``return_fig`` is ``True``. Can access
                 the axes through ``fig.axes`` for additional plotting.
         """
+        import matplotlib.pyplot as plt
 
         # Dummy axis for the plotting.
 
@@ -2002,6 +3753,8 @@ class rotationmap(datacube):
 
         if model is None:
             model = self.evaluate_models(samples, params.copy(), draws=draws)
+        model = self.rasterize(model)
+        mask = self.rasterize(mask, fill_value=0.0)
         vmin, vmax = np.nanpercentile(model / 1e3, [2, 98])
         vmax = max(abs(vmin - self.vlsr / 1e3), abs(vmax - self.vlsr / 1e3))
         vmin = self.vlsr / 1e3 - vmax
@@ -2064,6 +3817,7 @@ class rotationmap(datacube):
             fig (Matplotlib figure): If ``return_fig`` is ``True``. Can access
                 the axes through ``fig.axes`` for additional plotting.
         """
+        import matplotlib.pyplot as plt
 
         # Dummy axis to overplot.
 
@@ -2074,7 +3828,8 @@ class rotationmap(datacube):
 
         if model is None:
             model = self.evaluate_models(samples, params.copy(), draws=draws)
-        vres = self.data - model
+        vres = self.rasterize(self.data) - self.rasterize(model)
+        mask = self.rasterize(mask, fill_value=0.0)
         mask = np.ones(vres.shape) if mask is None else mask
         masked_vres = np.where(mask, vres, np.nan)
         vmin, vmax = np.nanpercentile(masked_vres, [2, 98])
@@ -2142,7 +3897,8 @@ class rotationmap(datacube):
 
         model = self.verify_params_dictionary(params.copy())
         model = self._populate_dictionary(np.median(samples, axis=0), model)
-        model['mask'] = np.isfinite(self.data) if mask_with_data else None
+        model['mask'] = self.rasterize(np.isfinite(self.data), False)
+        model['mask'] = model['mask'] if mask_with_data else None
         model.pop('r_max')
         fig = self.plot_surface(**model, **plot_surface_kwargs)
         self._gentrify_plot(ax=fig.axes[0])
@@ -2164,6 +3920,7 @@ class rotationmap(datacube):
             fig (Matplotlib figure): If ``return_fig`` is ``True``. Can access
                 the axes through ``fig.axes`` for additional plotting.
         """
+        import matplotlib.pyplot as plt
 
         r, _, z = self.evaluate_models(samples=samples,
                                        params=params,
@@ -2200,6 +3957,7 @@ class rotationmap(datacube):
         Returns:
             matplotlib axis: Matplotlib ax with axes drawn.
         """
+        import matplotlib.pyplot as plt
 
         # Dummy axis to plot.
 